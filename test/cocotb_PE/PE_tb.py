@@ -35,13 +35,13 @@ async def test_hdls(ptp, dut, iacts_array, wghts_array, psum_array, hyperparamet
     send_wght_thread = cocotb.start_soon(send_wght(ptp, dut, wghts_array, hyperparameter_list))
 
     await Combine(send_iact_thread, send_wght_thread)
-    cocotb.start_soon(rtl_test_utils.set_input(ptp, dut.compute_i, 1))
+    rtl_test_utils.set_input(ptp, dut.compute_i, 1)
     #dut.compute_i.value = 1
 
     await Timer(clk_cycle, units=clk_cycle_unit)
-    cocotb.start_soon(rtl_test_utils.set_input(ptp, dut.compute_i, 0))
+    rtl_test_utils.set_input(ptp, dut.compute_i, 0)
     #dut.compute_i.value = 0
-    cocotb.start_soon(rtl_test_utils.set_input(ptp, dut.psum_ready_i, 1))
+    rtl_test_utils.set_input(ptp, dut.psum_ready_i, 1)
 
     await RisingEdge(dut.psum_ready_o)
     await Timer(clk_cycle, units=clk_cycle_unit)
@@ -98,7 +98,7 @@ async def send_iact(ptp, dut, data_array, hyperparameter_list):
             spad_data[1][x] = spad_data[1][x] + x * 256
     dut._log.info("IACT ADDR is %s", spad_data[0])
     dut._log.info("IACT DATA is %s", spad_data[1])
-    cocotb.start_soon(rtl_test_utils.set_input(ptp, dut.iact_enable_i[0], 1))
+    rtl_test_utils.set_input(ptp, dut.iact_enable_i[0], 1)
     await send_to_spad(
         ptp,
         spad_data[0],
@@ -117,7 +117,7 @@ async def send_iact(ptp, dut, data_array, hyperparameter_list):
         dut.IACT_DATA_DATA.value,
         False,
     )
-    cocotb.start_soon(rtl_test_utils.set_input(ptp, dut.iact_enable_i[0], 0))
+    rtl_test_utils.set_input(ptp, dut.iact_enable_i[0], 0)
     await Timer(clk_cycle, units=clk_cycle_unit)
 
 async def get_psum(dut, iacts_array, wghts_array, psum_array):
@@ -191,7 +191,7 @@ async def send_wght(ptp, dut, data_array, hyperparameter_list):
     dut._log.info("WGHT ADDR is %s", spad_data[0])
     dut._log.info("WGHT DATA is %s", spad_data[1])
 
-    cocotb.start_soon(rtl_test_utils.set_input(ptp, dut.wght_enable_i, 1))
+    rtl_test_utils.set_input(ptp, dut.wght_enable_i, 1)
     await send_to_spad(
         ptp,
         spad_data[0],
@@ -210,7 +210,7 @@ async def send_wght(ptp, dut, data_array, hyperparameter_list):
         dut.WGHT_DATA_DATA.value,
         False,
     )
-    cocotb.start_soon(rtl_test_utils.set_input(ptp, dut.wght_enable_i, 0))
+    rtl_test_utils.set_input(ptp, dut.wght_enable_i, 0)
     await Timer(clk_cycle, units=clk_cycle_unit)
 
 async def send_bias(ptp, dut, data_array):
@@ -224,7 +224,7 @@ async def send_bias(ptp, dut, data_array):
         False,
     )
     dut._log.info("PSUM is %s", spad_data[1])
-    cocotb.start_soon(rtl_test_utils.set_input(ptp, dut.psum_enable_i, 1))
+    rtl_test_utils.set_input(ptp, dut.psum_enable_i, 1)
     await send_to_spad(
         ptp,
         spad_data[1],
@@ -234,30 +234,30 @@ async def send_bias(ptp, dut, data_array):
         dut.DATA_PSUM_BITWIDTH.value * 2,
         False,
     )
-    cocotb.start_soon(rtl_test_utils.set_input(ptp, dut.psum_enable_i, 0))
+    rtl_test_utils.set_input(ptp, dut.psum_enable_i, 0)
     await Timer(clk_cycle, units=clk_cycle_unit)
 
 async def reset_all_signals(ptp, dut):
-    cocotb.start_soon(rtl_test_utils.set_input(ptp,(dut.rst_ni), 0))
-    cocotb.start_soon(rtl_test_utils.set_input(ptp,(dut.data_mode_i), 0))
-    cocotb.start_soon(rtl_test_utils.set_input(ptp,(dut.iact_select_i), 0))
-    cocotb.start_soon(rtl_test_utils.set_input(ptp,(dut.compute_i), 0))
+    rtl_test_utils.set_input(ptp,(dut.rst_ni), 0)
+    rtl_test_utils.set_input(ptp,(dut.data_mode_i), 0)
+    rtl_test_utils.set_input(ptp,(dut.iact_select_i), 0)
+    rtl_test_utils.set_input(ptp,(dut.compute_i), 0)
 
     for glb_iact in range(dut.NUM_GLB_IACT.value):
-        cocotb.start_soon(rtl_test_utils.set_input(ptp,dut.iact_data_i[glb_iact], 0))
-        cocotb.start_soon(rtl_test_utils.set_input(ptp,dut.iact_enable_i[glb_iact], 0))
+        rtl_test_utils.set_input(ptp,dut.iact_data_i[glb_iact], 0)
+        rtl_test_utils.set_input(ptp,dut.iact_enable_i[glb_iact], 0)
 
-    cocotb.start_soon(rtl_test_utils.set_input(ptp,dut.wght_data_i, 0))
-    cocotb.start_soon(rtl_test_utils.set_input(ptp,dut.wght_enable_i, 0))
+    rtl_test_utils.set_input(ptp,dut.wght_data_i, 0)
+    rtl_test_utils.set_input(ptp,dut.wght_enable_i, 0)
 
-    cocotb.start_soon(rtl_test_utils.set_input(ptp,dut.psum_data_i, 0))
-    cocotb.start_soon(rtl_test_utils.set_input(ptp,dut.psum_enable_i, 0))
-    cocotb.start_soon(rtl_test_utils.set_input(ptp,dut.psum_ready_i, 0))
+    rtl_test_utils.set_input(ptp,dut.psum_data_i, 0)
+    rtl_test_utils.set_input(ptp,dut.psum_enable_i, 0)
+    rtl_test_utils.set_input(ptp,dut.psum_ready_i, 0)
 
-    cocotb.start_soon(rtl_test_utils.set_input(ptp,dut.fraction_bit_i, 0))
+    rtl_test_utils.set_input(ptp,dut.fraction_bit_i, 0)
 
     await Timer(clk_cycle, units=clk_cycle_unit)
-    cocotb.start_soon(rtl_test_utils.set_input(ptp,dut.rst_ni, 1))
+    rtl_test_utils.set_input(ptp,dut.rst_ni, 1)
     await Timer(clk_cycle, units=clk_cycle_unit)
 
 async def send_to_spad(ptp, spad, data_signal, addr_bits, trans_bits, data_bits, parallel):
@@ -283,10 +283,10 @@ async def send_to_spad(ptp, spad, data_signal, addr_bits, trans_bits, data_bits,
                 )
             except:
                 sending_data = sending_data
-        cocotb.start_soon(rtl_test_utils.set_input(ptp, (data_signal), sending_data))
+        rtl_test_utils.set_input(ptp, (data_signal), sending_data)
         sending_data = 0
         await Timer(clk_cycle, units=clk_cycle_unit)
-    cocotb.start_soon(rtl_test_utils.set_input(ptp, data_signal, 0))
+    rtl_test_utils.set_input(ptp, data_signal, 0)
 
 def generate_spad(
     array, addr_spad_words, data_spad_words, bitwidth, sisd, offset, ignore_zeros
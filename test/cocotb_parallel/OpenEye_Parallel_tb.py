@@ -11,6 +11,8 @@ import cocotb
 from cocotb.clock import Clock
 from cocotb.triggers import RisingEdge
 import cocotb_parallel.parallel_test_utils as ptu
+import cocotb_parallel.layer_pipeline as layer_pipeline
+import cocotb_parallel.transfer_scheduler as ts
 import test_utils.rtl_test_utils as rtl_test_utils
 import test_utils.timing_parameters as tp
 import test_utils.generic_test_utils as gtu
@@ -22,7 +24,9 @@ import test_utils.simple_layer_operations as slo
 import test_utils.layer_execution_state as les
 import test_utils.data_create as data_create
 import test_utils.tflite2model as tflite2model
-import test_utils.stream_dicts as strdic
+import test_utils.reference_cache as rc
+import test_utils.stream_cache as sc
+import test_utils.functional_model as functional_model
 from cocotb.triggers import Timer
 
 os.environ["CLOCK_LEN"] = "10"
@@ -51,11 +55,6 @@ except:
     logger.warning("Logger Level not given. Setting to INFO.")
     log_level = logging.INFO
 logger.setLevel(logging.INFO)
-global status_thread, iact_thread, wght_thread, psum_thread
-status_thread = []
-iact_thread = []
-wght_thread = []
-psum_thread = []
 
 @cocotb.test()
 async def single_layer_test(dut):
@@ -108,6 +107,11 @@ async def single_layer_test(dut):
         use_random = 1
         logger.debug("USE_RANDOM_VALUES set to one")
         print("except use random")
+
+    sim_mode = os.getenv("SIM_MODE", "rtl")
+    if sim_mode not in ("rtl", "functional"):
+        logger.warning("SIM_MODE " + str(sim_mode) + " unknown. Setting to rtl.")
+        sim_mode = "rtl"
     
     layer_es = les.LayerExecutionState()
     serial = 0
@@ -121,6 +125,8 @@ async def single_layer_test(dut):
     clk_delay_unit_out = os.environ["CLOCK_DELAY_UNIT_OUTPUT"]
 
     time_printer = time_stamper.time_stamper()
+    reference_cache = rc.ReferenceCache()
+    stream_cache = sc.StreamCache()
 
     ptp = tp.PortTimingParameters()
     ptp.initiate_params(clk_cycle, clk_cycle_unit, clk_delay_in, clk_delay_unit_in, clk_delay_out, clk_delay_unit_out)
@@ -143,6 +149,15 @@ async def single_layer_test(dut):
     openeye_parameter = oep.create_vh_file(serial)
     time_printer.timestamp("OpenEye parameters set. ", logger)
 
+    if(sim_mode == "functional"):
+        # Run the whole model through the fixed-point model instead of the RTL
+        def reference(layer, layer_number):
+            layer_parameters = lp.LayerParameters(layer, openeye_parameter)
+            return ptu.get_reference(openeye_parameter, layer_parameters, layer, layer_number, dram, False, reference_cache)
+        assert functional_model.run_model(openeye_parameter, model, dram, reference), "Functional model differs from the reference!"
+        time_printer.timestamp("Functional model finished. ", logger)
+        return
+
     # Start the clock
     clk = Clock(dut.clk_i, ptp.clk_cycle, units=ptp.clk_cycle_unit)
     cocotb.start_soon(clk.start())
@@ -150,68 +165,99 @@ async def single_layer_test(dut):
     # reset the DUT
     await cocotb.start_soon(rtl_test_utils.reset_all_signals(ptp, dut, openeye_parameter.SERIAL))
 
-    # Process the layers of the model one after another
+    # Process the layers of the model one after another. The static part of
+    # the next layer is prepared by the worker pool while the RTL simulates.
+    pipeline = layer_pipeline.LayerPipeline(openeye_parameter, model, dram, stream_cache)
+    pipeline.prefetch(0)
+    scheduler = ts.TransferScheduler(ptp)
+    prefetch_next_layer = ts.get_prefetch_next_layer()
     for layer_number, layer in enumerate(model.layers):
 
-        # TODO: After refactoring LayerParameters, it is nicer to use the constructor 
-        # layer_parameters = ptu.LayerParameters(model.layers[layer_number], openeye_parameter)
         if("Pooling" in str(layer)):
             slo.pool(dram, layer, layer_number)
         elif("Flat" in str(layer)):
             slo.flat(dram, layer, layer_number)
         else:
-            layer_parameters = lp.LayerParameters(layer, openeye_parameter)
-            time_printer.timestamp("Layer parameters created. ", logger)
-            calculated_results = ptu.collect_results(layer, layer_number, layer_parameters, dram)
-            if(logging.DEBUG >= log_level):
-                ptu.make_ref(openeye_parameter, layer_parameters, layer, layer_number, dram, calculated_results)
-                time_printer.timestamp("Reference data created. ", logger)
-
-            dram_layer_content = [dram.fmap[layer_number], dram.weights[layer_number], dram.bias[layer_number]]
             time_printer.timestamp("Start creating stream. ", logger)
-            stream = ptu.write_stream(openeye_parameter, layer_parameters, layer, dram_layer_content)
-            
+            layer_parameters, layer_streams = pipeline.get(layer_number)
             time_printer.timestamp("Streams set. ", logger)
+            pipeline.prefetch(layer_number + 1)
+
+            calculated_results = ptu.get_reference(openeye_parameter, layer_parameters, layer, layer_number, dram, logging.DEBUG >= log_level, reference_cache)
+            time_printer.timestamp("Reference data created. ", logger)
+
+            # The streams are consumed in order, the next one is needed early
+            streams = iter(layer_streams)
+            next_stream = next(streams)
             for layer_repetition in range(layer_parameters.needed_total_transmissions):
-                layer_thread = calculate_layer(ptp, dut, stream, openeye_parameter, layer_parameters, layer_repetition, model, layer_es, dram, log_level, layer_number, layer)
+                current_stream = next_stream
+                next_stream = next(streams, None)
+                # After the last repetition the weights of the next layer are loaded during the drain
+                next_layer = pipeline.peek(layer_number + 1) if (next_stream is None) and prefetch_next_layer else None
+                layer_thread = calculate_layer(ptp, dut, current_stream, next_stream, openeye_parameter, layer_parameters, layer_repetition, model, layer_es, dram, log_level, layer_number, layer, scheduler, next_layer)
                 await layer_thread
                 if(logging.DEBUG >= log_level):
                     assert gtu.check_results('demo/layer_' + str(layer_number) + '_' + str(layer_repetition) + '/dma_stream_ref.txt',\
                                 'demo/layer_' + str(layer_number) + '_' + str(layer_repetition) + '/output.txt')
-            assert ptu.compare_dram_with_ref(layer, calculated_results, dram.fmap[1 + layer_number])
+            scheduler.report("Layer " + str(layer_number))
+            assert ptu.compare_dram_with_ref(layer, calculated_results, dram.fmap[1 + layer_number], layer_parameters, openeye_parameter)
         slo.batchnorm_output(layer, 512, layer_number, dram)
 
+    scheduler.report_total()
     assert dut.rst_ni.value == 1, "rst_ni is not 1!"
 
-async def calculate_layer(ptp, dut, stream, oep, lp, layer_repetition, model, layer_es, dram, log_level, layer_number, layer):
-    global status_thread, iact_thread, wght_thread, psum_thread
+def get_router_mode_iact(stream, oep):
+    return rtl_test_utils.get_router_mode_port(stream.status.router_iact, oep.NUM_GLB_IACT, oep.Iact_Router_Bits)
+
+async def calculate_layer(ptp, dut, stream, next_stream, oep, lp, layer_repetition, model, layer_es, dram, log_level, layer_number, layer, scheduler, next_layer = None):
+    """ Run one layer repetition on the DUT.
+
+    The iact and wght GLBs are loaded by the TransferScheduler. Ports that
+    were loaded during the drain of the previous repetition are not sent
+    again. After the ready signal, the GLBs are loaded with next_stream, or
+    with the weights of next_layer, (layer_number, layer_params, streams) of
+    the next computed layer, while the output stream is drained.
+    """
+    key = (layer_number, layer_repetition)
     logger.info("Send stream.")
-    status_thread = cocotb.start_soon(rtl_test_utils.send_stream(ptp, dut, stream[layer_repetition], oep, lp, layer_repetition))
-    await status_thread
+    await scheduler.transfer("status", rtl_test_utils.send_stream(ptp, dut, stream, oep, lp, layer_repetition), key)
     # start the transmission of the data
-    if (layer_repetition == 0) :
-        iact_thread = cocotb.start_soon(rtl_test_utils.write_iact(ptp, dut, stream[layer_repetition][strdic.stream_parallel_dict["iact"]], oep, lp))
-        wght_thread = cocotb.start_soon(rtl_test_utils.write_wght(ptp, dut, stream[layer_repetition][strdic.stream_parallel_dict["wght"]], oep, lp))
-    if(stream[layer_repetition][strdic.stream_parallel_dict["status"]][strdic.status_dict["skipPsum"]] != 1):
-        psum_thread = cocotb.start_soon(rtl_test_utils.write_bias(ptp, dut, stream[layer_repetition][strdic.stream_parallel_dict["psum"]], oep, lp))
-        await psum_thread
+    if not scheduler.is_loaded("iact", key):
+        await scheduler.wait("iact")
+        scheduler.load("iact", rtl_test_utils.write_iact(ptp, dut, stream.iact, oep, lp), key)
+    if not scheduler.is_loaded("wght", key):
+        await scheduler.wait("wght")
+        scheduler.load("wght", rtl_test_utils.write_wght(ptp, dut, stream.wght, oep, lp), key)
+    if(stream.status.skipPsum != 1):
+        await scheduler.transfer("psum", rtl_test_utils.write_bias(ptp, dut, stream.psum, oep, lp), key)
     # wait until all transmission is finished
-    await iact_thread
-    await wght_thread
+    await scheduler.wait("iact")
+    await scheduler.wait("wght")
     logger.info("Stream is sent.")
     await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
-    cocotb.start_soon(rtl_test_utils.set_input(ptp,(dut.compute_i), 1))
+    rtl_test_utils.set_input(ptp,(dut.compute_i), 1)
     await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
-    cocotb.start_soon(rtl_test_utils.set_input(ptp,(dut.compute_i), 0))
-    await cocotb.start_soon(rtl_test_utils.await_ready_signal(ptp, dut, layer_number, model, layer_repetition, lp, oep, layer_es, dram, log_level, stream[layer_repetition]))
+    rtl_test_utils.set_input(ptp,(dut.compute_i), 0)
+    await scheduler.busy_with(rtl_test_utils.await_ready_signal(ptp, dut, layer_number, model, layer_repetition, lp, oep, layer_es, dram, log_level, stream))
     
     
-    if (layer_repetition != (lp.needed_total_transmissions-1)) :
-        iact_thread = cocotb.start_soon(rtl_test_utils.write_iact(ptp, dut, stream[layer_repetition + 1][strdic.stream_parallel_dict["iact"]], oep, lp))
-        wght_thread = cocotb.start_soon(rtl_test_utils.write_wght(ptp, dut, stream[layer_repetition + 1][strdic.stream_parallel_dict["wght"]], oep, lp))
+    # The wght routers take their mode from the pins in every idle cycle, so the
+    # mode of the next stream is driven before its weights are loaded. The iact
+    # router mode is only taken with the status register, the iact is loaded
+    # ahead only if the mode stays the same.
+    if (next_stream is not None) :
+        next_key = (layer_number, layer_repetition + 1)
+        if (get_router_mode_iact(next_stream, oep) == get_router_mode_iact(stream, oep)):
+            scheduler.load("iact", rtl_test_utils.write_iact(ptp, dut, next_stream.iact, oep, lp), next_key)
+        rtl_test_utils.set_router_mode_wght(ptp, dut, next_stream.status, oep)
+        scheduler.load("wght", rtl_test_utils.write_wght(ptp, dut, next_stream.wght, oep, lp), next_key)
+    elif (next_layer is not None) :
+        next_layer_number, next_lp, next_streams = next_layer
+        rtl_test_utils.set_router_mode_wght(ptp, dut, next_streams[0].status, oep)
+        scheduler.load("wght", rtl_test_utils.write_wght(ptp, dut, next_streams[0].wght, oep, next_lp), (next_layer_number, 0))
     if("Depthwise" in str(layer)):
-        await cocotb.start_soon(rtl_test_utils.compare_stream_Dw(ptp, dut, layer_number, model, layer_repetition, lp, oep, layer_es, dram, log_level, stream[layer_repetition]))
+        await scheduler.busy_with(rtl_test_utils.compare_stream_Dw(ptp, dut, layer_number, model, layer_repetition, lp, oep, layer_es, dram, log_level, stream))
     elif("Conv" in str(layer)):
-        await cocotb.start_soon(rtl_test_utils.compare_stream_Conv(ptp, dut, layer_number, model, layer_repetition, lp, oep, layer_es, dram, log_level, stream[layer_repetition]))
+        await scheduler.busy_with(rtl_test_utils.compare_stream_Conv(ptp, dut, layer_number, model, layer_repetition, lp, oep, layer_es, dram, log_level, stream))
     elif("Dense" in str(layer)):
-        await cocotb.start_soon(rtl_test_utils.compare_stream_Dense(ptp, dut, layer_number, model, layer_repetition, lp, oep, layer_es, dram, log_level, stream[layer_repetition]))
\ No newline at end of file
+        await scheduler.busy_with(rtl_test_utils.compare_stream_Dense(ptp, dut, layer_number, model, layer_repetition, lp, oep, layer_es, dram, log_level, stream))
@@ -0,0 +1,237 @@
+# This file is part of the OpenEye project.
+# All rights reserved. © Fachhochschule Dortmund - University of Applied Sciences and Arts.
+# SPDX-License-Identifier: SHL-2.1
+# For more details, see the LICENSE file in the root directory of this project.
+"""
+Host-side preparation of the next layer while the current layer simulates.
+
+The preparation of a layer is split in two parts. The static part, the
+LayerParameters and the status, wght and psum streams, only depends on the
+geometry and the weights. It is queued in the worker pool while the RTL of
+the previous layer runs. The iact streams depend on the output of the
+previous layer and are made as soon as it is written to the DRAM.
+
+The parts of the stream are looked up in the StreamCache first, only the
+parts that missed are made and stored in it, e.g. only the status and wght
+streams after new weights.
+
+With STREAM_LOOKAHEAD=K > 0 the repetitions are not made all at once. get()
+returns a StreamQueue that keeps at most K repetitions in the worker pool
+ahead of the one that is consumed, so the memory does not grow with the
+size of the layer. Streams made this way are not stored in the cache.
+"""
+import sys
+import os
+directory = (os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)))
+sys.path.extend([directory, os.path.dirname(os.path.realpath(__file__))])
+import logging
+import threading
+import collections
+import cocotb_parallel.parallel_test_utils as ptu
+import test_utils.layer_parameters as lp
+import test_utils.worker_pool as worker_pool
+import test_utils.stream_cache as sc
+from test_utils.layer_description import describe
+from test_utils.stream import Stream
+
+logger = logging.getLogger("cocotb")
+
+
+# The parts of the stream that do not depend on the input feature map
+static_parts = ("weights", "bias")
+
+def get_lookahead():
+    """ Return the number of repetitions made ahead, 0 makes all at once. """
+    try:
+        return max(0, int(os.getenv("STREAM_LOOKAHEAD", 0)))
+    except ValueError:
+        logger.warning("STREAM_LOOKAHEAD is not a number. Setting to 0.")
+        return 0
+
+def make_layer_parameters_mp(layer, params):
+    return lp.LayerParameters(layer, params)
+
+def is_computed_layer(layer):
+    """ Return True for layers that run on the accelerator. """
+    return not (("Pooling" in str(layer)) or ("Flat" in str(layer)))
+
+
+class PreparedLayer(object):
+    """ Static part of a layer, prepared in the background by the worker pool.
+
+    The LayerParameters are made by one worker, then the static streams of
+    all layer repetitions are queued, unless they are in the cache or lazy
+    is set. Only the parts that are not in the cache are made, see
+    sc.PARTS. result() waits until both are done, streams is None if lazy is
+    set and they are not all in the cache.
+    """
+    def __init__(self, params, layer, layer_number, dram, cache = None, lazy = False):
+        self.params = params
+        self.layer = describe(layer)
+        self.layer_number = layer_number
+        self.dram_layer_content = [None, dram.weights[layer_number], dram.bias[layer_number]]
+        self.layer_params = None
+        self.streams = None
+        self.error = None
+        self.done = threading.Event()
+        self.cache = cache
+        self.hits = []
+        self.missing = static_parts
+        self.made = None
+        self.lazy = lazy
+        if cache is not None:
+            self.keys = cache.part_keys(params, layer, self.dram_layer_content, static_parts)
+            self.hits, self.missing = cache.load_parts(self.keys)
+            if not self.missing:
+                self.streams = sc.combine(self.hits)
+        worker_pool.apply_async(make_layer_parameters_mp, (describe(layer, weights = True), params),
+                                callback = self._parameters_ready, error_callback = self._failed)
+
+    def _parameters_ready(self, layer_params):
+        # Runs in the result thread of the pool, so it must only queue work
+        self.layer_params = layer_params
+        if (not self.missing) or self.lazy:
+            self.done.set()
+            return
+        try:
+            worker_pool.starmap_async(ptu.write_components_layer_mp,
+                                      [(self.params, layer_params, self.layer, self.dram_layer_content, layer_repetition, sc.get_components(self.missing))
+                                       for layer_repetition in range(layer_params.needed_total_transmissions)],
+                                      callback = self._streams_ready, error_callback = self._failed)
+        except Exception as e:
+            self._failed(e)
+
+    def _streams_ready(self, streams):
+        self.made = streams
+        self.streams = sc.combine(self.hits + [(sc.get_components(self.missing), streams)])
+        self.done.set()
+
+    def _failed(self, error):
+        self.error = error
+        self.done.set()
+
+    def result(self):
+        """ Wait for the static part and return (layer_params, streams). """
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        if (self.cache is not None) and (self.made is not None):
+            self.cache.store_parts({part: self.keys[part] for part in self.missing}, self.made)
+            self.made = None
+        return self.layer_params, self.streams
+
+
+class StreamQueue(object):
+    """ Iterator over the streams of the layer repetitions.
+
+    The streams are made by the worker pool, at most lookahead repetitions
+    ahead of the one that was returned last. If static_streams are given,
+    only the iact streams are made and added to them.
+    """
+    def __init__(self, params, layer_params, layer, dram_layer_content, lookahead, static_streams = None):
+        self.params = params
+        self.layer_params = layer_params
+        self.layer = layer
+        self.dram_layer_content = dram_layer_content
+        self.lookahead = max(1, lookahead)
+        self.static_streams = static_streams
+        self.pending = collections.deque()
+        self.next_repetition = 0
+        self.fill()
+
+    def fill(self):
+        while (len(self.pending) < self.lookahead) and (self.next_repetition < len(self)):
+            function = ptu.write_stream_layer_mp if self.static_streams is None else ptu.write_iact_stream_layer_mp
+            self.pending.append((self.next_repetition, worker_pool.apply_async(function,
+                                 (self.params, self.layer_params, self.layer, self.dram_layer_content, self.next_repetition))))
+            self.next_repetition = self.next_repetition + 1
+
+    def __len__(self):
+        return self.layer_params.needed_total_transmissions
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.pending:
+            raise StopIteration
+        layer_repetition, result = self.pending.popleft()
+        stream = result.get()
+        self.fill()
+        if self.static_streams is not None:
+            static_stream = self.static_streams[layer_repetition]
+            stream = Stream(static_stream.serial, static_stream.status, stream, static_stream.wght, static_stream.psum)
+        return stream
+
+
+class LayerPipeline(object):
+    """ Prepares the layers of a model one layer ahead.
+
+    prefetch() queues the static part of the next computed layer, get() waits
+    for it and adds the iact streams from the current DRAM contents.
+    cache is an optional StreamCache, lookahead the number of repetitions
+    that are made ahead (default STREAM_LOOKAHEAD, 0 makes all at once).
+    """
+    def __init__(self, params, model, dram, cache = None, lookahead = None):
+        self.params = params
+        self.model = model
+        self.dram = dram
+        self.cache = cache
+        self.lookahead = get_lookahead() if lookahead is None else lookahead
+        self.prepared = {}
+
+    def prefetch(self, layer_number):
+        """ Queue the static part of the first computed layer from layer_number on. """
+        for next_layer_number in range(layer_number, len(self.model.layers)):
+            layer = self.model.layers[next_layer_number]
+            if is_computed_layer(layer):
+                if next_layer_number not in self.prepared:
+                    logger.debug("Prepare layer " + str(next_layer_number) + " in the background.")
+                    self.prepared[next_layer_number] = PreparedLayer(self.params, layer, next_layer_number, self.dram, self.cache, self.lookahead > 0)
+                return
+
+    def peek(self, layer_number):
+        """ Return (layer_number, layer_params, streams) of the first computed layer from layer_number on.
+
+        Only the static part of the layer is returned, and only if it is
+        ready, otherwise None. The call does not wait for the worker pool.
+        """
+        for next_layer_number in range(layer_number, len(self.model.layers)):
+            if is_computed_layer(self.model.layers[next_layer_number]):
+                prepared = self.prepared.get(next_layer_number)
+                if (prepared is None) or (not prepared.done.is_set()) or (prepared.error is not None) or (prepared.streams is None):
+                    return None
+                return next_layer_number, prepared.layer_params, prepared.streams
+        return None
+
+    def get(self, layer_number):
+        """ Return (layer_params, streams) of a layer.
+
+        streams is a list with the Stream of every repetition, or a
+        StreamQueue if the repetitions are made lazily. The input feature map
+        of the layer must be in the DRAM.
+        """
+        if layer_number not in self.prepared:
+            self.prefetch(layer_number)
+        layer_params, stream = self.prepared.pop(layer_number).result()
+        layer = describe(self.model.layers[layer_number])
+        dram_layer_content = [self.dram.fmap[layer_number], None, None]
+        iact_streams = None
+        if self.cache is not None:
+            keys = self.cache.part_keys(self.params, layer, dram_layer_content, ("fmap",))
+            cached = self.cache.load(keys["fmap"])
+            if cached is not None:
+                iact_streams = [cached_stream.iact for cached_stream in cached]
+        if (self.lookahead > 0) and ((iact_streams is None) or (stream is None)):
+            if stream is None:
+                dram_layer_content = [self.dram.fmap[layer_number], self.dram.weights[layer_number], self.dram.bias[layer_number]]
+            return layer_params, StreamQueue(self.params, layer_params, layer, dram_layer_content, self.lookahead, stream)
+        if iact_streams is None:
+            iact_streams = worker_pool.starmap(ptu.write_iact_stream_layer_mp,
+                                               [(self.params, layer_params, layer, dram_layer_content, layer_repetition)
+                                                for layer_repetition in range(layer_params.needed_total_transmissions)])
+            if self.cache is not None:
+                self.cache.store_parts(keys, [Stream(self.params.SERIAL, None, iact_stream, None, None) for iact_stream in iact_streams])
+        for layer_repetition, iact_stream in enumerate(iact_streams):
+            stream[layer_repetition].iact = iact_stream
+        return layer_params, stream
@@ -9,12 +9,19 @@ directory = (os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__fil
 sys.path.extend([directory, os.path.dirname(os.path.realpath(__file__))])
 import logging
 import math
+import collections
+import numpy as np
 from test_utils.dense_mapper import DenseMapper
 from test_utils.conv_mapper import ConvMapper
 from test_utils.dw_mapper import DWMapper
 import test_utils.generic_test_utils as gtu
-import test_utils.stream_dicts as strdic
-import multiprocessing as mp
+import test_utils.reference_model as rm
+import test_utils.reference_cache as reference_cache
+import test_utils.stream_cache as sc
+import test_utils.worker_pool as worker_pool
+import test_utils.shared_array as shared_array
+from test_utils.layer_description import describe
+from test_utils.stream import Stream, intern_streams
 
 logger = logging.getLogger("cocotb")
 
@@ -51,37 +58,66 @@ def get_verilog_sources(hdl_dir, serial):
         verilog_sources.append(os.path.join(hdl_dir, "OpenEye_Wrapper.v"))
     return verilog_sources
 
-def write_stream_layer_mp(params, layer_params, layer, dram_layer_content, return_dict, layer_repetition):
+def get_layer_mapper(params, layer_params, layer, dram_layer_content, layer_repetition):
     if "Depthwise" in str(layer):
-        LayerStreamGenerator = DWMapper(params, layer_params, layer_repetition, dram_layer_content)
-        LayerStreamGenerator.make_stream()
+        return DWMapper(params, layer_params, layer_repetition, dram_layer_content)
     elif "Conv" in str(layer):
-        LayerStreamGenerator = ConvMapper(params, layer_params, layer_repetition, dram_layer_content)
-        LayerStreamGenerator.make_stream()
+        return ConvMapper(params, layer_params, layer_repetition, dram_layer_content)
     elif "Dense" in str(layer):
-        LayerStreamGenerator = DenseMapper(params, layer_params, layer_repetition, dram_layer_content)
-        LayerStreamGenerator.make_stream()
-    return_dict[layer_repetition] = LayerStreamGenerator.get_stream()
-
-def write_stream(params, layer_params, layer, dram_layer_content):
-    manager = mp.Manager()
-    return_dict = manager.dict()
-    jobs = []
-
-    for layer_repetition in range(layer_params.needed_total_transmissions):
-        p = mp.Process(target = write_stream_layer_mp, args = (params, layer_params, layer, dram_layer_content, return_dict, layer_repetition))
-        p.start()
-        jobs.append(p)
-
-    for proc in range(len(jobs)):
-        jobs[proc].join()
-    #assert False
-    return return_dict
+        return DenseMapper(params, layer_params, layer_repetition, dram_layer_content)
+
+def write_stream_layer_mp(params, layer_params, layer, dram_layer_content, layer_repetition):
+    LayerStreamGenerator = get_layer_mapper(params, layer_params, layer, dram_layer_content, layer_repetition)
+    LayerStreamGenerator.make_stream()
+    return LayerStreamGenerator.get_stream().share()
+
+def write_iact_stream_layer_mp(params, layer_params, layer, dram_layer_content, layer_repetition):
+    LayerStreamGenerator = get_layer_mapper(params, layer_params, layer, dram_layer_content, layer_repetition)
+    LayerStreamGenerator.make_iact_stream()
+    logger.info("Stream finished: " + str(layer_repetition + 1) + " of " + str(layer_params.needed_total_transmissions))
+    return LayerStreamGenerator.get_stream().iact.share()
+
+def write_components_layer_mp(params, layer_params, layer, dram_layer_content, layer_repetition, components):
+    """ Return a Stream with the given components of a layer repetition, the others are None. """
+    LayerStreamGenerator = get_layer_mapper(params, layer_params, layer, dram_layer_content, layer_repetition)
+    LayerStreamGenerator.make_components(components)
+    logger.info("Stream finished: " + str(layer_repetition + 1) + " of " + str(layer_params.needed_total_transmissions))
+    stream = LayerStreamGenerator.get_stream()
+    for component in ("status",) + Stream.ports:
+        if component not in components:
+            setattr(stream, component, None)
+    return stream.share()
+
+def write_stream(params, layer_params, layer, dram_layer_content, cache = None):
+    """ Return the streams of all layer repetitions.
+
+    If cache is a StreamCache, the parts of the streams are taken from it on a
+    hit. Only the parts that missed are made and stored in it, e.g. only the
+    status and wght streams after new weights, see sc.PARTS.
+    """
+    hits = []
+    components = sc.get_components(sc.PARTS)
+    if cache is not None:
+        keys = cache.part_keys(params, layer, dram_layer_content)
+        hits, missing = cache.load_parts(keys)
+        if not missing:
+            return sc.combine(hits)
+        components = sc.get_components(missing)
+        if hits:
+            logger.info("Make the components " + str(components) + " of the stream, the others are cached.")
+    layer = describe(layer)
+    streams = worker_pool.starmap(write_components_layer_mp, [(params, layer_params, layer, dram_layer_content, layer_repetition, components)
+                                                              for layer_repetition in range(layer_params.needed_total_transmissions)])
+    streams = intern_streams(streams)
+    if cache is not None:
+        cache.store_parts({part: keys[part] for part in missing}, streams)
+    return sc.combine(hits + [(components, streams)])
 
 #Reference
 
 def make_ref(params, layer_params, layer, layer_number, dram, calculated_results):
-    
+    # The workers of the output streams read the results from shared memory
+    calculated_results = shared_array.copy(calculated_results)
 
     #Write wght File
     write_weight_file(layer, layer_number, dram)
@@ -129,34 +165,16 @@ def make_ref(params, layer_params, layer, layer_number, dram, calculated_results
                 for b in range(0,params.Clusters_Y,layer_params.used_Y_cluster):
                     cluster_order.append(a+b)
 
-            manager = mp.Manager()
-            jobs = []
-
-            for layer_repetition in range(layer_params.needed_total_transmissions):
-                p = mp.Process(target = calculate_dw_output_stream_mp, \
-                               args = (layer_repetition, layer_number, params, layer_params, layer, cluster_order, calculated_results))
-                p.start()
-                jobs.append(p)
-            
-            for proc in range(len(jobs)):
-                jobs[proc].join()
+            worker_pool.starmap(calculate_dw_output_stream_mp, [(layer_repetition, layer_number, params, layer_params, describe(layer), cluster_order, calculated_results)
+                                                                for layer_repetition in range(layer_params.needed_total_transmissions)])
     elif "Conv" in str(layer):
         cluster_order = []
         for a in range(layer_params.used_Y_cluster):
             for b in range(0,params.Clusters_Y,layer_params.used_Y_cluster):
                 cluster_order.append(a+b)
 
-        manager = mp.Manager()
-        jobs = []
-
-        for layer_repetition in range(layer_params.needed_total_transmissions):
-            p = mp.Process(target = calculate_conv_output_stream_mp, \
-                            args = (layer_repetition, layer_number, params, layer_params, layer, cluster_order, calculated_results))
-            p.start()
-            jobs.append(p)
-        
-        for proc in range(len(jobs)):
-            jobs[proc].join()
+        worker_pool.starmap(calculate_conv_output_stream_mp, [(layer_repetition, layer_number, params, layer_params, describe(layer), cluster_order, calculated_results)
+                                                              for layer_repetition in range(layer_params.needed_total_transmissions)])
     elif "Dense" in str(layer):
         if(params.SERIAL):
             assert False, "not realized yet"
@@ -250,9 +268,6 @@ def write_iact_file(layer, layer_number, dram):
         return iact_ref
 
 def write_psum_file(layer, layer_number, dram, calculated_results):
-    manager = mp.Manager()
-    return_dict = manager.dict()
-    jobs = []
     if "Dense" in str(layer):
         psum_ref = gtu.open_or_create_file('demo/layer_' + str(layer_number) + '/psum/psum_ref' + '_0.csv')
         for x in range(layer.output.shape[1]):
@@ -271,91 +286,85 @@ def write_psum_file(layer, layer_number, dram, calculated_results):
             psum_ref[c].close()
 
     elif "Conv" in str(layer):
-        for f in range(layer.output.shape[3]):
-            p = mp.Process(target = write_psum_file_conv_mp, args = (f, layer, calculated_results, return_dict))
-            p.start()
-            jobs.append(p)
-        for proc in range(len(jobs)):
-            jobs[proc].join()
+        psum_files = worker_pool.starmap(write_psum_file_conv_mp, [(f, describe(layer), calculated_results[f]) for f in range(layer.output.shape[3])])
         psum_ref = [0 for f in range(layer.output.shape[3])]
         for f in range(layer.output.shape[3]):
             psum_ref[f] = gtu.open_or_create_file('demo/layer_' + str(layer_number) + '/psum/psum_ref' + '_' +  str(f) + '.csv')
-            psum_ref[f].write(return_dict[f])
+            psum_ref[f].write(psum_files[f])
             psum_ref[f].close()
     return psum_ref
 
-def write_psum_file_conv_mp(f, layer, calculated_results, return_dict):
+def write_psum_file_conv_mp(f, layer, calculated_results):
     psum_ref = ""
     for x in range(layer.output.shape[1]):
         for y in range(layer.output.shape[2]):
-            psum_ref = psum_ref + (str(calculated_results[f][y][x]).rjust(8) + ";")
+            psum_ref = psum_ref + (str(calculated_results[y][x]).rjust(8) + ";")
         psum_ref = psum_ref + ("\n")
-    return_dict[f] = psum_ref
+    return psum_ref
+
+def get_reference(params, layer_params, layer, layer_number, dram, write_files, cache = None):
+    """ Return the reference results of a layer, served from the reference cache if possible.
+
+    If write_files is set, the reference files of make_ref are written as well.
+    The expected DMA streams are restored from the cache, the other files are
+    written from the cached results.
+    """
+    if cache is None:
+        cache = reference_cache.ReferenceCache()
+    if not cache.enabled:
+        calculated_results = collect_results(layer, layer_number, layer_params, dram)
+        if write_files:
+            make_ref(params, layer_params, layer, layer_number, dram, calculated_results)
+        return calculated_results
+
+    key = cache.key(params, layer_params, layer, layer_number, dram)
+    entry = cache.load(key)
+    if entry is not None:
+        calculated_results, dma_streams = entry
+        if not write_files:
+            return calculated_results
+        if dma_streams is not None and len(dma_streams) == layer_params.needed_total_transmissions:
+            write_weight_file(layer, layer_number, dram)
+            write_iact_file(layer, layer_number, dram)
+            write_psum_file(layer, layer_number, dram, calculated_results)
+            for layer_repetition in range(layer_params.needed_total_transmissions):
+                file_dma_ref = gtu.open_or_create_file(get_dma_stream_ref_path(layer_number, layer_repetition))
+                file_dma_ref.write(str(dma_streams[layer_repetition]))
+                file_dma_ref.close()
+            logger.info("Reference files restored from cache.")
+            return calculated_results
+    else:
+        calculated_results = collect_results(layer, layer_number, layer_params, dram)
+
+    dma_streams = None
+    if write_files:
+        make_ref(params, layer_params, layer, layer_number, dram, calculated_results)
+        dma_streams = []
+        for layer_repetition in range(layer_params.needed_total_transmissions):
+            with open(get_dma_stream_ref_path(layer_number, layer_repetition), 'r') as file_dma_ref:
+                dma_streams.append(file_dma_ref.read())
+    cache.store(key, calculated_results, dma_streams)
+    return calculated_results
+
+def get_dma_stream_ref_path(layer_number, layer_repetition):
+    return 'demo/layer_' + str(layer_number) + '_' + str(layer_repetition) + '/dma_stream_ref.txt'
 
 #Collect and get results
 def collect_results(layer, layer_number, layer_params, dram):
     #Calculate Bias
     if "Dense" in str(layer):
-        calculated_results = [0 for i in range(layer.output.shape[1])]
-        manager = mp.Manager()
-        return_dict = manager.dict()
-        jobs = []
-        for x in range(layer.output.shape[1]):
-            p = mp.Process(target = calculate_dense_results_mp, args = (x, layer, layer_number, dram, calculated_results[x], return_dict))
-            p.start()
-            jobs.append(p)
-        for proc in range(len(jobs)):
-            jobs[proc].join()
-        calculated_results = return_dict
+        calculated_results = rm.dense(dram.fmap[layer_number], dram.weights[layer_number], rm.get_bias(layer, layer.output.shape[1]))
 
     elif "Depthwise" in str(layer):
-        calculated_results = [[[0 for i in range(layer.output.shape[1])] for j in range(layer.output.shape[2])]for k in range(layer.output.shape[3])]
-        for j in range(layer.output.shape[1]):
-            for i in range(layer.output.shape[2]):
-                for f in range(layer.output.shape[3]):
-                    calculated_results[f][i][j] = int(calculated_results[f][i][j] + int(layer.bias[f]))
-        for j in range(layer.output.shape[1]):
-            for i in range(layer.output.shape[2]):
-                for y in range(0 - math.floor(layer.kernel_size[1]/2),math.ceil(layer.kernel_size[1]/2)):
-                    for c in range(layer.input.shape[3]):
-                        for x in range(0 - math.floor(layer.kernel_size[0]/2),math.ceil(layer.kernel_size[0]/2)):
-                            if((((x + i * layer_params.strideX) >= 0) & ((x + i * layer_params.strideX) < (layer.output.shape[2] * layer_params.strideX))) & \
-                            (((y + j * layer_params.strideY) >= 0) & ((y + j * layer_params.strideY) < (layer.output.shape[1] * layer_params.strideY)))):
-                                calculated_results[c][i][j] = int(calculated_results[c][i][j] + \
-                                                                dram.weights[layer_number][c][x + math.floor(layer.kernel_size[0]/2)][y + math.floor((layer.kernel_size[1]-1)/2)] * \
-                                                                dram.fmap[layer_number][c][x + (i * layer_params.strideX)][y + (j * layer_params.strideY)])
-                            else:
-                                calculated_results[c][i][j] = int(calculated_results[c][i][j] + \
-                                                                dram.weights[layer_number][c][x + math.floor(layer.kernel_size[0]/2)][y + math.floor((layer.kernel_size[1]-1)/2)])
+        calculated_results = rm.depthwise_conv2d(dram.fmap[layer_number], dram.weights[layer_number], rm.get_bias(layer, layer.output.shape[3]),
+                                                 layer.kernel_size, (layer_params.strideX, layer_params.strideY),
+                                                 (layer.output.shape[2], layer.output.shape[1]))
     elif "Conv" in str(layer):
-        calculated_results = [[[0 for i in range(layer.output.shape[1])] for j in range(layer.output.shape[2])]for k in range(layer.output.shape[3])]
-        for j in range(layer.output.shape[1]):
-            for i in range(layer.output.shape[2]):
-                for f in range(layer.output.shape[3]):
-                    calculated_results[f][i][j] = int(calculated_results[f][i][j] + int(layer.bias[f]))
-
-        manager = mp.Manager()
-        return_dict = manager.dict()
-        jobs = []
-        max_parallel_jobs = 1
-        semaphore = mp.Semaphore(max_parallel_jobs)
-
-        for f in range(layer.output.shape[3]):
-            p = mp.Process(target = calculate_conv_results_mp, args = (f, layer, layer_number, layer_params, dram, calculated_results[f], return_dict, semaphore))
-            p.start()
-            jobs.append(p)
-        
-        for proc in range(len(jobs)):
-            jobs[proc].join()
-
-        calculated_results = return_dict
+        calculated_results = rm.conv2d(dram.fmap[layer_number], dram.weights[layer_number], rm.get_bias(layer, layer.output.shape[3]),
+                                       layer.kernel_size, (layer_params.strideX, layer_params.strideY),
+                                       (layer.output.shape[2], layer.output.shape[1]))
     return calculated_results
 
-def calculate_dense_results_mp(x, layer, layer_number, dram, calculated_results,return_dict):
-    for c in range(layer.input.shape[1]):
-        calculated_results = int(calculated_results + dram.weights[layer_number][x][c] * dram.fmap[layer_number][c])
-    return_dict[x] = calculated_results
-
 def calculate_conv_output_stream_mp(layer_repetition, layer_number, params, layer_params, layer, cluster_order, calculated_results):
     file_dma_ref = gtu.open_or_create_file('demo/layer_' + str(layer_number) + '_' + str(layer_repetition) + '/dma_stream_ref.txt')
     layer_repetition_cycle = math.floor(layer_repetition/layer_params.iact_transmissions_pe)
@@ -467,63 +476,69 @@ def calculate_dw_output_stream_mp(layer_repetition, layer_number, params, layer_
 
     logger.info("Stream " + str(layer_repetition) + " / " + str(layer_params.needed_total_transmissions) + " calculated.")
 
-def calculate_conv_results_mp(f, layer, layer_number, layer_params, dram, calculated_results, return_dict, semaphore):
-    with semaphore:
-        if(f < layer.kernel.shape[3]):
-            for j in range(layer.output.shape[1]):
-                for i in range(layer.output.shape[2]):
-                    for x in range(0 - math.floor(layer.kernel_size[0]/2),math.ceil(layer.kernel_size[0]/2)):
-                        for c in range(layer.input.shape[3]):
-                            for y in range(0 - math.floor(layer.kernel_size[1]/2),math.ceil(layer.kernel_size[1]/2)):
-                                if((((x + i * layer_params.strideX) >= 0) & ((x + i * layer_params.strideX) < (layer.output.shape[2] * layer_params.strideX))) & \
-                                (((y + j * layer_params.strideY) >= 0) & ((y + j * layer_params.strideY) < (layer.output.shape[1] * layer_params.strideY)))):
-                                    calculated_results[i][j] = int(calculated_results[i][j] + \
-                                                                    dram.weights[layer_number][c][f][x + math.floor(layer.kernel_size[0]/2)][y + math.floor((layer.kernel_size[1]-1)/2)] * \
-                                                                    dram.fmap[layer_number][c][x + (i * layer_params.strideX)][y + (j * layer_params.strideY)])
+def compare_dram_with_ref(layer, ref_output, dram, layer_params = None, params = None, max_reported = 10):
+    """ Compare the output in the DRAM with the reference output.
 
-                                else:
-                                    calculated_results[i][j] = int(calculated_results[i][j] + \
-                                                                    dram.weights[layer_number][c][f][x + math.floor(layer.kernel_size[0]/2)][y + math.floor((layer.kernel_size[1]-1)/2)])
-        return_dict[f] = calculated_results
+    On a mismatch the total mismatch count, the first max_reported mismatch
+    coordinates, the maximum absolute error and the mismatches per filter are
+    logged. If layer_params and params are given, the mismatches per tile
+    (cl_x, cl_y, router) of the PE array that computed them are logged, too.
 
-def compare_dram_with_ref(layer, ref_output, dram):
+    Returns:
+        True if all results are equal.
+    """
     logger.info("Results are checked.")
 
-    if "Conv" in str(layer):
-        manager = mp.Manager()
-        return_dict = manager.dict()
-        jobs = []
-
-        for f in range(len(ref_output)):
-            p = mp.Process(target = compare_dram_with_ref_mp, args = (f, ref_output[f], dram[f], return_dict))
-            p.start()
-            jobs.append(p)
-        
-        for proc in range(len(jobs)):
-            jobs[proc].join()
-
-        for f in range(len(ref_output)):
-            if (return_dict[f] == False) :
-                return False
-
-    elif "Dense" in str(layer):
-        for f in range(len(ref_output)):
-            if dram[f] != ref_output[f]:
-                logger.error(f'Difference found at f = {f}')
-                logger.error(f'ReferenceData: {str(ref_output[f])}')
-                logger.error(f'Output Stream: {str(dram[f])}')
-                return False
-
-    return True
-
-def compare_dram_with_ref_mp(f, ref_output, dram, return_dict):
-    return_dict[f] = True
-    for x in range(len(ref_output)):
-        for y in range(len(ref_output[x])):
-            if dram[x][y] != ref_output[x][y]:
-                logger.error(f'Difference found at f = {f}, x = {x}, y= {y}')
-                logger.error(f'ReferenceData: {str(ref_output[x][y])}')
-                logger.error(f'Output Stream: {str(dram[x][y])}')
-                return_dict[f] = False
-                return
-                 
\ No newline at end of file
+    if ("Conv" not in str(layer)) and ("Dense" not in str(layer)):
+        return True
+
+    ref_output = np.asarray(ref_output, dtype=np.int64)
+    output = np.asarray(dram, dtype=np.int64)[tuple(slice(0, n) for n in ref_output.shape)]
+    mismatch = output != ref_output
+    mismatch_count = np.count_nonzero(mismatch)
+    if mismatch_count == 0:
+        return True
+
+    coordinates = np.argwhere(mismatch)
+    error = np.abs(output - ref_output)[mismatch]
+    logger.error(f'{mismatch_count} of {ref_output.size} results differ, max absolute error: {error.max()}')
+    for coordinate in coordinates[:max_reported]:
+        index = tuple(coordinate)
+        if "Dense" in str(layer):
+            logger.error(f'Difference found at f = {index[0]}')
+        else:
+            logger.error(f'Difference found at f = {index[0]}, x = {index[1]}, y= {index[2]}')
+        logger.error(f'ReferenceData: {str(ref_output[index])}')
+        logger.error(f'Output Stream: {str(output[index])}')
+
+    if "Dense" not in str(layer):
+        per_filter = np.count_nonzero(mismatch.reshape(len(ref_output), -1), axis=1)
+        logger.error(f'Mismatches per filter: { {int(f): int(per_filter[f]) for f in np.flatnonzero(per_filter)} }')
+    if (layer_params is not None) and (params is not None):
+        tiles = get_output_tiles(layer, layer_params, params, ref_output.shape)
+        per_tile = collections.Counter(zip(*(tile[mismatch].tolist() for tile in tiles)))
+        logger.error(f'Mismatches per tile (cl_x, cl_y, router): {dict(sorted(per_tile.items()))}')
+    return False
+
+def get_output_tiles(layer, layer_params, params, shape):
+    """ Return the cl_x, cl_y and psum router that compute each output.
+
+    For convolutions the outputs are distributed row by row over the PE
+    columns, clusters and cluster row groups like in the iact mapper, cl_y is
+    the first cluster row of the group. For Dense layers the neurons are
+    distributed over the clusters.
+    """
+    if "Dense" in str(layer):
+        position = np.arange(shape[0]) % (params.Clusters_X * params.Clusters_Y * layer_params.used_psum_per_PE)
+        cl_x = (position // layer_params.used_psum_per_PE) % params.Clusters_X
+        cl_y = position // (params.Clusters_X * layer_params.used_psum_per_PE)
+        return cl_x, cl_y, np.zeros_like(cl_x)
+
+    x = np.arange(shape[1])[:, None]
+    y = np.arange(shape[2])[None, :]
+    position = y * (layer_params.output_shape[2] + layer_params.add_up) + x
+    groups = max(1, math.floor(params.Clusters_Y / layer_params.used_Y_cluster))
+    router = position % params.PEs_X
+    cl_x = (position // params.PEs_X) % params.Clusters_X
+    cl_y = ((position // (params.PEs_X * params.Clusters_X)) % groups) * layer_params.used_Y_cluster
+    return tuple(np.broadcast_to(tile, shape) for tile in (cl_x, cl_y, router))
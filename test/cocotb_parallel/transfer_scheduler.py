@@ -0,0 +1,142 @@
+# This file is part of the OpenEye project.
+# All rights reserved. © Fachhochschule Dortmund - University of Applied Sciences and Arts.
+# SPDX-License-Identifier: SHL-2.1
+# For more details, see the LICENSE file in the root directory of this project.
+"""
+Scheduling of the transfers to the GLBs of the DUT.
+
+The iact and wght GLBs are double buffered: as soon as the DUT signalled
+ready, the PEs have taken their data, and the buffers can be loaded for the
+next layer repetition while the psum GLBs are drained. The TransferScheduler
+keeps the load into the free buffer of every port. calculate_layer starts
+these loads right after the ready signal, for the next repetition or, after
+the last repetition of a layer, the weights of the next computed layer. A
+repetition only loads the ports whose buffer was not loaded ahead.
+
+The status register and the bias preload are not overlapped. The status is
+only taken by the DUT after the drain (status_reg_enable_i) and the bias is
+written to the psum GLBs, which are drained at the same time. The iact of the
+next layer depends on the output of the current one.
+
+Every transfer is timed. The cycles in which a transfer runs while the DUT
+computes or drains are hidden, the others are exposed and add to the run time
+of the layer. report() logs both, per layer and in total.
+
+The prefetch of the next layer is configured with an environment variable:
+    PREFETCH_NEXT_LAYER: 1 loads the weights of the next computed layer
+        during the last drain of a layer, 0 disables it (default). The wght
+        router mode of the next layer is driven before the load, this is not
+        verified in a simulation yet.
+"""
+import os
+import logging
+import cocotb
+from cocotb.utils import get_sim_time, get_sim_steps
+
+logger = logging.getLogger("cocotb")
+
+
+def get_prefetch_next_layer():
+    """ Return True if the weights of the next layer are loaded during the last drain. """
+    try:
+        return int(os.getenv("PREFETCH_NEXT_LAYER", 0)) != 0
+    except ValueError:
+        logger.warning("PREFETCH_NEXT_LAYER is not a number. Setting to 0.")
+        return False
+
+
+class Transfer(object):
+    """ A timed transfer to the DUT.
+
+    Attributes:
+        name: The port of the transfer.
+        key: (layer_number, layer_repetition) of the data.
+        start, end: Simulation time in steps, end is None while it runs.
+        task: The running coroutine.
+    """
+    def __init__(self, name, key):
+        self.name = name
+        self.key = key
+        self.start = None
+        self.end = None
+        self.task = None
+
+
+class TransferScheduler(object):
+    """ Loads the double buffered GLBs ahead and counts the cycles that are hidden.
+
+    Attributes:
+        buffers: Maps a port to the Transfer into its free buffer.
+        transfers: The finished Transfers since the last report.
+        busy: (start, end) in steps of the compute and drain phases, the first
+            counted_busy of them were counted in the last report.
+        totals: Transfer, hidden and busy cycles of all reports.
+    """
+    def __init__(self, ptp):
+        self.clk_steps = get_sim_steps(ptp.clk_cycle, ptp.clk_cycle_unit)
+        self.buffers = {}
+        self.transfers = []
+        self.busy = []
+        self.counted_busy = 0
+        self.totals = {"transfer": 0, "hidden": 0, "busy": 0}
+
+    async def run(self, transfer, coroutine):
+        transfer.start = get_sim_time("step")
+        await coroutine
+        transfer.end = get_sim_time("step")
+        self.transfers.append(transfer)
+
+    def load(self, name, coroutine, key):
+        """ Start loading the free buffer of a port with the data of key. """
+        transfer = Transfer(name, key)
+        transfer.task = cocotb.start_soon(self.run(transfer, coroutine))
+        self.buffers[name] = transfer
+        return transfer
+
+    def is_loaded(self, name, key):
+        """ Return True if the free buffer of a port is loaded with the data of key. """
+        transfer = self.buffers.get(name)
+        return (transfer is not None) and (transfer.key == key)
+
+    async def wait(self, name):
+        """ Wait until the buffer of a port is loaded, it is used by the DUT afterwards. """
+        transfer = self.buffers.pop(name, None)
+        if transfer is not None:
+            await transfer.task
+
+    async def transfer(self, name, coroutine, key):
+        """ Run a transfer that is not overlapped and time it. """
+        await self.run(Transfer(name, key), coroutine)
+
+    async def busy_with(self, coroutine):
+        """ Run a compute or drain phase of the DUT, transfers during it are hidden. """
+        start = get_sim_time("step")
+        await coroutine
+        self.busy.append((start, get_sim_time("step")))
+
+    def get_hidden_steps(self, transfer):
+        return sum(max(0, min(transfer.end, end) - max(transfer.start, start)) for start, end in self.busy)
+
+    def report(self, label):
+        """ Log the transfer cycles since the last report and how many of them were hidden.
+
+        The transfers that are still running are counted in the next report.
+        """
+        transfer_cycles = sum(transfer.end - transfer.start for transfer in self.transfers) // self.clk_steps
+        hidden_cycles = sum(self.get_hidden_steps(transfer) for transfer in self.transfers) // self.clk_steps
+        busy_cycles = sum(end - start for start, end in self.busy[self.counted_busy:]) // self.clk_steps
+        for name, value in (("transfer", transfer_cycles), ("hidden", hidden_cycles), ("busy", busy_cycles)):
+            self.totals[name] = self.totals[name] + value
+        logger.info(label + ": " + str(hidden_cycles) + " of " + str(transfer_cycles) + " transfer cycles hidden, "
+                    + str(transfer_cycles - hidden_cycles) + " exposed, DUT busy for " + str(busy_cycles) + " cycles.")
+        # Keep the last busy phase, a prefetch that still runs may overlap with it
+        self.busy = self.busy[-1:]
+        self.counted_busy = len(self.busy)
+        self.transfers = []
+        return {"transfer": transfer_cycles, "hidden": hidden_cycles, "busy": busy_cycles}
+
+    def report_total(self):
+        """ Log the transfer cycles of all reports. """
+        logger.info("All layers: " + str(self.totals["hidden"]) + " of " + str(self.totals["transfer"]) + " transfer cycles hidden, "
+                    + str(self.totals["transfer"] - self.totals["hidden"]) + " exposed, DUT busy for " + str(self.totals["busy"]) + " cycles.")
+        return dict(self.totals)
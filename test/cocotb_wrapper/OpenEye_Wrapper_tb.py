@@ -23,6 +23,8 @@ import test_utils.layer_execution_state as les
 import test_utils.data_create as data_create
 import test_utils.tflite2model as tflite2model
 import test_utils.stream_dicts as str_dic
+import test_utils.stream_cache as sc
+import test_utils.dma_image as dma_image
 
 os.environ["CLOCK_LEN"] = "10"
 os.environ["CLOCK_UNIT"] = "ns"
@@ -140,6 +142,8 @@ async def single_layer_test(dut):
     dram.write_initial_data_to_dram(model)
 
     openeye_parameter = oep.create_vh_file(serial)
+    stream_cache = sc.StreamCache()
+    image_dir = dma_image.get_image_dir()
     time_currently = time.time()
     time_elapsed = time_currently - time_last_check
     time_last_check = time.time()
@@ -180,7 +184,19 @@ async def single_layer_test(dut):
             time_elapsed = time_currently - time_last_check
             time_last_check = time.time()
             logger.info("Start creating stream. " + str(time_elapsed))
-            stream = ptu.write_stream(openeye_parameter, layer_parameters, layer, dram_layer_content)
+            # Replay the DMA images of an earlier run if they belong to this layer
+            images = None
+            if (image_dir is not None):
+                image_key = "".join(stream_cache.part_keys(openeye_parameter, layer, dram_layer_content).values())
+                images = [dma_image.read_image(dma_image.get_image_path(image_dir, layer_number, layer_repetition), image_key)
+                          for layer_repetition in range(layer_parameters.needed_total_transmissions)]
+                if (None in images):
+                    images = None
+            if (images is None):
+                stream = ptu.write_stream(openeye_parameter, layer_parameters, layer, dram_layer_content, stream_cache)
+                if (image_dir is not None):
+                    images = [dma_image.read_image(path) for path in
+                              dma_image.export_images(image_dir, layer_number, stream, openeye_parameter.DMA_Bits, image_key)]
             
             time_currently = time.time()
             time_elapsed = time_currently - time_last_check
@@ -190,19 +206,25 @@ async def single_layer_test(dut):
             for layer_repetition in range(layer_parameters.needed_total_transmissions):
                 
                 logger.info("Send stream.")
-                await cocotb.start_soon(rtl_test_utils.send_stream(ptp, dut, stream[layer_repetition], openeye_parameter, layer_parameters))
+                if (images is not None):
+                    sent_stream = images[layer_repetition]
+                    await cocotb.start_soon(rtl_test_utils.replay_dma_image(ptp, dut, sent_stream))
+                else:
+                    sent_stream = stream[layer_repetition]
+                    await cocotb.start_soon(rtl_test_utils.send_stream(ptp, dut, sent_stream, openeye_parameter, layer_parameters, layer_repetition))
                 logger.info("Stream is sent.")
+                await cocotb.start_soon(rtl_test_utils.await_ready_signal(ptp, dut, layer_number, model, layer_repetition, layer_parameters, openeye_parameter, layer_es, dram, log_level, sent_stream))
                 if("Depthwise" in str(layer)):
-                    await cocotb.start_soon(rtl_test_utils.await_and_compare_stream_Dw(ptp, dut, layer_number, model, layer_repetition, layer_parameters, openeye_parameter, layer_es, dram, log_level))
+                    await cocotb.start_soon(rtl_test_utils.compare_stream_Dw(ptp, dut, layer_number, model, layer_repetition, layer_parameters, openeye_parameter, layer_es, dram, log_level, sent_stream))
                 elif("Conv" in str(layer)):
-                    await cocotb.start_soon(rtl_test_utils.await_and_compare_stream_Conv(ptp, dut, layer_number, model, layer_repetition, layer_parameters, openeye_parameter, layer_es, dram, log_level))
+                    await cocotb.start_soon(rtl_test_utils.compare_stream_Conv(ptp, dut, layer_number, model, layer_repetition, layer_parameters, openeye_parameter, layer_es, dram, log_level, sent_stream))
                 elif("Dense" in str(layer)):
-                    await cocotb.start_soon(rtl_test_utils.await_and_compare_stream_Dense(ptp, dut, layer_number, model, layer_repetition, layer_parameters, openeye_parameter, layer_es, dram, log_level))
+                    await cocotb.start_soon(rtl_test_utils.compare_stream_Dense(ptp, dut, layer_number, model, layer_repetition, layer_parameters, openeye_parameter, layer_es, dram, log_level, sent_stream))
                 if(logging.DEBUG >= log_level):
                     assert gtu.check_results('demo/layer_' + str(layer_number) + '_' + str(layer_repetition) + '/dma_stream_ref.txt',\
                                             'demo/layer_' + str(layer_number) + '_' + str(layer_repetition) + '/output.txt')
                     
-            assert ptu.compare_dram_with_ref(layer, calculated_results, dram.fmap[1 + layer_number])
+            assert ptu.compare_dram_with_ref(layer, calculated_results, dram.fmap[1 + layer_number], layer_parameters, openeye_parameter)
 
         slo.batchnorm_output(layer, 512, layer_number, dram)
 
@@ -4,6 +4,7 @@
 # For more details, see the LICENSE file in the root directory of this project.
 import math
 import numpy as np
+import test_utils.shared_array as shared_array
 
 class DRAMContents(object):
     """ The DRAM contents that is used to store intermediate data during tests.
@@ -12,6 +13,10 @@ class DRAMContents(object):
     during the simulation to store the intermediate data of the accelerator
     between different layers or between different repetitions of the same layer.
 
+    All feature maps, weights and biases are int64 SharedArrays. Worker
+    processes that get them as arguments attach to the same memory instead of
+    receiving a pickled copy.
+
     """
 
     def __init__(self, model) -> None:
@@ -20,46 +25,48 @@ class DRAMContents(object):
         dram_bias = []
         for i in range(len(model.layers)):
             if "Depthwise" in str(model.layers[i]):
-                dram_weights.append([[[0 for l in range(model.layers[i].kernel_size[1])]
-                                    for k in range(model.layers[i].kernel_size[0])]
-                                    for j in range(model.layers[i].input.shape[3])])
+                dram_weights.append(shared_array.zeros((model.layers[i].input.shape[3],
+                                    model.layers[i].kernel_size[0],
+                                    model.layers[i].kernel_size[1])))
             elif "Conv" in str(model.layers[i]):
-                dram_weights.append([[[[0 for m in range(model.layers[i].kernel_size[1])]
-                                    for l in range(model.layers[i].kernel_size[0])]
-                                    for k in range(model.layers[i].filters)]
-                                    for j in range(model.layers[i].input.shape[3])])
+                dram_weights.append(shared_array.zeros((model.layers[i].input.shape[3],
+                                    model.layers[i].filters,
+                                    model.layers[i].kernel_size[0],
+                                    model.layers[i].kernel_size[1])))
             elif "Dense" in str(model.layers[i]):
-                dram_weights.append([[0 for m in range(model.layers[i].input.shape[1])]
-                                    for l in range(model.layers[i].output.shape[1])])
-            elif "Flat" in str(model.layers[i]):
-                dram_weights.append([0])
+                dram_weights.append(shared_array.zeros((model.layers[i].output.shape[1],
+                                    model.layers[i].input.shape[1])))
+            elif ("Flat" in str(model.layers[i])) or ("Pooling" in str(model.layers[i])):
+                dram_weights.append(shared_array.zeros((1,)))
 
             if "Depthwise" in str(model.layers[i]):
-                dram_bias.append([0 for k in range(model.layers[i].kernel_size[0])])
+                dram_bias.append(shared_array.zeros((model.layers[i].kernel_size[0],)))
             elif "Conv" in str(model.layers[i]):
-                dram_bias.append([0 for m in range(model.layers[i].filters)])
+                dram_bias.append(shared_array.zeros((model.layers[i].filters,)))
             elif "Dense" in str(model.layers[i]):
-                dram_bias.append([[0 for m in range(model.layers[i].input.shape[1])]
-                                    for l in range(model.layers[i].output.shape[1])])
+                dram_bias.append(shared_array.zeros((model.layers[i].output.shape[1],
+                                    model.layers[i].input.shape[1])))
+            elif ("Flat" in str(model.layers[i])) or ("Pooling" in str(model.layers[i])):
+                dram_bias.append(shared_array.zeros((1,)))
 
             if "Conv" in str(model.layers[i]):
-                dram_fmap.append([[[0 for l in range(model.layers[i].input.shape[2])]
-                                for k in range(model.layers[i].input.shape[1])]
-                                for j in range(model.layers[i].input.shape[3])])
+                dram_fmap.append(shared_array.zeros((model.layers[i].input.shape[3],
+                                model.layers[i].input.shape[1],
+                                model.layers[i].input.shape[2])))
             elif "Dense" in str(model.layers[i]):
-                dram_fmap.append([0 for j in range(model.layers[i].input.shape[1])])
-            elif "Flat" in str(model.layers[i]):
-                dram_fmap.append([[[0 for l in range(model.layers[i].input.shape[2])]
-                                for k in range(model.layers[i].input.shape[1])]
-                                for j in range(model.layers[i].input.shape[3])])
+                dram_fmap.append(shared_array.zeros((model.layers[i].input.shape[1],)))
+            elif ("Flat" in str(model.layers[i])) or ("Pooling" in str(model.layers[i])):
+                dram_fmap.append(shared_array.zeros((model.layers[i].input.shape[3],
+                                model.layers[i].input.shape[1],
+                                model.layers[i].input.shape[2])))
 
         for i in [len(model.layers)-1]:
-            if "Conv" in str(model.layers[i]):
-                dram_fmap.append([[[0 for l in range(model.layers[i].output.shape[2])]
-                                    for k in range(model.layers[i].output.shape[1])]
-                                    for j in range(model.layers[i].output.shape[3])])
-            elif "Dense" in str(model.layers[i]):
-                dram_fmap.append([0 for l in range(model.layers[i].output.shape[1])])
+            if ("Conv" in str(model.layers[i])) or ("Pooling" in str(model.layers[i])):
+                dram_fmap.append(shared_array.zeros((model.layers[i].output.shape[3],
+                                    model.layers[i].output.shape[1],
+                                    model.layers[i].output.shape[2])))
+            elif ("Dense" in str(model.layers[i])) or ("Flat" in str(model.layers[i])):
+                dram_fmap.append(shared_array.zeros((model.layers[i].output.shape[1],)))
         self.fmap = dram_fmap
         self.weights = dram_weights
         self.bias = dram_bias
@@ -0,0 +1,72 @@
+# This file is part of the OpenEye project.
+# All rights reserved. © Fachhochschule Dortmund - University of Applied Sciences and Arts.
+# SPDX-License-Identifier: SHL-2.1
+# For more details, see the LICENSE file in the root directory of this project.
+"""
+Memory-mappable binary files with a JSON header.
+
+The stream cache and the DMA images share the format
+
+    magic (8 byte), start of the data (uint64 little endian),
+    JSON header, data (64 byte aligned)
+
+The header always holds the version of the format of its user. The data is
+written in blocks at offsets relative to its start, so the blocks can be
+mapped with np.memmap. Files are written atomically: into a temporary file
+in the target directory that replaces the target when it is complete.
+"""
+import os
+import json
+import struct
+import tempfile
+
+ALIGNMENT = 64
+
+
+def get_aligned(size):
+    """ Return size rounded up to the next multiple of ALIGNMENT. """
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+def write_container(path, magic, version, header, blocks):
+    """ Write a file atomically to path and return path.
+
+    Args:
+        magic: The 8 byte magic of the format.
+        version: The version of the format, stored in the header.
+        header: JSON serializable dict.
+        blocks: (offset, data) pairs, the offset relative to the start of the data.
+    """
+    header = json.dumps(dict(header, version = version)).encode()
+    start = get_aligned(len(magic) + 8 + len(header))
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(magic + struct.pack("<Q", start))
+            f.write(header.ljust(start - len(magic) - 8, b" "))
+            for offset, data in blocks:
+                f.seek(start + offset)
+                f.write(data)
+        os.replace(tmp_path, path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return path
+
+def read_header(path, magic, version):
+    """ Return the header of a file and the start of its data.
+
+    Raises ValueError if the file has another magic or version.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError(path + " is not a " + magic.decode() + " file")
+        start = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(start - len(magic) - 8))
+    if header.get("version") != version:
+        raise ValueError(path + " has the version " + str(header.get("version")))
+    return header, start
@@ -0,0 +1,142 @@
+# This file is part of the OpenEye project.
+# All rights reserved. © Fachhochschule Dortmund - University of Applied Sciences and Arts.
+# SPDX-License-Identifier: SHL-2.1
+# For more details, see the LICENSE file in the root directory of this project.
+"""
+Vectorized packing and unpacking of bit fields.
+
+The fields of a word lie along the last axis of an array, the first field is
+the least significant one. Negative values are stored as two's complement
+with the width of their field, bits that do not fit into the field are cut
+off like on the bus. Words of up to 64 bit are uint64 arrays, wider words
+are object arrays of Python ints.
+"""
+import numpy as np
+
+
+def mask(bits):
+    return (1 << bits) - 1
+
+def to_unsigned(values, bits):
+    """ Return values as unsigned fields of the given width. """
+    values = np.asarray(values)
+    if (values.dtype == object) or (bits > 62):
+        return np.asarray(np.bitwise_and(values.astype(object), mask(bits)))
+    return np.asarray(np.bitwise_and(values.astype(np.int64), mask(bits)))
+
+def to_signed(values, bits):
+    """ Return the signed value of fields with the given width. """
+    values = to_unsigned(values, bits)
+    return values - ((values >> (bits - 1)) & 1) * (1 << bits)
+
+def get_widths(bits, count):
+    if np.ndim(bits) == 0:
+        return [int(bits)] * count
+    widths = [int(width) for width in bits]
+    if len(widths) != count:
+        raise ValueError(str(count) + " fields, but " + str(len(widths)) + " widths given.")
+    return widths
+
+def pack(fields, bits):
+    """ Pack the fields along the last axis into words.
+
+    Args:
+        fields: Array of the fields, the first field is the least significant one.
+        bits: Width of all fields or a sequence with the width of every field.
+
+    Returns:
+        The words as uint64 array, or as object array if they are wider than 64 bit.
+    """
+    fields = np.asarray(fields)
+    widths = get_widths(bits, fields.shape[-1])
+    wide = sum(widths) > 64
+    words = np.zeros(fields.shape[:-1], dtype = object if wide else np.uint64)
+    offset = 0
+    for field, width in enumerate(widths):
+        value = to_unsigned(fields[..., field], width)
+        if wide:
+            words = words + (value.astype(object) << offset)
+        else:
+            words = words | (value.astype(np.uint64) << np.uint64(offset))
+        offset = offset + width
+    return words
+
+def pack_limbs(fields, bits):
+    """ Pack the fields along the last axis into words of 64 bit limbs.
+
+    Like pack, but wide words are a uint64 array with the shape
+    (..., limbs), least significant limb first, instead of Python ints.
+    Every field must fit into 64 bit.
+    """
+    fields = np.asarray(fields)
+    widths = get_widths(bits, fields.shape[-1])
+    limbs = np.zeros(fields.shape[:-1] + (max(1, -(-sum(widths) // 64)),), dtype = np.uint64)
+    offset = 0
+    for field, width in enumerate(widths):
+        value = to_unsigned(fields[..., field], width).astype(np.uint64)
+        limb, shift = divmod(offset, 64)
+        limbs[..., limb] |= value << np.uint64(shift)
+        if shift + width > 64:
+            limbs[..., limb + 1] |= value >> np.uint64(64 - shift)
+        offset = offset + width
+    return limbs
+
+def limbs_to_ints(limbs):
+    """ Return the words of an array of 64 bit limbs as list of Python ints. """
+    limbs = np.ascontiguousarray(np.asarray(limbs).astype("<u8"))
+    size = limbs.shape[-1] * 8
+    data = limbs.tobytes()
+    return [int.from_bytes(data[n:n + size], "little") for n in range(0, len(data), size)]
+
+def pack_int(fields, bits):
+    """ Pack a 1-D sequence of fields into one Python int. """
+    return int(pack(fields, bits))
+
+def pack_record(values, layout):
+    """ Pack named fields into one Python int.
+
+    layout maps the names of the fields to their widths, least significant
+    field first. Fields that are missing in values are 0.
+    """
+    return pack_int([values.get(name, 0) for name in layout], list(layout.values()))
+
+def unpack(words, bits, count = None, signed = False):
+    """ Split words into fields, the inverse of pack.
+
+    Args:
+        words: Array of words, uint64 or object.
+        bits: Width of all fields or a sequence with the width of every field.
+        count: Number of fields if bits is a single width.
+        signed: Read the fields as two's complement.
+
+    Returns:
+        The fields along a new last axis.
+    """
+    words = np.asarray(words)
+    widths = get_widths(bits, count if np.ndim(bits) == 0 else len(bits))
+    wide = (words.dtype == object) or (sum(widths) > 64)
+    fields = []
+    offset = 0
+    for width in widths:
+        if wide:
+            value = np.asarray((words.astype(object) >> offset) & mask(width))
+        else:
+            value = np.asarray((words.astype(np.uint64) >> np.uint64(offset)) & np.uint64(mask(width)))
+        value = value.astype(np.int64) if width <= 62 else value.astype(object)
+        if signed:
+            value = to_signed(value, width)
+        fields.append(value)
+        offset = offset + width
+    return np.stack(fields, axis = -1)
+
+def group(values, words, lanes):
+    """ Group the last axis of values into words of lanes fields.
+
+    Values behind the end are 0, values that do not fit are dropped.
+    Returns an array with the shape (..., words, lanes).
+    """
+    values = np.asarray(values)
+    grouped = np.zeros(values.shape[:-1] + (words * lanes,), dtype = values.dtype)
+    count = min(values.shape[-1], words * lanes)
+    grouped[..., :count] = values[..., :count]
+    return grouped.reshape(values.shape[:-1] + (words, lanes))
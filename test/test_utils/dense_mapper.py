@@ -35,48 +35,30 @@ class DenseMapper(LayerMapper):
         else :
             layer_params.skipPsum = 1
         
-        counter = 0
-        computing_pes = 0
-
-        for x in range(params.Clusters_X):
-            for y in range(params.Clusters_Y):
-                for pe_y in range(params.PEs_Y):
-                    for pe_x in range(params.PEs_X):
-                        if(layer_params.computing_mx[x][y][pe_y][pe_x]== 1):
-                            computing_pes = computing_pes + 2**(counter)
-                        counter = counter + 1
-        computing_pes = format(computing_pes, "0192b")
+        computing_pes = self.write_computing_pes(params, layer_params)
         if (params.SERIAL):
-            dma_line = 0
-            dma_storage = []
-            dma_line = params.data_mode + ((layer_params.realfactor) << 1) 
-            dma_line = dma_line + (params.autofunction << 6)
-            dma_line = dma_line + (params.poolingmode << 7)
-            dma_line = dma_line + ((needed_refreshes << 8))
-            dma_line = dma_line + (layer_params.used_X_cluster << 16)
-            dma_line = dma_line + (layer_params.used_Y_cluster << 18)
-            dma_line = dma_line + (layer_params.needed_Iact_writes << 22)
-            dma_line = dma_line + (layer_params.used_psum_per_PE << 26)
-            dma_line = dma_line + (layer_params.used_iact_addr_per_PE << 32)
-            dma_line = dma_line + (layer_params.used_wght_addr_per_PE << 36)
-            dma_line = dma_line + (layer_params.used_iact_per_PE << 41)
-            dma_storage.append(dma_line)
-            dma_line = 0
-            dma_line = dma_line + (layer_params.iact_addr_len)
-            dma_line = dma_line + (layer_params.iact_data_len << 2)
-            dma_line = dma_line + (layer_params.strideX << 6)
-            dma_line = dma_line + (layer_params.strideY << 10)
-            if ((layer_repetition % layer_params.needed_wght_transmissions) == 0):
-                dma_line = dma_line + (0 << 14)
-            else:
-                dma_line = dma_line + (1 << 14)
-            dma_line = dma_line + (layer_params.skipWght << 15)
-            dma_line = dma_line + (layer_params.skipPsum << 16)
-            dma_storage.append(dma_line)
-
-            for x in reversed(range(4)):
-                dma_line = int(computing_pes[x*48:(x+1)*48],2)
-                dma_storage.append(dma_line)
+            status = {
+                "data_mode": params.data_mode,
+                "realfactor": layer_params.realfactor,
+                "autofunction": params.autofunction,
+                "poolingmode": params.poolingmode,
+                "needed_refreshes": needed_refreshes,
+                "used_X_cluster": layer_params.used_X_cluster,
+                "used_Y_cluster": layer_params.used_Y_cluster,
+                "needed_Iact_writes": layer_params.needed_Iact_writes,
+                "used_psum_per_PE": layer_params.used_psum_per_PE,
+                "used_iact_addr_per_PE": layer_params.used_iact_addr_per_PE,
+                "used_wght_addr_per_PE": layer_params.used_wght_addr_per_PE,
+                "used_iact_per_PE": layer_params.used_iact_per_PE,
+                "iact_addr_len": layer_params.iact_addr_len,
+                "iact_data_len": layer_params.iact_data_len,
+                "strideX": layer_params.strideX,
+                "strideY": layer_params.strideY,
+                "skipIact": int((layer_repetition % layer_params.needed_wght_transmissions) != 0),
+                "skipWght": layer_params.skipWght,
+                "skipPsum": layer_params.skipPsum
+            }
+            dma_storage = self.write_status_dma(status, computing_pes)
             storage = dma_storage
         else:
             storage[strdic.status_dict["data_mode"]] = params.data_mode
@@ -99,7 +81,7 @@ class DenseMapper(LayerMapper):
             storage[strdic.status_dict["skipIact"]] = layer_params.skipIact
             storage[strdic.status_dict["skipWght"]] = layer_params.skipWght
             storage[strdic.status_dict["skipPsum"]] = layer_params.skipPsum
-            storage[strdic.status_dict["usePEs"]] = int(computing_pes,2)
+            storage[strdic.status_dict["usePEs"]] = computing_pes
 
             storage[strdic.status_dict["router_iact"]] = self.write_router_iact(params, layer_params)
             storage[strdic.status_dict["router_wght"]] = self.write_router_wght(params)
@@ -0,0 +1,123 @@
+# This file is part of the OpenEye project.
+# All rights reserved. © Fachhochschule Dortmund - University of Applied Sciences and Arts.
+# SPDX-License-Identifier: SHL-2.1
+# For more details, see the LICENSE file in the root directory of this project.
+"""
+Binary images of the serial DMA stream of a layer repetition.
+
+An image holds the complete sequence of DMA words that is sent to
+data_dma_i for one layer repetition, section by section in the order of
+send_stream (status, iact, wght, psum). It can be replayed into the DUT
+without the mappers, shared between runs and used for the bring-up of an
+FPGA. An image is a binary_container file whose data are the words.
+Every word takes ceil(word_bits / 8) bytes, little endian. The header holds
+the width of the words, the offset and the number of words of every section
+and an optional key, e.g. the stream cache keys of the layer, to recognize
+stale images.
+
+The images of the testbench are configured with environment variables:
+    DMA_IMAGE_DIR: Directory of the images. If it is not set, no images are
+        written and the streams are sent from memory.
+"""
+import os
+import numpy as np
+from test_utils.binary_container import write_container, read_header
+
+# Increase when the format changes
+IMAGE_VERSION = 1
+
+MAGIC = b"OEDMAIMG"
+
+sections = ("status", "iact", "wght", "psum")
+
+
+def get_image_dir():
+    """ Return the directory of the DMA images or None. """
+    return os.getenv("DMA_IMAGE_DIR") or None
+
+def get_image_path(directory, layer_number, layer_repetition):
+    return os.path.join(directory, "layer_" + str(layer_number) + "_" + str(layer_repetition) + ".dma")
+
+def encode(words, word_bytes):
+    """ Return the words as little endian bytes with word_bytes per word. """
+    words = np.asarray(words)
+    if word_bytes > 8:
+        return b"".join(int(word).to_bytes(word_bytes, "little") for word in words.reshape(-1))
+    data = np.ascontiguousarray(words.astype("<u8").reshape(-1, 1)).view(np.uint8)
+    return data[:, :word_bytes].tobytes()
+
+def decode(data, word_bytes):
+    """ Return the words of little endian bytes, uint64 or object if they are wider. """
+    data = np.asarray(data, dtype = np.uint8).reshape(-1, word_bytes)
+    if word_bytes > 8:
+        return np.array([int.from_bytes(word.tobytes(), "little") for word in data], dtype = object)
+    padded = np.zeros((len(data), 8), dtype = np.uint8)
+    padded[:, :word_bytes] = data
+    return padded.view("<u8").reshape(-1)
+
+
+class DMAImage(object):
+    """ A DMA image mapped from its file.
+
+    Attributes:
+        path: The file of the image.
+        word_bits: Width of the DMA words.
+        word_bytes: Bytes per word in the file.
+        key: The key the image was written with or None.
+        sections: Maps the name of a section to its first word and its number of words.
+    """
+    def __init__(self, path):
+        header, start = read_header(path, MAGIC, IMAGE_VERSION)
+        self.path = path
+        self.word_bits = header["word_bits"]
+        self.word_bytes = header["word_bytes"]
+        self.key = header.get("key")
+        self.sections = {name: tuple(section) for name, section in header["sections"].items()}
+        total = sum(count for _, count in self.sections.values())
+        self.mapping = np.memmap(path, dtype = np.uint8, mode = "r", offset = start, shape = (total * self.word_bytes,)) \
+            if total else np.zeros(0, dtype = np.uint8)
+
+    def __len__(self):
+        return len(self.mapping) // self.word_bytes
+
+    def words(self, section = None, start = 0, stop = None):
+        """ Return the words start:stop of a section, or of the whole image if section is None. """
+        first, count = (0, len(self)) if section is None else self.sections[section]
+        stop = count if stop is None else min(stop, count)
+        return decode(self.mapping[(first + start) * self.word_bytes:(first + stop) * self.word_bytes], self.word_bytes)
+
+    def chunks(self, chunk_words = 4096):
+        """ Yield the words of the image as Python ints, decoded chunk by chunk. """
+        for start in range(0, len(self), chunk_words):
+            yield from self.words(start = start, stop = start + chunk_words).tolist()
+
+
+def write_image(path, stream, word_bits, key = None):
+    """ Write the DMA words of a serial Stream atomically to path. """
+    word_bytes = -(-word_bits // 8)
+    header_sections = {}
+    blocks = []
+    position = 0
+    for name in sections:
+        port = getattr(stream, name)
+        words = [] if port is None else port.words()
+        header_sections[name] = [position, len(words)]
+        blocks.append((position * word_bytes, encode(np.array(words, dtype = object if word_bytes > 8 else np.uint64), word_bytes)))
+        position = position + len(words)
+    header = {"word_bits": word_bits, "word_bytes": word_bytes, "key": key, "sections": header_sections}
+    return write_container(path, MAGIC, IMAGE_VERSION, header, blocks)
+
+def read_image(path, key = None):
+    """ Return the DMAImage of path, or None if it is missing or was written with another key. """
+    try:
+        image = DMAImage(path)
+    except (FileNotFoundError, ValueError):
+        return None
+    if (key is not None) and (image.key != key):
+        return None
+    return image
+
+def export_images(directory, layer_number, streams, word_bits, key = None):
+    """ Write the images of all repetitions of a layer and return their paths. """
+    return [write_image(get_image_path(directory, layer_number, layer_repetition), stream, word_bits, key)
+            for layer_repetition, stream in enumerate(streams)]
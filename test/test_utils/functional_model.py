@@ -0,0 +1,96 @@
+# This file is part of the OpenEye project.
+# All rights reserved. © Fachhochschule Dortmund - University of Applied Sciences and Arts.
+# SPDX-License-Identifier: SHL-2.1
+# For more details, see the LICENSE file in the root directory of this project.
+"""
+Bit-accurate functional model of the OpenEye datapath.
+
+The model replaces the RTL simulation of a layer by NumPy fixed-point
+arithmetic. Input activations and weights are transported with
+IACT_Bitwidth and WGHT_Bitwidth, the partial sums are preloaded with the psum
+stream (0) and accumulated in PSUM_Bitwidth with wraparound. The result is
+read back as two's complement like in compare_stream_Conv. The output feature
+map is written to DRAMContents.fmap in the same layout as the RTL path.
+"""
+import sys
+import os
+directory = (os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)))
+sys.path.extend([directory, os.path.dirname(os.path.realpath(__file__))])
+import logging
+import numpy as np
+import test_utils.reference_model as rm
+import test_utils.simple_layer_operations as slo
+
+logger = logging.getLogger("cocotb")
+
+
+def wrap_signed(values, bits):
+    """ Wrap values to signed integers of the given bitwidth. """
+    values = np.asarray(values, dtype=np.int64)
+    return ((values + (1 << (bits - 1))) & ((1 << bits) - 1)) - (1 << (bits - 1))
+
+def transport(values, bits, name):
+    """ Return the values as they arrive in the SPads after the transport. """
+    wrapped = wrap_signed(values, bits)
+    overflows = np.count_nonzero(wrapped != np.asarray(values, dtype=np.int64))
+    if overflows:
+        logger.warning(str(overflows) + " " + name + " values exceed " + str(bits) + " bit and are wrapped.")
+    return wrapped
+
+def compute_layer(params, layer, layer_number, dram):
+    """ Compute a Conv2D, DepthwiseConv2D or Dense layer like the accelerator.
+
+    Returns:
+        The output of the accelerator as int64 ndarray with the shape (F, X, Y)
+        or (O,) for Dense layers.
+    """
+    fmap = transport(dram.fmap[layer_number], params.IACT_Bitwidth, "iact")
+    weights = transport(dram.weights[layer_number], params.WGHT_Bitwidth, "wght")
+
+    if "Dense" in str(layer):
+        psum = rm.dense(fmap, weights, np.zeros(layer.output.shape[1], dtype=np.int64))
+    else:
+        strides = tuple(layer.strides)
+        output_size = (layer.output.shape[2], layer.output.shape[1])
+        if "Depthwise" in str(layer):
+            psum = rm.depthwise_conv2d(fmap, weights, np.zeros(layer.output.shape[3], dtype=np.int64), layer.kernel_size, strides, output_size)
+        else:
+            psum = rm.conv2d(fmap, weights, np.zeros(layer.output.shape[3], dtype=np.int64), layer.kernel_size, strides, output_size)
+    return wrap_signed(psum, params.PSUM_Bitwidth)
+
+def write_output_to_dram(layer, layer_number, dram, output):
+    """ Write the output to the DRAM in place, in the layout of the RTL path. """
+    dram.fmap[layer_number + 1][tuple(slice(0, n) for n in output.shape)] = output
+
+def run_model(params, model, dram, calculated_results = None, divide_value = 512):
+    """ Run a whole model through the functional model.
+
+    Args:
+        params: The OpenEye parameters.
+        model: The model.
+        dram: The DRAM contents with the initial data.
+        calculated_results: Optional callable (layer, layer_number) that returns
+            the reference results. If given, each output is compared to them.
+        divide_value: The divisor of batchnorm_output.
+
+    Returns:
+        True if all compared layers match the reference.
+    """
+    passed = True
+    for layer_number, layer in enumerate(model.layers):
+        if("Pooling" in str(layer)):
+            slo.pool(dram, layer, layer_number)
+        elif("Flat" in str(layer)):
+            slo.flat(dram, layer, layer_number)
+        else:
+            output = compute_layer(params, layer, layer_number, dram)
+            write_output_to_dram(layer, layer_number, dram, output)
+            if calculated_results is not None:
+                reference = np.asarray(calculated_results(layer, layer_number))
+                mismatches = np.count_nonzero(reference != output)
+                if mismatches:
+                    logger.error("Layer " + str(layer_number) + ": " + str(mismatches) + " outputs differ from the reference.")
+                    passed = False
+            logger.info("Layer " + str(layer_number) + " computed by the functional model.")
+        slo.batchnorm_output(layer, divide_value, layer_number, dram)
+    return passed
@@ -22,6 +22,8 @@ def delete_files_in_directory(directory_path):
      logger.debug("Error occurred while deleting files and subdirectories.")
 
 def to_twos_complement(value, bits):
+    # DRAM values are numpy integers, shifting them must not overflow
+    value = int(value)
     if value < 0:
         value = (1 << bits) + value
     return value
@@ -31,6 +33,15 @@ def to_twos_complement_string(value, bits):
     binary_string = format(value, '0' + str(bits) + 'b')
     return binary_string
 
+def get_used_transmissions(needed, transmissions):
+    """ Return the number of transmissions that are sent for a SPad.
+
+    All transmissions are sent if needed is not between 1 and transmissions.
+    """
+    if (needed < 1) or (needed > transmissions):
+        return transmissions
+    return needed
+
 def open_ref_txts(params, layer_params, layer, layer_number, dram):
     file_dma_ref = [0 for layer_repetition in range(layer_params.needed_total_transmissions)]
     for layer_repetition in range(layer_params.needed_total_transmissions):
@@ -8,8 +8,11 @@ directory = (os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__fil
 sys.path.extend([directory, os.path.dirname(os.path.realpath(__file__))])
 import math
 import logging
+import numpy as np
 import generic_test_utils as gtu
+import bit_fields
 import stream_dicts as strdic
+from test_utils.stream import LaneInterner
 
 logger = logging.getLogger("cocotb")
 
@@ -19,7 +22,8 @@ class IactStreamMapper(object):
         self.params = params
         self.layer_params = layer_params
         self.layer_repetition = layer_repetition
-        self.dram_fmap = dram_layer_content
+        self.dram_fmap = dram_layer_content if dram_layer_content is None else np.asarray(dram_layer_content)
+        self.interner = LaneInterner()
         if (params.SERIAL):
             self.storage = [[] for _ in range(len(strdic.stream_serial_dict))]
         else:
@@ -35,57 +39,79 @@ class IactStreamMapper(object):
         return iact_stream
     
     def write_iact_data_glb(self, cl_x, cl_y, router):
-        storage = []
-        for cycle in range(self.layer_params.needed_refreshes_mx[self.layer_repetition][1],self.layer_params.needed_refreshes_mx[self.layer_repetition][2]):
-            for iact_cycle in range(self.layer_params.needed_Iact_writes):
-                if ((cl_y - cycle) % self.layer_params.used_Y_cluster == 0) :
-                    data_spad = self.write_iact_data_storage(cl_x, cl_y, router, cycle, iact_cycle)
-                    addr_spad = self.write_iact_addr_storage(cl_x, cl_y, router, cycle, iact_cycle)
-                    storage.append([addr_spad, data_spad])
-
-        return storage
+        """ Return the address and the data SPads of a router as [addr, data].
+
+        addr has the shape (SPads, Iacts_Addr_per_PE) and data the shape
+        (SPads, Iacts_per_PE, 2), the SPads are ordered by cycle and iact_cycle.
+        """
+        cycles = self.get_cycles(cl_y)
+        data_spads = self.write_iact_data_storage(cl_x, cl_y, router,
+                                                  np.array(cycles, dtype=np.int64)[:, None],
+                                                  np.arange(self.layer_params.needed_Iact_writes)[None, :])
+        data_spads = data_spads.reshape((-1,) + data_spads.shape[-2:])
+        # The addresses do not depend on the cycle
+        addr_spad = self.write_iact_addr_storage(cl_x, cl_y, router, cycles[0] if cycles else 0, 0)
+        addr_spads = np.tile(np.array(addr_spad, dtype=np.int64), (len(data_spads), 1))
+        return [addr_spads, data_spads]
+
+    def get_cycles(self, cl_y):
+        """ Return the cycles in which the cluster row cl_y gets iacts. """
+        return [cycle for cycle in range(self.layer_params.needed_refreshes_mx[self.layer_repetition][1],self.layer_params.needed_refreshes_mx[self.layer_repetition][2])
+                if ((cl_y - cycle) % self.layer_params.used_Y_cluster == 0)]
 
     def write_iact_data_storage(self, cl_x, cl_y, router, cycle, iact_cycle):
+        """ Return the data SPads of a router for all combinations of cycle and iact_cycle.
 
+        cycle and iact_cycle are broadcast against each other. The result is an
+        ndarray with the shape (*broadcast shape, Iacts_per_PE, 2) that holds
+        the iact and the overhead counter of every SPad word. Iacts outside of
+        the feature map (padding) are 1.
+        """
         layer_params = self.layer_params
         params = self.params
-        layer_repetition = self.layer_repetition
-        dram_fmap = self.dram_fmap
-
-        overhead_counter = 0
-        spad_storage = [[0 for _ in range(2)] for _ in range(params.Iacts_per_PE)]
-        for words_in_storage in range(math.ceil(params.Iacts_per_PE)):
-            if(words_in_storage < layer_params.used_iact_per_PE):
-                iact_temp_pos_x = \
-                int((math.floor(((cl_x * params.PEs_X) + \
-                (math.floor(cl_y / layer_params.used_Y_cluster) * params.PEs_X * params.Clusters_X) + \
-                cycle * params.PEs_X * math.floor(params.Clusters/self.layer_params.used_Y_cluster)) * layer_params.strideX) % \
-                ((layer_params.output_shape[2]+layer_params.add_up)*layer_params.strideX)) + \
-                router + iact_cycle * params.Iact_Routers) - \
-                (math.ceil((layer_params.kernel_size[1]-1)/2))                             #Zero Padding
-                
-                iact_temp_pos_y = \
-                int((words_in_storage % layer_params.kernel_size[1]) + \
-                (layer_params.strideY * \
-                math.floor((((math.floor(cl_y / layer_params.used_Y_cluster) * params.PEs_X * params.Clusters_X) + \
-                cycle * params.PEs_X * math.floor(params.Clusters/self.layer_params.used_Y_cluster)) * layer_params.strideX)/((layer_params.output_shape[2]+layer_params.add_up)*layer_params.strideX)))) - \
-                (math.ceil((layer_params.kernel_size[1]-1)/2))                             #Zero Padding
-
-                channel = math.floor(words_in_storage/layer_params.kernel_size[0]) + ((layer_repetition % layer_params.iact_transmissions_pe) * math.ceil(layer_params.input_shape[3]/layer_params.iact_transmissions_pe)) #HIer was aendern
-                if(((math.floor(cycle/ self.layer_params.used_Y_cluster) * params.Clusters_Y *  params.Clusters_X * params.PEs_X) + \
-                    ((math.floor(cl_y/ self.layer_params.used_Y_cluster) *  params.Clusters_X * params.PEs_X)) + (cl_x * params.PEs_X)) < \
-                   (layer_params.output_shape[1] * (layer_params.output_shape[2]+layer_params.add_up))):
-                    if(((iact_temp_pos_x >= 0) & (iact_temp_pos_x < (layer_params.output_shape[1] * layer_params.strideX))) & \
-                    ((iact_temp_pos_y) >= 0) & (iact_temp_pos_y < (layer_params.output_shape[2] * layer_params.strideY))):
-                        spad_storage[words_in_storage][0] = dram_fmap[channel][iact_temp_pos_x][iact_temp_pos_y]
-
-                    else:
-                        spad_storage[words_in_storage][0] = 1
-                    spad_storage[words_in_storage][1] = overhead_counter
-                    overhead_counter = overhead_counter + 1
 
+        cycle = np.asarray(cycle)[..., None]
+        iact_cycle = np.asarray(iact_cycle)[..., None]
+        words = np.arange(min(layer_params.used_iact_per_PE, params.Iacts_per_PE))
+        shape = np.broadcast_shapes(cycle.shape, iact_cycle.shape, words.shape)
+        iact_pos_x, iact_pos_y, channel, active = [np.broadcast_to(a, shape) for a in
+                                                   self.get_iact_positions(cl_x, cl_y, router, cycle, iact_cycle, words)]
+
+        inside = active & \
+            (iact_pos_x >= 0) & (iact_pos_x < (layer_params.output_shape[1] * layer_params.strideX)) & \
+            (iact_pos_y >= 0) & (iact_pos_y < (layer_params.output_shape[2] * layer_params.strideY))
+        values = np.ones(shape, dtype=np.int64)
+        values[inside] = self.dram_fmap[channel[inside], iact_pos_x[inside], iact_pos_y[inside]]
+
+        spad_storage = np.zeros(shape[:-1] + (params.Iacts_per_PE, 2), dtype=np.int64)
+        spad_storage[..., :words.size, 0] = np.where(active, values, 0)
+        spad_storage[..., :words.size, 1] = np.where(active, words, 0)
         return spad_storage
-        
+
+    def get_iact_positions(self, cl_x, cl_y, router, cycle, iact_cycle, words):
+        """ Return iact_pos_x, iact_pos_y, channel and the mask of active PEs.
+
+        The arguments are broadcast against each other.
+        """
+        layer_params = self.layer_params
+        params = self.params
+
+        padding = math.ceil((layer_params.kernel_size[1]-1)/2)             #Zero Padding
+        line_len = (layer_params.output_shape[2]+layer_params.add_up)*layer_params.strideX
+        row_offset = (cl_y // layer_params.used_Y_cluster) * params.PEs_X * params.Clusters_X + \
+            cycle * params.PEs_X * (params.Clusters // layer_params.used_Y_cluster)
+
+        iact_pos_x = (((cl_x * params.PEs_X) + row_offset) * layer_params.strideX) % line_len + \
+            router + iact_cycle * params.Iact_Routers - padding
+        iact_pos_y = (words % layer_params.kernel_size[1]) + \
+            layer_params.strideY * ((row_offset * layer_params.strideX) // line_len) - padding
+        channel = words // layer_params.kernel_size[0] + \
+            ((self.layer_repetition % layer_params.iact_transmissions_pe) * math.ceil(layer_params.input_shape[3]/layer_params.iact_transmissions_pe))
+        active = (((cycle // layer_params.used_Y_cluster) * params.Clusters_Y * params.Clusters_X * params.PEs_X) + \
+                  ((cl_y // layer_params.used_Y_cluster) * params.Clusters_X * params.PEs_X) + (cl_x * params.PEs_X)) < \
+                 (layer_params.output_shape[1] * (layer_params.output_shape[2]+layer_params.add_up))
+        return iact_pos_x, iact_pos_y, channel, active
+
     def write_iact_addr_storage(self, cl_x, cl_y, router, cycle, iact_cycle):
 
         layer_params = self.layer_params
@@ -109,115 +135,69 @@ class IactStreamMapper(object):
                 for router in range(params.Iact_Routers):
 
                     current_spad = spad_storage[cl_x][cl_y][router]
-                    for cycle in range(len(current_spad)):
-                        stream[cl_x][cl_y][router].extend(self.create_pe_addr_iact_stream(current_spad[cycle]))
-
-                        stream[cl_x][cl_y][router].extend(self.create_pe_data_iact_stream(current_spad[cycle]))
+                    # The address transmissions of a SPad are followed by its data transmissions
+                    words = np.concatenate([self.create_pe_addr_iact_stream(current_spad),
+                                            self.create_pe_data_iact_stream(current_spad)], axis=-1)
+                    # Routers without iacts and repeated SPads share one list
+                    stream[cl_x][cl_y][router] = self.interner.intern(words.reshape(-1))
 
         if(params.SERIAL):
             temp_stream = stream
             stream = []
             for cl_y in range(params.Clusters_Y):
                 for router in range(params.Iact_Routers):
-                    for word in range(len(temp_stream[0][cl_y][router])):
-                        stream.append(temp_stream[0][cl_y][router][word] + (temp_stream[1][cl_y][router][word] * (2**24)))
+                    stream.extend(bit_fields.pack(np.stack([temp_stream[0][cl_y][router], temp_stream[1][cl_y][router]], axis=-1), 24).tolist())
 
         return stream
     
     def create_pe_addr_iact_stream(self, spad):
+        """ Return the address transmissions of one or more SPads [addr, data]. """
         layer_params = self.layer_params
         params = self.params
 
         addr_per_trans = math.floor(params.IACT_Trans_Bitwidth/params.IACT_Addr_Bitwidth)
-        line_counter = 0
-        stream = []
-        for spad_addr_trans in range(math.ceil(params.Iacts_Addr_per_PE/addr_per_trans)):
-            temp_trans = 0
-            for addr_in_trans in range(addr_per_trans):
-                try:
-                    spad_word = addr_in_trans + spad_addr_trans * addr_per_trans
-                    temp_trans = temp_trans + \
-                        (spad[0][spad_word] \
-                        << (params.IACT_Addr_Bitwidth * addr_in_trans)) 
-                except:
-                    pass
-            stream.append(temp_trans)
-            line_counter = line_counter + 1
-            if (line_counter == math.ceil(layer_params.used_iact_addr_per_PE/addr_per_trans)):
-                return stream
-        return stream
+        transmissions = gtu.get_used_transmissions(math.ceil(layer_params.used_iact_addr_per_PE/addr_per_trans),
+                                                   math.ceil(params.Iacts_Addr_per_PE/addr_per_trans))
+        return bit_fields.pack(bit_fields.group(spad[0], transmissions, addr_per_trans), params.IACT_Addr_Bitwidth)
     
     def create_pe_data_iact_stream(self, spad):
+        """ Return the data transmissions of one or more SPads [addr, data].
+
+        Every value is sent with its 4 bit overhead counter above the iact.
+        """
         layer_params = self.layer_params
         params = self.params
 
         data_per_trans = math.floor(params.IACT_Trans_Bitwidth/params.IACT_WOH_Bitwidth)
-        line_counter = 0
-        stream = []
-        for spad_data_trans in range(math.floor(params.Iacts_per_PE/data_per_trans)):
-            temp_trans = 0
-            for data_in_trans in range(data_per_trans):
-                try:
-                    number_of_value = (data_in_trans + spad_data_trans * data_per_trans)
-                    value = gtu.to_twos_complement_string(spad[1][number_of_value][1], 4) + \
-                        gtu.to_twos_complement_string(spad[1][number_of_value][0], self.params.IACT_Bitwidth)
-                    temp_trans = temp_trans + (int(value,2) << (data_in_trans * params.IACT_WOH_Bitwidth))
-                except:
-                    pass
-            stream.append(temp_trans)
-            line_counter = line_counter + 1
-            if (line_counter == math.ceil(layer_params.used_iact_per_PE/2)):
-                break
-        return stream
+        transmissions = gtu.get_used_transmissions(math.ceil(layer_params.used_iact_per_PE/2),
+                                                   math.floor(params.Iacts_per_PE/data_per_trans))
+        values = bit_fields.pack(spad[1], [self.params.IACT_Bitwidth, 4])
+        return bit_fields.pack(bit_fields.group(values, transmissions, data_per_trans), params.IACT_WOH_Bitwidth)
     
 class ConvIactStreamMapper(IactStreamMapper):
     def __init__(self, params, layer_params, layer_repetition, dram_layer_content):
         super().__init__(params, layer_params, layer_repetition, dram_layer_content)
 
-    def write_iact_data_storage(self, cl_x, cl_y, router, cycle, iact_cycle):
-
+    def get_iact_positions(self, cl_x, cl_y, router, cycle, iact_cycle, words):
         layer_params = self.layer_params
         params = self.params
-        layer_repetition = self.layer_repetition
-        dram_fmap = self.dram_fmap
 
-        overhead_counter = 0
-        line_counter = 0
-        spad_storage = [[0 for _ in range(2)] for _ in range(params.Iacts_per_PE)]
-        for words_in_storage in range(math.ceil(params.Iacts_per_PE)):
-            if(words_in_storage < layer_params.used_iact_per_PE):
-
-                iact_temp_pos_x = \
-                int((math.floor(((cl_x * params.PEs_X) + \
-                (math.floor(cl_y / layer_params.used_Y_cluster) * params.PEs_X * params.Clusters_X) + \
-                cycle * params.PEs_X * math.floor(params.Clusters/self.layer_params.used_Y_cluster)) * layer_params.strideX) % \
-                ((layer_params.output_shape[2]+layer_params.add_up)*layer_params.strideX)) + \
-                router + iact_cycle * params.Iact_Routers) - \
-                (math.ceil((layer_params.kernel_size[1]-1)/2))                             #Zero Padding
-                
-                iact_temp_pos_y = \
-                int((words_in_storage % layer_params.kernel_size[1]) + \
-                (layer_params.strideY * \
-                math.floor((((math.floor(cl_y / layer_params.used_Y_cluster) * params.PEs_X * params.Clusters_X) + \
-                (cl_x * params.PEs_X) + \
-                cycle * params.PEs_X * math.floor(params.Clusters/self.layer_params.used_Y_cluster)) * layer_params.strideX)/((layer_params.output_shape[2]+layer_params.add_up)*layer_params.strideX)))) - \
-                (math.ceil((layer_params.kernel_size[1]-1)/2))                             #Zero Padding
-
-                channel = math.floor(words_in_storage/layer_params.kernel_size[0]) + ((layer_repetition % layer_params.iact_transmissions_pe) * math.ceil(layer_params.input_shape[3]/layer_params.iact_transmissions_pe))
-                if(((math.floor(cycle/ self.layer_params.used_Y_cluster) * params.Clusters_Y *  params.Clusters_X * params.PEs_X) + \
-                    ((math.floor(cl_y/ self.layer_params.used_Y_cluster) *  params.Clusters_X * params.PEs_X)) + (cl_x * params.PEs_X)) < \
-                   (layer_params.output_shape[1] * (layer_params.output_shape[2]+layer_params.add_up))):
-                    if(((iact_temp_pos_x >= 0) & (iact_temp_pos_x < (layer_params.output_shape[1] * layer_params.strideX))) & \
-                    ((iact_temp_pos_y) >= 0) & (iact_temp_pos_y < (layer_params.output_shape[2] * layer_params.strideY))):
-                        spad_storage[words_in_storage][0] = dram_fmap[channel][iact_temp_pos_x][iact_temp_pos_y]
-
-                    else:
-                        spad_storage[words_in_storage][0] = 1
-                    spad_storage[words_in_storage][1] = overhead_counter
-                    overhead_counter = overhead_counter + 1
-
-
-        return spad_storage
+        padding = math.ceil((layer_params.kernel_size[1]-1)/2)             #Zero Padding
+        line_len = (layer_params.output_shape[2]+layer_params.add_up)*layer_params.strideX
+        pe_offset = (cl_x * params.PEs_X) + \
+            (cl_y // layer_params.used_Y_cluster) * params.PEs_X * params.Clusters_X + \
+            cycle * params.PEs_X * (params.Clusters // layer_params.used_Y_cluster)
+
+        iact_pos_x = (pe_offset * layer_params.strideX) % line_len + \
+            router + iact_cycle * params.Iact_Routers - padding
+        iact_pos_y = (words % layer_params.kernel_size[1]) + \
+            layer_params.strideY * ((pe_offset * layer_params.strideX) // line_len) - padding
+        channel = words // layer_params.kernel_size[0] + \
+            ((self.layer_repetition % layer_params.iact_transmissions_pe) * math.ceil(layer_params.input_shape[3]/layer_params.iact_transmissions_pe))
+        active = (((cycle // layer_params.used_Y_cluster) * params.Clusters_Y * params.Clusters_X * params.PEs_X) + \
+                  ((cl_y // layer_params.used_Y_cluster) * params.Clusters_X * params.PEs_X) + (cl_x * params.PEs_X)) < \
+                 (layer_params.output_shape[1] * (layer_params.output_shape[2]+layer_params.add_up))
+        return iact_pos_x, iact_pos_y, channel, active
         
     def write_iact_addr_storage(self, cl_x, cl_y, router, cycle, iact_cycle):
 
@@ -237,15 +217,8 @@ class DenseIactStreamMapper(IactStreamMapper):
     def __init__(self, params, layer_params, layer_repetition, dram_layer_content):
         super().__init__(params, layer_params, layer_repetition, dram_layer_content)
     
-    def write_iact_data_glb(self, cl_x, cl_y, router):
-        storage = []
-        for cycle in range(self.layer_params.needed_refreshes_mx[self.layer_repetition][1],self.layer_params.needed_refreshes_mx[self.layer_repetition][2]):
-            for iact_cycle in range(self.layer_params.needed_Iact_writes):
-                data_spad = self.write_iact_data_storage(cl_x, cl_y, router, cycle, iact_cycle)
-                addr_spad = self.write_iact_addr_storage(cl_x, cl_y, router, cycle, iact_cycle)
-                storage.append([addr_spad, data_spad])
-
-        return storage
+    def get_cycles(self, cl_y):
+        return list(range(self.layer_params.needed_refreshes_mx[self.layer_repetition][1],self.layer_params.needed_refreshes_mx[self.layer_repetition][2]))
     
     def write_iact_addr_storage(self, cl_x, cl_y, router, cycle, iact_cycle):
 
@@ -264,25 +237,21 @@ class DenseIactStreamMapper(IactStreamMapper):
         params = self.params
         layer_params = self.layer_params
         dram_fmap = self.dram_fmap
-        layer_repetition = self.layer_repetition
 
-        overhead_counter = 0
-        spad_storage = [[0 for _ in range(2)] for _ in range(params.Iacts_per_PE)]
+        shape = np.broadcast_shapes(np.shape(cycle), np.shape(iact_cycle))
+        spad_storage = np.zeros(shape + (params.Iacts_per_PE, 2), dtype=np.int64)
         if(cl_y == 0):
-            for words_in_storage in range(math.ceil(params.Iacts_per_PE)):
-                if(words_in_storage < layer_params.used_iact_per_PE):
-
-                    iact_temp_pos_x = words_in_storage + \
-                    router * layer_params.used_iact_per_PE + \
-                    (layer_repetition % layer_params.iact_transmissions_pe) * params.Iact_Routers * layer_params.used_iact_per_PE
-
-                    try:
-                        spad_storage[words_in_storage][0]= dram_fmap[iact_temp_pos_x]
-                    except:
-                        spad_storage[words_in_storage][0]= 0
-                    spad_storage[words_in_storage][1]= overhead_counter
-
-                    overhead_counter = overhead_counter + 1
+            words = np.arange(min(layer_params.used_iact_per_PE, params.Iacts_per_PE))
+            iact_temp_pos_x = words + \
+                router * layer_params.used_iact_per_PE + \
+                (self.layer_repetition % layer_params.iact_transmissions_pe) * params.Iact_Routers * layer_params.used_iact_per_PE
+
+            # Iacts behind the end of the input are 0
+            inside = iact_temp_pos_x < len(dram_fmap)
+            values = np.zeros(words.size, dtype=np.int64)
+            values[inside] = dram_fmap[iact_temp_pos_x[inside]]
+            spad_storage[..., :words.size, 0] = values
+            spad_storage[..., :words.size, 1] = words
 
         return spad_storage
     
@@ -303,49 +272,27 @@ class DwIactStreamMapper(IactStreamMapper):
                 spad_storage[words_in_storage] = (layer_params.kernel_size[0] * (words_in_storage + 1))
         return spad_storage
     
-    def write_iact_data_storage(self, cl_x, cl_y, router, cycle, iact_cycle):
+    def get_iact_positions(self, cl_x, cl_y, router, cycle, iact_cycle, words):
         params = self.params
         layer_params = self.layer_params
-        dram_fmap = self.dram_fmap
 
-        iact_temp_pos_x = 0
-        iact_temp_pos_y = 0
-        overhead_counter = 0
-        spad_storage = [[0 for _ in range(2)] for _ in range(params.Iacts_per_PE)]
-
-        for words_in_storage in range(math.ceil(params.Iacts_per_PE)):
-            if(words_in_storage < layer_params.used_iact_per_PE):
-
-                iact_temp_pos_x = \
-                int((math.floor(((cl_x * params.PEs_X) + \
-                ((cl_y / layer_params.ceil_used_PE_per_clm) * params.PEs_X * params.Clusters_X) + \
-                ((cl_y % layer_params.ceil_used_PE_per_clm) * params.PEs_X * (params.Clusters / layer_params.ceil_used_PE_per_clm )) + \
-                cycle * params.PEs_X * params.Clusters) * \
-                layer_params.strideX) % \
-                ((layer_params.output_shape[2]+layer_params.add_up)*layer_params.strideX)) + \
-                router + iact_cycle * params.Iact_Routers) - \
-                (math.ceil((layer_params.kernel_size[1]-1)/2))                             #Zero Padding
-                
-                iact_temp_pos_y = \
-                int(((words_in_storage) % layer_params.kernel_size[1]) + \
-                (layer_params.strideY * math.floor( \
-                ((((cl_y / layer_params.ceil_used_PE_per_clm) * params.PEs_X * params.Clusters_X) + \
-                ((cl_y % layer_params.ceil_used_PE_per_clm) * params.Clusters_X * params.PEs_X) + \
-                (cl_x * params.PEs_X) + \
-                cycle *params.PEs_X * params.Clusters) * \
-                layer_params.strideX)/((layer_params.output_shape[2]+layer_params.add_up)*layer_params.strideX)))) - \
-                (math.ceil((layer_params.kernel_size[1]-1)/2))                             #Zero Padding
-                
-                channel = math.floor(words_in_storage/layer_params.kernel_size[0]) + ((self.layer_repetition % layer_params.iact_transmissions_pe) * math.ceil(layer_params.input_shape[3]/layer_params.iact_transmissions_pe)) #HIer was aendern
-
-                if(((cycle * 8 * 2 * 4) + (cl_y * 2 * 4) + (cl_x * 4)) < (layer_params.output_shape[1] * (layer_params.output_shape[2]+layer_params.add_up))):
-                    if(((iact_temp_pos_x >= 0) & (iact_temp_pos_x < (layer_params.output_shape[1] * layer_params.strideX))) & \
-                    ((iact_temp_pos_y) >= 0) & (iact_temp_pos_y < (layer_params.output_shape[2] * layer_params.strideY))):
-                        spad_storage[words_in_storage][0]= dram_fmap[channel][iact_temp_pos_x][iact_temp_pos_y]
-                    else:
-                        spad_storage[words_in_storage][0]= 1
-                    spad_storage[words_in_storage][1] = overhead_counter
-                    overhead_counter = overhead_counter + 1
-
-        return spad_storage
-    
\ No newline at end of file
+        padding = math.ceil((layer_params.kernel_size[1]-1)/2)             #Zero Padding
+        line_len = (layer_params.output_shape[2]+layer_params.add_up)*layer_params.strideX
+        # The cluster rows are spread with float factors, keep the order of the operations
+        x_offset = (cl_x * params.PEs_X) + \
+            ((cl_y / layer_params.ceil_used_PE_per_clm) * params.PEs_X * params.Clusters_X) + \
+            ((cl_y % layer_params.ceil_used_PE_per_clm) * params.PEs_X * (params.Clusters / layer_params.ceil_used_PE_per_clm )) + \
+            cycle * params.PEs_X * params.Clusters
+        y_offset = ((cl_y / layer_params.ceil_used_PE_per_clm) * params.PEs_X * params.Clusters_X) + \
+            ((cl_y % layer_params.ceil_used_PE_per_clm) * params.Clusters_X * params.PEs_X) + \
+            (cl_x * params.PEs_X) + \
+            cycle *params.PEs_X * params.Clusters
+
+        iact_pos_x = np.floor(x_offset * layer_params.strideX).astype(np.int64) % line_len + \
+            router + iact_cycle * params.Iact_Routers - padding
+        iact_pos_y = (words % layer_params.kernel_size[1]) + \
+            layer_params.strideY * np.floor((y_offset * layer_params.strideX)/line_len).astype(np.int64) - padding
+        channel = words // layer_params.kernel_size[0] + \
+            ((self.layer_repetition % layer_params.iact_transmissions_pe) * math.ceil(layer_params.input_shape[3]/layer_params.iact_transmissions_pe))
+        active = ((cycle * 8 * 2 * 4) + (cl_y * 2 * 4) + (cl_x * 4)) < (layer_params.output_shape[1] * (layer_params.output_shape[2]+layer_params.add_up))
+        return iact_pos_x, iact_pos_y, channel, active
@@ -0,0 +1,70 @@
+# This file is part of the OpenEye project.
+# All rights reserved. © Fachhochschule Dortmund - University of Applied Sciences and Arts.
+# SPDX-License-Identifier: SHL-2.1
+# For more details, see the LICENSE file in the root directory of this project.
+"""
+Coalesced writes of the input signals of the DUT.
+
+The inputs are written with the input delay after the rising edge, which
+is the value used for the implementation constraints of OpenEye. Instead of
+one coroutine with its own Timer per write, one InputScheduler per clock
+domain collects the writes that are made at the same simulation time and
+applies them together after a single Timer. Writes to the same signal in
+the same batch keep the last value, like the coroutines did before.
+"""
+import collections
+import cocotb
+from cocotb.triggers import Timer, Event
+from cocotb.utils import get_sim_time, get_sim_steps
+
+
+class InputScheduler(object):
+    """ Long-lived coroutine that applies the pending input writes of a clock domain.
+
+    Attributes:
+        delay: The input delay in simulation steps.
+        batches: Deque of [due time in steps, {signal: value}], ordered by the due time.
+        applied: Number of writes that were applied, for statistics.
+    """
+    def __init__(self, ptp):
+        self.delay = get_sim_steps(ptp.clk_delay_in, ptp.clk_delay_unit_in)
+        self.batches = collections.deque()
+        self.wakeup = Event()
+        self.applied = 0
+        self.task = cocotb.start_soon(self.run())
+
+    def set(self, signal, value):
+        """ Queue a write of value to signal, it is applied after the input delay. """
+        due = get_sim_time("step") + self.delay
+        if (not self.batches) or (self.batches[-1][0] != due):
+            self.batches.append([due, {}])
+        writes = self.batches[-1][1]
+        # A later write to the same signal replaces the earlier one, but keeps the order of the others
+        writes.pop(signal, None)
+        writes[signal] = value
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            if not self.batches:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            due, writes = self.batches[0]
+            now = get_sim_time("step")
+            if due > now:
+                await Timer(due - now, units="step")
+                continue
+            self.batches.popleft()
+            for signal, value in writes.items():
+                signal.value = value
+            self.applied = self.applied + len(writes)
+
+
+def get_input_scheduler(ptp):
+    """ Return the InputScheduler of the clock domain ptp, it is started on first use. """
+    scheduler = getattr(ptp, "input_scheduler", None)
+    if (scheduler is None) or scheduler.task.done():
+        scheduler = InputScheduler(ptp)
+        ptp.input_scheduler = scheduler
+    return scheduler
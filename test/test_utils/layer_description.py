@@ -0,0 +1,47 @@
+# This file is part of the OpenEye project.
+# All rights reserved. © Fachhochschule Dortmund - University of Applied Sciences and Arts.
+# SPDX-License-Identifier: SHL-2.1
+# For more details, see the LICENSE file in the root directory of this project.
+import numpy as np
+
+class TensorDescription(object):
+    """ Shape of an input or output tensor of a layer. """
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+
+
+class LayerDescription(object):
+    """ Picklable snapshot of the geometry of a Keras layer.
+
+    Worker processes get this description instead of the Keras layer, which
+    is expensive or impossible to pickle. str() of the description returns
+    str() of the layer, so checks like "Conv" in str(layer) keep working.
+    The weights are only copied on request, LayerParameters needs them.
+    """
+    def __init__(self, layer, weights = False):
+        self.name = str(layer)
+        self.input = TensorDescription(layer.input.shape)
+        self.output = TensorDescription(layer.output.shape)
+        self.kernel_size = tuple(getattr(layer, "kernel_size", ()))
+        self.filters = getattr(layer, "filters", None)
+        self.strides = tuple(getattr(layer, "strides", ()))
+        self.pool_size = tuple(getattr(layer, "pool_size", ()))
+        self.padding = getattr(layer, "padding", None)
+        self.weights = [np.asarray(w) for w in layer.weights] if weights else []
+
+    def __str__(self):
+        return self.name
+
+
+def get_layer_type(layer):
+    """ Return the type of a layer as the tests dispatch on it, without the address or the name in str(layer). """
+    for layer_type in ("Depthwise", "Conv", "Dense", "Pooling", "Flat"):
+        if layer_type in str(layer):
+            return layer_type
+    return type(layer).__name__
+
+def describe(layer, weights = False):
+    """ Return a LayerDescription of a layer, or the layer if it is one already. """
+    if isinstance(layer, LayerDescription) and (layer.weights or not weights):
+        return layer
+    return LayerDescription(layer, weights)
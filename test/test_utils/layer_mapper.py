@@ -9,8 +9,11 @@ directory = (os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__fil
 sys.path.extend([directory, os.path.dirname(os.path.realpath(__file__))])
 import math
 import logging
+import numpy as np
 import generic_test_utils as gtu
+import bit_fields
 import stream_dicts as strdic
+from test_utils.stream import Stream
 
 logger = logging.getLogger("cocotb")
 
@@ -38,17 +41,50 @@ class LayerMapper(object):
             self.storage = [[] for _ in range(len(strdic.stream_parallel_dict))]
 
     def make_stream(self):
-        self.storage[strdic.stream_parallel_dict["status"]] = self.write_working_parameters(self.params, self.layer_params, self.layer_repetition)
-        self.storage[strdic.stream_parallel_dict["iact"]] = self.IactStreamCreator.get_iact_stream()
-        self.storage[strdic.stream_parallel_dict["wght"]] = self.WghtStreamCreator.get_wght_stream()
-        self.storage[strdic.stream_parallel_dict["psum"]] = self.PsumStreamCreator.get_psum_stream()
+        self.make_static_stream()
+        self.make_iact_stream()
         logger.info("Stream finished: " + str(self.layer_repetition + 1) + " of " + str(self.layer_params.needed_total_transmissions))
 
+    def make_static_stream(self):
+        """ Make the parts of the stream that do not depend on the input feature map. """
+        self.make_components(("status", "wght", "psum"))
+
+    def make_iact_stream(self):
+        """ Make the iact stream, it needs the input feature map in the DRAM. """
+        self.make_components(("iact",))
+
+    def make_components(self, components):
+        """ Make the given parts of the stream, see strdic.stream_dependencies. """
+        for component in components:
+            if component == "status":
+                self.storage[strdic.stream_parallel_dict["status"]] = self.write_working_parameters(self.params, self.layer_params, self.layer_repetition)
+            elif component == "iact":
+                self.storage[strdic.stream_parallel_dict["iact"]] = self.IactStreamCreator.get_iact_stream()
+            elif component == "wght":
+                self.storage[strdic.stream_parallel_dict["wght"]] = self.WghtStreamCreator.get_wght_stream()
+            elif component == "psum":
+                self.storage[strdic.stream_parallel_dict["psum"]] = self.PsumStreamCreator.get_psum_stream()
+
     def get_stream(self):
-        return self.storage
+        # The bus words are made here, in the worker, and not by the drivers
+        return Stream.from_storage(self.storage, self.params.SERIAL).make_bus(self.params)
     
     def write_working_parameters(self):
         pass
+
+    def write_computing_pes(self, params, layer_params):
+        """ Return the mask of the computing PEs, one bit per PE. """
+        return bit_fields.pack_int(np.asarray(layer_params.computing_mx).reshape(-1), 1)
+
+    def write_status_dma(self, status, computing_pes):
+        """ Return the status words of the serial DMA stream.
+
+        status maps the fields of strdic.status_dma_layout to their values,
+        the mask of the computing PEs follows in 48 bit words.
+        """
+        dma_storage = [bit_fields.pack_record(status, layout) for layout in strdic.status_dma_layout]
+        dma_storage.extend(int(word) for word in bit_fields.unpack(np.array(computing_pes, dtype = object), strdic.use_pes_dma_bitwidth, strdic.use_pes_dma_words))
+        return dma_storage
  
     def get_psum_stream(self):
         if(self.params.SERIAL):
@@ -0,0 +1,237 @@
+# This file is part of the OpenEye project.
+# All rights reserved. © Fachhochschule Dortmund - University of Applied Sciences and Arts.
+# SPDX-License-Identifier: SHL-2.1
+# For more details, see the LICENSE file in the root directory of this project.
+"""
+Capture of the output stream of the DUT.
+
+The drain loops of compare_stream_Conv/Dw/Dense read the output bus once per
+cycle as one int (read_word). The captured words are mapped to the output
+feature map with a ScatterPlan. It holds the position of every 20 bit field
+that is read in a cycle and the output index (f, x, y) or (x,) of every
+field and cycle. The indices follow the same f/x/y state machine as the
+drain loops did before. The plan of a layer repetition is made before the
+drain for the expected number of cycles, and extended if the DUT sends more
+words. After the drain, all words are unpacked and scattered into the fmap
+at once.
+
+The positions count from the most significant bit of the bus, like the
+slices of the BinaryValue that were used before.
+"""
+import math
+import numpy as np
+
+PSUM_FIELD_BITS = 20
+LANE_BITS = 40
+
+
+def read_word(signal):
+    """ Return the value of a bus as int, or as string of bits if it is not resolvable. """
+    value = signal.value
+    try:
+        return int(value)
+    except ValueError:
+        return value.binstr
+
+
+class ScatterPlan(object):
+    """ Maps the fields of the captured output words to the output feature map.
+
+    Attributes:
+        positions: Start of every field that is read in a cycle.
+        lanes: Start and width of every lane that is written to the debug output.
+        names: Names of the axes of the output indices, for the debug output.
+        step: Function that advances a state dict by one cycle and returns
+            the output index of every field of the cycle.
+        indexes: The output indices of the fields, one list per planned cycle.
+        states: The state before every planned cycle and after the last one.
+    """
+    def __init__(self, positions, lanes, names, step, state, cycles = 0):
+        self.positions = list(positions)
+        self.lanes = list(lanes)
+        self.names = names
+        self.step = step
+        self.indexes = []
+        self.states = [dict(state)]
+        self.extend(cycles)
+
+    def extend(self, cycles):
+        """ Plan at least cycles cycles. """
+        while len(self.indexes) < cycles:
+            state = dict(self.states[-1])
+            self.indexes.append(self.step(state))
+            self.states.append(state)
+
+    def unpack(self, words, bus_bits):
+        """ Return the signed value of every field of the words and if it could be read.
+
+        Both arrays have the shape (cycles, fields). Fields outside of the
+        bus and fields with X or Z are not valid.
+        """
+        shifts = bus_bits - np.asarray(self.positions, dtype = np.int64) - PSUM_FIELD_BITS
+        values = np.zeros((len(words), len(self.positions)), dtype = np.int64)
+        valid = np.zeros(values.shape, dtype = bool)
+        resolved = [n for n, word in enumerate(words) if not isinstance(word, str)]
+        if resolved and len(self.positions):
+            word_bytes = -(-bus_bits // 8) + 8
+            data = np.frombuffer(b"".join(words[n].to_bytes(word_bytes, "little") for n in resolved), dtype = np.uint8)
+            data = data.reshape(len(resolved), word_bytes).astype(np.uint64)
+            first = np.clip(shifts, 0, None) // 8
+            chunks = data[:, first[:, None] + np.arange(4)]
+            fields = (chunks << (np.arange(4, dtype = np.uint64) * np.uint64(8))).sum(axis = -1, dtype = np.uint64)
+            fields = (fields >> (np.clip(shifts, 0, None) % 8).astype(np.uint64)) & np.uint64((1 << PSUM_FIELD_BITS) - 1)
+            values[resolved] = fields.astype(np.int64)
+            valid[resolved] = shifts >= 0
+        for n, word in enumerate(words):
+            if isinstance(word, str):
+                for field, position in enumerate(self.positions):
+                    try:
+                        values[n, field] = int(word[position:position + PSUM_FIELD_BITS], 2)
+                        valid[n, field] = (len(word[position:position + PSUM_FIELD_BITS]) == PSUM_FIELD_BITS)
+                    except ValueError:
+                        pass
+        values = values - (values >= 2**(PSUM_FIELD_BITS - 1)) * 2**PSUM_FIELD_BITS
+        return values, valid
+
+    def scatter(self, fmap, words, bus_bits):
+        """ Write the fields of the captured words to fmap and return the state after the last word.
+
+        Fields whose index is outside of fmap are dropped, like the writes
+        of the drain loops that raised an IndexError.
+        """
+        self.extend(len(words))
+        if words and len(self.positions):
+            values, valid = self.unpack(words, bus_bits)
+            indexes = np.asarray(self.indexes[:len(words)], dtype = np.int64).reshape(-1, fmap.ndim)
+            valid = valid.reshape(-1) & np.all((indexes >= 0) & (indexes < np.asarray(fmap.shape)), axis = 1)
+            fmap[tuple(indexes[valid].T)] = values.reshape(-1)[valid]
+        return self.states[len(words)]
+
+    def write_debug(self, txt_file, storage_file, words, bus_bits):
+        """ Write the lanes of the words and the output indices like the drain loops did. """
+        for word in words:
+            bits = word if isinstance(word, str) else format(word, "0" + str(bus_bits) + "b")
+            for position, width in self.lanes:
+                txt_file.write(bits[position:position + width].zfill(width) + "\n")
+        for indexes in self.indexes[:len(words)]:
+            for index in indexes:
+                storage_file.write(" ".join(name + ": " + str(value) for name, value in zip(self.names, index)) + "\n")
+
+
+def get_lane_position(oep, x_cluster, y_cluster, router):
+    return x_cluster * oep.Clusters_Y * oep.NUM_GLB_PSUM * LANE_BITS + y_cluster * oep.NUM_GLB_PSUM * LANE_BITS + router * LANE_BITS
+
+def get_computing_lanes(oep, layer_parameters, y_clusters):
+    """ Return (x_cluster, y_cluster, router) of the lanes that are read, in the order of the drain. """
+    return [(x_cluster, y_cluster, router) for y_cluster in y_clusters
+            for x_cluster in reversed(range(oep.Clusters_X))
+            for router in reversed(range(oep.NUM_GLB_PSUM))
+            if layer_parameters.computing_mx[oep.Clusters_X-x_cluster-1][oep.Clusters_Y-y_cluster-1][0][oep.NUM_GLB_PSUM-router-1] == 1]
+
+def get_enable_cycles_conv(layer_parameters, layer_repetition):
+    """ Return the number of cycles of send_enable_conv, the expected length of the drain. """
+    return int((math.ceil(layer_parameters.filters/layer_parameters.needed_wght_transmissions/2)*\
+                math.ceil(layer_parameters.needed_refreshes_mx[layer_repetition][0]/layer_parameters.used_Y_cluster)))
+
+def get_state(les, f, x, y):
+    return {"f": f, "x": x, "y": y, "f_start": les.f_start, "x_start": les.x_start, "y_start": les.y_start}
+
+def advance_corner(state, les):
+    """ Advance the state after the last lane of an output position of a Conv layer. """
+    if(state["f"] >= les.f_end):
+        state["f_start"] = les.f_corner_start
+        state["f"] = state["f_start"]
+        if(state["x"] == les.x_end - 1):
+            state["x"] = 0
+            if(state["y"] >= les.y_end - 1):
+                state["y"] = 0
+            else:
+                state["y"] = state["y"] + 1
+        else:
+            state["x"] = state["x"] + 1
+        state["y_start"] = state["y"]
+        state["x_start"] = state["x"]
+    else:
+        state["f_start"] = state["f"]
+        state["x"] = state["x_start"]
+        state["y"] = state["y_start"]
+
+def get_plan_Conv(oep, layer_parameters, les, f, x, y, cycles = 0):
+    """ Return the ScatterPlan of the psum bus of a Conv layer, starting at f, x, y. """
+    cluster_order = []
+    for a in range(layer_parameters.used_Y_cluster):
+        for b in range(0,oep.Clusters_Y,layer_parameters.used_Y_cluster):
+            cluster_order.append(a+b)
+    lanes = get_computing_lanes(oep, layer_parameters, reversed(cluster_order))
+    corners = [(y_cluster == 0) and (x_cluster == 0) and (router == layer_parameters.add_up) for x_cluster, y_cluster, router in lanes]
+
+    def step(state):
+        indexes = []
+        for corner in corners:
+            for _ in range(2):
+                indexes.append((state["f"], state["x"], state["y"]))
+                state["f"] = state["f"] + 1
+            if(corner):
+                advance_corner(state, les)
+            else:
+                state["f"] = state["f"] - 2
+                if(state["x"] == les.x_end - 1):
+                    state["x"] = 0
+                    state["y"] = state["y"] + 1
+                else:
+                    state["x"] = state["x"] + 1
+        return indexes
+
+    positions = [get_lane_position(oep, *lane) + PSUM_FIELD_BITS*(1-i) for lane in lanes for i in range(2)]
+    lane_fields = [(get_lane_position(oep, *lane), LANE_BITS) for lane in lanes]
+    return ScatterPlan(positions, lane_fields, ("f", "x", "y"), step, get_state(les, f, x, y), cycles)
+
+def get_plan_Conv_serial(oep, les, f, x, y, cycles = 0):
+    """ Return the ScatterPlan of the DMA output of a Conv layer, starting at f, x, y. """
+    def step(state):
+        indexes = []
+        for _ in range(2):
+            indexes.append((state["f"], state["x"], state["y"]))
+            state["f"] = state["f"] + 1
+        advance_corner(state, les)
+        return indexes
+
+    positions = [28 - PSUM_FIELD_BITS*i for i in range(2)]
+    return ScatterPlan(positions, [(0, oep.DMA_Bits)], ("f", "x", "y"), step, get_state(les, f, x, y), cycles)
+
+def get_plan_Dw(oep, layer_parameters, les, f, x, y, cycles = 0):
+    """ Return the ScatterPlan of the psum bus of a DepthwiseConv layer, starting at f, x, y. """
+    lanes = get_computing_lanes(oep, layer_parameters, reversed(range(oep.Clusters_Y)))
+
+    def step(state):
+        indexes = []
+        for _ in lanes:
+            indexes.append((state["f"], state["x"], state["y"]))
+            state["x"] = state["x"] + 1
+            if(state["x"] >= les.x_end):
+                state["x"] = 0
+                state["y"] = state["y"] + 1
+        return indexes
+
+    positions = [get_lane_position(oep, *lane) + PSUM_FIELD_BITS for lane in lanes]
+    lane_fields = [(get_lane_position(oep, *lane), LANE_BITS) for lane in lanes]
+    return ScatterPlan(positions, lane_fields, ("f", "x", "y"), step, get_state(les, f, x, y), cycles)
+
+def get_plan_Dense(oep, layer_parameters, offset_layer_repetition, router = 3, values_per_trans = 2, cycles = 0):
+    """ Return the ScatterPlan of the psum bus of a Dense layer. """
+    lanes = [(x_cluster, y_cluster, router) for y_cluster in reversed(range(oep.Clusters_Y)) for x_cluster in reversed(range(oep.Clusters_X))]
+
+    def step(state):
+        indexes = []
+        for x_cluster, y_cluster, _ in lanes:
+            x = state["offset"] + offset_layer_repetition + \
+                (oep.Clusters_Y-1-y_cluster) * oep.Clusters_X * layer_parameters.used_psum_per_PE + \
+                (oep.Clusters_X-1-x_cluster) * layer_parameters.used_psum_per_PE
+            for i in range(values_per_trans):
+                indexes.append((x + i,))
+        state["offset"] = state["offset"] + values_per_trans
+        return indexes
+
+    positions = [get_lane_position(oep, *lane) + PSUM_FIELD_BITS*(1-i) for lane in lanes for i in range(values_per_trans)]
+    lane_fields = [(get_lane_position(oep, *lane), LANE_BITS) for lane in lanes]
+    return ScatterPlan(positions, lane_fields, ("x",), step, {"offset": 0}, cycles)
@@ -8,8 +8,11 @@ directory = (os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__fil
 sys.path.extend([directory, os.path.dirname(os.path.realpath(__file__))])
 import math
 import logging
+import numpy as np
 import generic_test_utils as gtu
+import bit_fields
 import stream_dicts as strdic
+from test_utils.stream import LaneInterner
 
 logger = logging.getLogger("cocotb")
 
@@ -20,6 +23,7 @@ class PsumStreamMapper(object):
         self.layer_params = layer_params
         self.layer_repetition = layer_repetition
         self.dram_bias = dram_layer_content
+        self.interner = LaneInterner()
         if (self.params.SERIAL):
             self.storage = [[] for _ in range(len(strdic.stream_serial_dict))]
         else:
@@ -27,13 +31,22 @@ class PsumStreamMapper(object):
 
     def get_psum_stream(self):
         psum_stream = [[[[] for c in range(self.params.Psum_Routers)] for b in range(self.params.Clusters_Y)] for a in range(self.params.Clusters_X)]
+        # The SPads of routers with the same lane key are written once
+        spads = {}
         for cl_x in range(self.params.Clusters_X):
             for cl_y in range(self.params.Clusters_Y):
                 for router in range(self.params.Psum_Routers):
-                    psum_stream[cl_x][cl_y][router] = self.write_psum_data_glb(cl_x, cl_y, router)
+                    key = self.get_lane_key(cl_x, cl_y, router)
+                    if key not in spads:
+                        spads[key] = self.write_psum_data_glb(cl_x, cl_y, router)
+                    psum_stream[cl_x][cl_y][router] = spads[key]
         psum_stream = self.create_complete_psum_stream(psum_stream)
         return psum_stream
 
+    def get_lane_key(self, cl_x, cl_y, router):
+        """ Return the coordinates of a router that its psum SPads depend on. """
+        return (cl_x, cl_y, router)
+
     def write_psum_data_glb(self, cl_x, cl_y, router):
         storage = []
         for cycle in range(self.layer_params.needed_refreshes_mx[self.layer_repetition][1],self.layer_params.needed_refreshes_mx[self.layer_repetition][2]):
@@ -48,8 +61,7 @@ class PsumStreamMapper(object):
                 for router in range(params.Psum_Routers):
 
                     current_spad = spad_storage[cl_x][cl_y][router]
-                    for cycle in range(len(current_spad)):
-                        stream[cl_x][cl_y][router].extend(spad_storage[cl_x][cl_y][router][cycle])
+                    stream[cl_x][cl_y][router] = self.interner.intern([value for spad in current_spad for value in spad])
 
 
         if(self.params.SERIAL):
@@ -57,8 +69,7 @@ class PsumStreamMapper(object):
             stream = []
             for cl_y in range(self.params.Clusters_Y):
                 for router in range(self.params.Iact_Routers):
-                    for word in range(len(temp_stream[0][cl_y][router])):
-                        stream.append(temp_stream[0][cl_y][router][word] + (temp_stream[1][cl_y][router][word] * (2**24)))
+                    stream.extend(bit_fields.pack(np.stack([temp_stream[0][cl_y][router], temp_stream[1][cl_y][router]], axis=-1), 24).tolist())
         else:
             return stream
         return stream
@@ -67,6 +78,9 @@ class ConvPsumStreamMapper(PsumStreamMapper):
     def __init__(self, params, layer_params, layer_repetition, dram_layer_content):
         super().__init__(params, layer_params, layer_repetition, dram_layer_content)
 
+    def get_lane_key(self, cl_x, cl_y, router):
+        return ()
+
     def write_psum_storage(self, cl_x, cl_y, router, cycle):
         storage = []
         for part_data_num in range(int(self.layer_params.filters/self.layer_params.needed_wght_transmissions)):
@@ -80,6 +94,9 @@ class DwPsumStreamMapper(PsumStreamMapper):
     def __init__(self, params, layer_params, layer_repetition, dram_layer_content):
         super().__init__(params, layer_params, layer_repetition, dram_layer_content)
 
+    def get_lane_key(self, cl_x, cl_y, router):
+        return ((cl_y % self.layer_params.ceil_used_PE_per_clm) == 0,)
+
     def write_psum_storage(self, cl_x, cl_y, router, cycle):
         storage = []
         for part_data_num in range(int(self.layer_params.filters)):
@@ -94,6 +111,9 @@ class DensePsumStreamMapper(PsumStreamMapper):
     def __init__(self, params, layer_params, layer_repetition, dram_layer_content):
         super().__init__(params, layer_params, layer_repetition, dram_layer_content)
 
+    def get_lane_key(self, cl_x, cl_y, router):
+        return ()
+
     def write_psum_storage(self, cl_x, cl_y, router, cycle):
         storage = []
         for part_data_num in range(math.ceil(self.layer_params.used_psum_per_PE/2)):
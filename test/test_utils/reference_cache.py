@@ -0,0 +1,177 @@
+# This file is part of the OpenEye project.
+# All rights reserved. © Fachhochschule Dortmund - University of Applied Sciences and Arts.
+# SPDX-License-Identifier: SHL-2.1
+# For more details, see the LICENSE file in the root directory of this project.
+"""
+Content-addressed on-disk cache for the golden reference of a layer.
+
+An entry is addressed by a SHA-256 hash over the layer geometry, the strides,
+the padding, the OpenEye parameters, the source files the reference is
+computed with and the bytes of the weights, the bias and the input feature
+map. A change of the sources invalidates the entries without a new
+CACHE_VERSION. It holds the reference results and, if they were created, the
+expected DMA streams of all layer repetitions as compressed .npz file.
+
+The cache is configured with environment variables:
+    REFERENCE_CACHE: Set to 0 to bypass the cache (default 1).
+    REFERENCE_CACHE_DIR: Directory of the cache (default test/.reference_cache).
+    REFERENCE_CACHE_MAX_MB: Size cap in MiB, the least recently used entries
+        are evicted first (default 512).
+"""
+import os
+import hashlib
+import logging
+import functools
+import tempfile
+import numpy as np
+
+logger = logging.getLogger("cocotb")
+
+# Increase when the semantics of the reference model or the streams change
+CACHE_VERSION = 1
+
+TEST_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir))
+DEFAULT_CACHE_DIR = os.path.join(TEST_DIR, ".reference_cache")
+DEFAULT_MAX_MB = 512
+
+# Sources of the reference results and the expected DMA streams, relative to TEST_DIR
+REFERENCE_SOURCES = (
+    "test_utils/reference_model.py",
+    "cocotb_parallel/parallel_test_utils.py",
+)
+
+
+@functools.lru_cache(maxsize=None)
+def get_source_hash(sources):
+    """ Return a hash over the contents of the source files, paths relative to TEST_DIR. """
+    sha = hashlib.sha256()
+    for source in sources:
+        sha.update(source.encode())
+        try:
+            with open(os.path.join(TEST_DIR, source), "rb") as f:
+                sha.update(f.read())
+        except OSError:
+            sha.update(b"missing")
+    return sha.hexdigest()
+
+
+class ReferenceCache(object):
+    """ LRU cache of reference results and DMA streams on disk.
+
+    Attributes:
+        enabled: False if the cache is bypassed.
+        directory: Directory that holds the .npz entries.
+        max_bytes: Size cap of the directory in bytes.
+    """
+    suffix = ".npz"
+    sources = REFERENCE_SOURCES
+
+    def __init__(self, directory = None, max_mb = None, enabled = None):
+        if enabled is None:
+            enabled = os.getenv("REFERENCE_CACHE", "1") not in ("0", "false", "False", "off")
+        if directory is None:
+            directory = os.getenv("REFERENCE_CACHE_DIR", DEFAULT_CACHE_DIR)
+        if max_mb is None:
+            try:
+                max_mb = float(os.getenv("REFERENCE_CACHE_MAX_MB", DEFAULT_MAX_MB))
+            except ValueError:
+                logger.warning("REFERENCE_CACHE_MAX_MB is not a number. Setting to " + str(DEFAULT_MAX_MB) + ".")
+                max_mb = DEFAULT_MAX_MB
+        self.enabled = enabled
+        self.directory = directory
+        self.max_bytes = int(max_mb * 1024 * 1024)
+
+    def key(self, params, layer_params, layer, layer_number, dram):
+        """ Return the hash that addresses the reference of a layer. """
+        sha = hashlib.sha256()
+        geometry = (
+            CACHE_VERSION,
+            type(layer).__name__,
+            tuple(layer.input.shape),
+            tuple(layer.output.shape),
+            tuple(getattr(layer, "kernel_size", ())),
+            getattr(layer, "filters", None),
+            layer_params.strideX,
+            layer_params.strideY,
+            getattr(layer, "padding", None),
+            sorted(vars(params).items()),
+            get_source_hash(self.sources),
+        )
+        sha.update(repr(geometry).encode())
+        for data in (dram.weights[layer_number], getattr(layer, "bias", None), dram.fmap[layer_number]):
+            if data is None:
+                sha.update(b"None")
+            else:
+                data = np.ascontiguousarray(np.asarray(data))
+                sha.update(repr((data.dtype.str, data.shape)).encode())
+                sha.update(data.tobytes())
+        return sha.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def load(self, key):
+        """ Return the entry as (results, dma_streams) or None on a miss.
+
+        dma_streams is None if the entry was stored without streams.
+        """
+        if not self.enabled:
+            return None
+        path = self.path(key)
+        try:
+            with np.load(path) as entry:
+                results = entry["results"]
+                dma_streams = list(entry["dma_streams"]) if "dma_streams" in entry else None
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("Reference cache entry " + path + " is unreadable and removed: " + str(e))
+            self._remove(path)
+            return None
+        # Mark the entry as recently used
+        os.utime(path)
+        logger.info("Reference cache hit: " + key)
+        return results, dma_streams
+
+    def store(self, key, results, dma_streams = None):
+        """ Store an entry atomically and evict old entries above the size cap. """
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        entry = {"results": np.asarray(results)}
+        if dma_streams is not None:
+            entry["dma_streams"] = np.asarray(dma_streams, dtype=str)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez_compressed(f, **entry)
+            os.replace(tmp_path, self.path(key))
+        except Exception:
+            self._remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """ Remove the least recently used entries until the size cap holds. """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(self.suffix):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            logger.debug("Reference cache evicts " + path)
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,119 @@
+# This file is part of the OpenEye project.
+# All rights reserved. © Fachhochschule Dortmund - University of Applied Sciences and Arts.
+# SPDX-License-Identifier: SHL-2.1
+# For more details, see the LICENSE file in the root directory of this project.
+"""
+Vectorized golden model of the layers that are computed by OpenEye.
+
+The functions in this module compute the reference results that the output
+of the accelerator is compared against. They work on int64 ndarrays and keep
+the semantics of the original scalar loops: input activations outside of the
+feature map are treated as 1, and the feature map is only read inside of the
+area covered by the output times the stride.
+"""
+import math
+import logging
+import numpy as np
+
+logger = logging.getLogger("cocotb")
+
+
+def get_bias(layer, channels):
+    """ Return the bias of a layer as int64 ndarray.
+
+    The bias values are truncated towards zero, like int() does.
+    """
+    if getattr(layer, "bias", None) is None:
+        return np.zeros(channels, dtype=np.int64)
+    return np.trunc(np.asarray(layer.bias, dtype=np.float64)).astype(np.int64).reshape(channels)
+
+def get_windows(fmap, kernel_size, strides, output_size):
+    """ Return the strided input windows of a convolution.
+
+    Args:
+        fmap: The input feature map with the shape (C, X, Y).
+        kernel_size: The kernel size (K0, K1).
+        strides: The strides (strideX, strideY).
+        output_size: The number of outputs (X, Y).
+
+    Returns:
+        A read-only view with the shape (C, X, Y, K0, K1). Positions outside of
+        the feature map are filled with 1.
+    """
+    fmap = np.asarray(fmap, dtype=np.int64)
+    channels = fmap.shape[0]
+    pad_x = math.floor(kernel_size[0]/2)
+    pad_y = math.floor(kernel_size[1]/2)
+    size_x = (output_size[0] - 1) * strides[0] + kernel_size[0]
+    size_y = (output_size[1] - 1) * strides[1] + kernel_size[1]
+
+    # Only the area covered by output * stride is read from the feature map
+    valid_x = min(fmap.shape[1], output_size[0] * strides[0], size_x - pad_x)
+    valid_y = min(fmap.shape[2], output_size[1] * strides[1], size_y - pad_y)
+
+    padded = np.ones((channels, size_x, size_y), dtype=np.int64)
+    padded[:, pad_x:pad_x + valid_x, pad_y:pad_y + valid_y] = fmap[:, :valid_x, :valid_y]
+
+    windows = np.lib.stride_tricks.sliding_window_view(padded, tuple(kernel_size), axis=(1, 2))
+    return windows[:, ::strides[0], ::strides[1]][:, :output_size[0], :output_size[1]]
+
+def get_kernel_y_order(kernel_size):
+    """ Return the order of the kernel columns as used by the scalar model.
+
+    The weight column is addressed with y + floor((K1-1)/2), which wraps
+    around for even kernel sizes.
+    """
+    offsets = np.arange(kernel_size[1]) - math.floor(kernel_size[1]/2) + math.floor((kernel_size[1]-1)/2)
+    return offsets % kernel_size[1]
+
+def conv2d(fmap, weights, bias, kernel_size, strides, output_size):
+    """ Compute a 2D convolution with im2col and one int64 matrix product.
+
+    Args:
+        fmap: The input feature map with the shape (C, X, Y).
+        weights: The weights with the shape (C, F, K0, K1).
+        bias: The bias with the shape (F,).
+        kernel_size: The kernel size (K0, K1).
+        strides: The strides (strideX, strideY).
+        output_size: The number of outputs (X, Y).
+
+    Returns:
+        The results as int64 ndarray with the shape (F, X, Y).
+    """
+    weights = np.asarray(weights, dtype=np.int64)[..., get_kernel_y_order(kernel_size)]
+    windows = get_windows(fmap, kernel_size, strides, output_size)
+    results = np.tensordot(windows, weights, axes=([0, 3, 4], [0, 2, 3]))
+    return np.ascontiguousarray(np.moveaxis(results, 2, 0)) + np.asarray(bias, dtype=np.int64)[:, None, None]
+
+def depthwise_conv2d(fmap, weights, bias, kernel_size, strides, output_size):
+    """ Compute a depthwise 2D convolution on strided windows per channel.
+
+    Args:
+        fmap: The input feature map with the shape (C, X, Y).
+        weights: The weights with the shape (C, K0, K1).
+        bias: The bias with the shape (C,).
+        kernel_size: The kernel size (K0, K1).
+        strides: The strides (strideX, strideY).
+        output_size: The number of outputs (X, Y).
+
+    Returns:
+        The results as int64 ndarray with the shape (C, X, Y).
+    """
+    weights = np.asarray(weights, dtype=np.int64)[..., get_kernel_y_order(kernel_size)]
+    windows = get_windows(fmap, kernel_size, strides, output_size)
+    return np.einsum('cxyij,cij->cxy', windows, weights) + np.asarray(bias, dtype=np.int64)[:, None, None]
+
+def dense(fmap, weights, bias):
+    """ Compute a fully connected layer as one int64 matrix product.
+
+    Args:
+        fmap: The input vector with the shape (I,) or a batch of input
+            vectors with the shape (B, I).
+        weights: The weights with the shape (O, I).
+        bias: The bias with the shape (O,).
+
+    Returns:
+        The results as int64 ndarray with the shape (O,) or (B, O).
+    """
+    weights = np.asarray(weights, dtype=np.int64)
+    return np.asarray(fmap, dtype=np.int64) @ weights.T + np.asarray(bias, dtype=np.int64)
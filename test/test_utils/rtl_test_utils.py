@@ -6,17 +6,34 @@
 import os
 import logging
 import math
+import numpy as np
 import cocotb
-from cocotb.triggers import Timer
-import test_utils.stream_dicts as strdic
+from cocotb.triggers import Timer, Edge, First
+from cocotb.utils import get_sim_time, get_sim_steps
+import test_utils.bit_fields as bit_fields
+import test_utils.psum_capture as psum_capture
+import test_utils.dma_image as dma_image
+from test_utils.input_scheduler import get_input_scheduler
+from test_utils.stream import get_lane_bits
 
 logger = logging.getLogger("cocotb")
 
+# The waits for the DUT fail after WATCHDOG_FACTOR times the expected cycles of a layer repetition, 0 disables them
+WATCHDOG_MIN_CYCLES = 10000
+try:
+    watchdog_factor = int(os.getenv("WATCHDOG_FACTOR"))
+except:
+    logger.warning("WATCHDOG_FACTOR not given. Setting to 16.")
+    watchdog_factor = 16
 
-async def set_input(port_timings, signal, new_value, multiple_dim = False, array_index = [], array_max_index = []):
-    # input delay of 100 ps relative to rising edge
-    # this is the value used for the implementation constraints of OpenEye
-    await Timer(port_timings.clk_delay_in, units=port_timings.clk_delay_unit_in)
+
+def set_input(port_timings, signal, new_value, multiple_dim = False, array_index = [], array_max_index = []):
+    """ Write new_value to an input of the DUT with the input delay after the rising edge.
+
+    The write is queued in the InputScheduler of the clock domain, which
+    applies all writes of a cycle after a single input delay (100 ps in the
+    testbenches, the value used for the implementation constraints of OpenEye).
+    """
     if(multiple_dim):
         if(cocotb.SIM_NAME == "Icarus Verilog"):
             array_max_index = list(reversed(array_max_index))
@@ -33,58 +50,66 @@ async def set_input(port_timings, signal, new_value, multiple_dim = False, array
         else:
             for current_index in range(len(array_index)):
                 signal = signal[array_index[current_index]]
-    signal.value = new_value
+    get_input_scheduler(port_timings).set(signal, new_value)
     
+def get_router_mode_port(router_mode, routers, bits):
+    """ Pack the router modes [cl_x][cl_y][router] into the value of the router mode port. """
+    return bit_fields.pack_int(np.asarray(router_mode)[:, :, :routers].reshape(-1), bits)
+
 async def reset_all_signals(ptp, dut, serial):
     """ Reset all signals of the DUT.
 
     This function resets all signals of the DUT. It is called by the testbench.
     """
-    cocotb.start_soon(set_input(ptp,(dut.rst_ni), 0))
+    set_input(ptp,(dut.rst_ni), 0)
     if(serial == 0):
-        cocotb.start_soon(set_input(ptp,(dut.compute_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.wght_data_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.wght_enable_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.iact_data_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.iact_enable_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.psum_data_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.psum_enable_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.psum_ready_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.status_reg_enable_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.data_mode_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.fraction_bit_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.needed_cycles_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.needed_x_cls_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.needed_y_cls_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.needed_iact_cycles_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.filters_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.iact_addr_len_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.wght_addr_len_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.bano_cluster_mode_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.af_cluster_mode_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.pooling_cluster_mode_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.input_activations_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.iact_write_addr_t_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.iact_write_data_t_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.stride_x_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.stride_y_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.compute_mask_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.router_mode_iact_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.router_mode_wght_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.router_mode_psum_i), 0))
+        set_input(ptp,(dut.compute_i), 0)
+        set_input(ptp,(dut.wght_data_i), 0)
+        set_input(ptp,(dut.wght_enable_i), 0)
+        set_input(ptp,(dut.iact_data_i), 0)
+        set_input(ptp,(dut.iact_enable_i), 0)
+        set_input(ptp,(dut.psum_data_i), 0)
+        set_input(ptp,(dut.psum_enable_i), 0)
+        set_input(ptp,(dut.psum_ready_i), 0)
+        set_input(ptp,(dut.status_reg_enable_i), 0)
+        set_input(ptp,(dut.data_mode_i), 0)
+        set_input(ptp,(dut.fraction_bit_i), 0)
+        set_input(ptp,(dut.needed_cycles_i), 0)
+        set_input(ptp,(dut.needed_x_cls_i), 0)
+        set_input(ptp,(dut.needed_y_cls_i), 0)
+        set_input(ptp,(dut.needed_iact_cycles_i), 0)
+        set_input(ptp,(dut.filters_i), 0)
+        set_input(ptp,(dut.iact_addr_len_i), 0)
+        set_input(ptp,(dut.wght_addr_len_i), 0)
+        set_input(ptp,(dut.bano_cluster_mode_i), 0)
+        set_input(ptp,(dut.af_cluster_mode_i), 0)
+        set_input(ptp,(dut.pooling_cluster_mode_i), 0)
+        set_input(ptp,(dut.input_activations_i), 0)
+        set_input(ptp,(dut.iact_write_addr_t_i), 0)
+        set_input(ptp,(dut.iact_write_data_t_i), 0)
+        set_input(ptp,(dut.stride_x_i), 0)
+        set_input(ptp,(dut.stride_y_i), 0)
+        set_input(ptp,(dut.compute_mask_i), 0)
+        set_input(ptp,(dut.router_mode_iact_i), 0)
+        set_input(ptp,(dut.router_mode_wght_i), 0)
+        set_input(ptp,(dut.router_mode_psum_i), 0)
     else:
-        cocotb.start_soon(set_input(ptp,(dut.data_dma_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.enable_dma_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.ready_dma_i), 0))
+        set_input(ptp,(dut.data_dma_i), 0)
+        set_input(ptp,(dut.enable_dma_i), 0)
+        set_input(ptp,(dut.ready_dma_i), 0)
 
     for _ in range(3):
         await Timer(ptp.clk_cycle, ptp.clk_cycle_unit)
-    cocotb.start_soon(set_input(ptp,(dut.rst_ni), 1))
+    set_input(ptp,(dut.rst_ni), 1)
 
     # After deasserting reset, we wait 4 clock cycles
     for _ in range(4):
         await Timer(ptp.clk_cycle, ptp.clk_cycle_unit)
 
+def set_router_mode_wght(ptp, dut, status, oep):
+    """ Drive the wght router mode of a status, the DUT takes it over in every idle cycle. """
+    set_input(ptp,(dut.router_mode_wght_i), get_router_mode_port(status.router_wght, oep.NUM_GLB_WGHT, oep.Wght_Router_Bits))
+
 async def send_stream(ptp, dut, stream, oep, lp, layer_repetition):
     """ Send the stream to the DUT. 
     
@@ -101,81 +126,62 @@ async def send_stream(ptp, dut, stream, oep, lp, layer_repetition):
     """
     if (oep.SERIAL == 0):
         # Set the input signals
-        cocotb.start_soon(set_input(ptp,(dut.status_reg_enable_i), 1))
-        cocotb.start_soon(set_input(ptp,(dut.data_mode_i), stream[strdic.stream_parallel_dict["status"]][strdic.status_dict["data_mode"]]))
-        cocotb.start_soon(set_input(ptp,(dut.fraction_bit_i), stream[strdic.stream_parallel_dict["status"]][strdic.status_dict["realfactor"]]))
-        cocotb.start_soon(set_input(ptp,(dut.needed_cycles_i), stream[strdic.stream_parallel_dict["status"]][strdic.status_dict["needed_refreshes"]]))
-        cocotb.start_soon(set_input(ptp,(dut.needed_x_cls_i), stream[strdic.stream_parallel_dict["status"]][strdic.status_dict["used_X_cluster"]]))
-        cocotb.start_soon(set_input(ptp,(dut.needed_y_cls_i), stream[strdic.stream_parallel_dict["status"]][strdic.status_dict["used_Y_cluster"]]))
-        cocotb.start_soon(set_input(ptp,(dut.needed_iact_cycles_i), stream[strdic.stream_parallel_dict["status"]][strdic.status_dict["needed_Iact_writes"]]))
-        cocotb.start_soon(set_input(ptp,(dut.filters_i), stream[strdic.stream_parallel_dict["status"]][strdic.status_dict["used_psum_per_PE"]]))
-        cocotb.start_soon(set_input(ptp,(dut.iact_addr_len_i), stream[strdic.stream_parallel_dict["status"]][strdic.status_dict["used_iact_addr_per_PE"]]))
-        cocotb.start_soon(set_input(ptp,(dut.wght_addr_len_i), stream[strdic.stream_parallel_dict["status"]][strdic.status_dict["used_wght_addr_per_PE"]]))
-        cocotb.start_soon(set_input(ptp,(dut.bano_cluster_mode_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.af_cluster_mode_i), stream[strdic.stream_parallel_dict["status"]][strdic.status_dict["autofunction"]]))
-        cocotb.start_soon(set_input(ptp,(dut.pooling_cluster_mode_i), stream[strdic.stream_parallel_dict["status"]][strdic.status_dict["poolingmode"]]))
-        cocotb.start_soon(set_input(ptp,(dut.delay_psum_glb_i), stream[strdic.stream_parallel_dict["status"]][strdic.status_dict["psum_delay"]]))
-        cocotb.start_soon(set_input(ptp,(dut.input_activations_i), stream[strdic.stream_parallel_dict["status"]][strdic.status_dict["used_iact_per_PE"]]))
-        cocotb.start_soon(set_input(ptp,(dut.iact_write_addr_t_i), stream[strdic.stream_parallel_dict["status"]][strdic.status_dict["iact_addr_len"]]))
-        cocotb.start_soon(set_input(ptp,(dut.iact_write_data_t_i), stream[strdic.stream_parallel_dict["status"]][strdic.status_dict["iact_data_len"]]))
-        cocotb.start_soon(set_input(ptp,(dut.stride_x_i), stream[strdic.stream_parallel_dict["status"]][strdic.status_dict["strideX"]]))
-        cocotb.start_soon(set_input(ptp,(dut.stride_y_i), stream[strdic.stream_parallel_dict["status"]][strdic.status_dict["strideY"]]))
-        cocotb.start_soon(set_input(ptp,(dut.compute_mask_i), stream[strdic.stream_parallel_dict["status"]][strdic.status_dict["usePEs"]]))
+        set_input(ptp,(dut.status_reg_enable_i), 1)
+        set_input(ptp,(dut.data_mode_i), stream.status.data_mode)
+        set_input(ptp,(dut.fraction_bit_i), stream.status.realfactor)
+        set_input(ptp,(dut.needed_cycles_i), stream.status.needed_refreshes)
+        set_input(ptp,(dut.needed_x_cls_i), stream.status.used_X_cluster)
+        set_input(ptp,(dut.needed_y_cls_i), stream.status.used_Y_cluster)
+        set_input(ptp,(dut.needed_iact_cycles_i), stream.status.needed_Iact_writes)
+        set_input(ptp,(dut.filters_i), stream.status.used_psum_per_PE)
+        set_input(ptp,(dut.iact_addr_len_i), stream.status.used_iact_addr_per_PE)
+        set_input(ptp,(dut.wght_addr_len_i), stream.status.used_wght_addr_per_PE)
+        set_input(ptp,(dut.bano_cluster_mode_i), 0)
+        set_input(ptp,(dut.af_cluster_mode_i), stream.status.autofunction)
+        set_input(ptp,(dut.pooling_cluster_mode_i), stream.status.poolingmode)
+        set_input(ptp,(dut.delay_psum_glb_i), stream.status.psum_delay)
+        set_input(ptp,(dut.input_activations_i), stream.status.used_iact_per_PE)
+        set_input(ptp,(dut.iact_write_addr_t_i), stream.status.iact_addr_len)
+        set_input(ptp,(dut.iact_write_data_t_i), stream.status.iact_data_len)
+        set_input(ptp,(dut.stride_x_i), stream.status.strideX)
+        set_input(ptp,(dut.stride_y_i), stream.status.strideY)
+        set_input(ptp,(dut.compute_mask_i), stream.status.usePEs)
         
         # Set the router mode for the input activations
-        router_mode_port = 0
-        for cl_x in range(oep.Clusters_X):
-            for cl_y in range(oep.Clusters_Y):
-                for router in range(oep.NUM_GLB_IACT):
-                    router_mode_port = router_mode_port + (stream[strdic.stream_parallel_dict["status"]][strdic.status_dict["router_iact"]][cl_x][cl_y][router] << \
-                                                        (oep.Iact_Router_Bits * router + \
-                                                            oep.Iact_Router_Bits * oep.NUM_GLB_IACT * cl_y + \
-                                                            oep.Iact_Router_Bits * oep.NUM_GLB_IACT * oep.Clusters_Y * cl_x))
-        cocotb.start_soon(set_input(ptp,(dut.router_mode_iact_i), router_mode_port))
+        router_mode_port = get_router_mode_port(stream.status.router_iact, oep.NUM_GLB_IACT, oep.Iact_Router_Bits)
+        set_input(ptp,(dut.router_mode_iact_i), router_mode_port)
         
         # Set the router mode for the weights
-        router_mode_port = 0
-        for cl_x in range(oep.Clusters_X):
-            for cl_y in range(oep.Clusters_Y):
-                for router in range(oep.NUM_GLB_WGHT):
-                    router_mode_port = router_mode_port + (stream[strdic.stream_parallel_dict["status"]][strdic.status_dict["router_wght"]][cl_x][cl_y][router] << \
-                                                        (oep.Wght_Router_Bits * router + \
-                                                            oep.Wght_Router_Bits * oep.NUM_GLB_WGHT * cl_y + \
-                                                            oep.Wght_Router_Bits * oep.NUM_GLB_WGHT * oep.Clusters_Y * cl_x))
-        cocotb.start_soon(set_input(ptp,(dut.router_mode_wght_i), router_mode_port))
+        set_router_mode_wght(ptp, dut, stream.status, oep)
         
         # Set the router mode for the partial sums
-        router_mode_port = 0
-        for cl_x in range(oep.Clusters_X):
-            for cl_y in range(oep.Clusters_Y):
-                for router in range(oep.NUM_GLB_PSUM):
-                    router_mode_port = router_mode_port + (stream[strdic.stream_parallel_dict["status"]][strdic.status_dict["router_psum"]][cl_x][cl_y][router] << \
-                                                        (oep.Psum_Router_Bits * router + \
-                                                            oep.Psum_Router_Bits * oep.NUM_GLB_PSUM * cl_y + \
-                                                            oep.Psum_Router_Bits * oep.NUM_GLB_PSUM * oep.Clusters_Y * cl_x))
-        cocotb.start_soon(set_input(ptp,(dut.router_mode_psum_i), router_mode_port))
-        router_mode_port = 0
+        router_mode_port = get_router_mode_port(stream.status.router_psum, oep.NUM_GLB_PSUM, oep.Psum_Router_Bits)
+        set_input(ptp,(dut.router_mode_psum_i), router_mode_port)
         # Wait until the status register and the router mode are set
         await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
-        cocotb.start_soon(set_input(ptp,(dut.status_reg_enable_i), 0))
+        set_input(ptp,(dut.status_reg_enable_i), 0)
     else:
-        cocotb.start_soon(set_input(ptp,(dut.enable_dma_i), 1))
-        for data_word in range(len(stream[strdic.stream_parallel_dict["status"]])):
-            cocotb.start_soon(set_input(ptp,(dut.data_dma_i), stream[strdic.stream_parallel_dict["status"]][data_word]))
-            await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
-        for data_word in range(len(stream[strdic.stream_parallel_dict["iact"]])):
-            cocotb.start_soon(set_input(ptp,(dut.data_dma_i), stream[strdic.stream_parallel_dict["iact"]][data_word]))
-            await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
-        for data_word in range(len(stream[strdic.stream_parallel_dict["wght"]])):
-            cocotb.start_soon(set_input(ptp,(dut.data_dma_i), stream[strdic.stream_parallel_dict["wght"]][data_word]))
-            await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
-        for data_word in range(len(stream[strdic.stream_parallel_dict["psum"]])):
-            cocotb.start_soon(set_input(ptp,(dut.data_dma_i), stream[strdic.stream_parallel_dict["psum"]][data_word]))
-            await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
+        await send_dma_words(ptp, dut, (data_word for port in (stream.status, stream.iact, stream.wght, stream.psum) for data_word in port.words()))
+
+async def send_dma_words(ptp, dut, data_words):
+    """ Send DMA words to the serial interface of the DUT, one word per clock cycle. """
+    set_input(ptp,(dut.enable_dma_i), 1)
+    for data_word in data_words:
+        set_input(ptp,(dut.data_dma_i), data_word)
         await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
-        cocotb.start_soon(set_input(ptp,(dut.enable_dma_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.ready_dma_i), 1))
+    await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
+    set_input(ptp,(dut.enable_dma_i), 0)
+    set_input(ptp,(dut.ready_dma_i), 1)
+
+async def replay_dma_image(ptp, dut, image):
+    """ Send a DMAImage to the serial interface of the DUT.
+
+    The words are read from the memory map of the image, it behaves like
+    send_stream with the stream the image was written from.
+    """
+    await send_dma_words(ptp, dut, image.chunks())
         
+
 async def write_iact(ptp, dut, stream, oep, lp):
     """ Write the input activations to the DUT.
     
@@ -183,32 +189,18 @@ async def write_iact(ptp, dut, stream, oep, lp):
     
     Args:
         dut: The DUT. 
-        stream: The stream that is sent to the DUT.
+        stream: The PortStream that is sent to the DUT.
         layer_repetition: The index of the part of a layer, if it is too large to be processed at once.
         oep: The OpenEye parameters.
         lp: The layer parameters.
     """
-    iact_enable_signal = 0
-    iact_transmission = 0
     if(lp.skipIact != 1):
-        for position in range(len(stream[0][0][0])):
-            iact_enable_signal = 0
-            for x_cluster in range(oep.Clusters_X):
-                for y_cluster in range(oep.Clusters_Y):
-                    for router in range(oep.NUM_GLB_IACT):
-                        try:
-                            iact_transmission = iact_transmission + \
-                            (stream[x_cluster][y_cluster][router][position] \
-                            << ((router + y_cluster * oep.NUM_GLB_IACT + x_cluster * oep.NUM_GLB_WGHT * oep.Clusters_Y) * int(oep.DMA_Bits/oep.Clusters_X)))
-                            iact_enable_signal = iact_enable_signal + 2**(router + y_cluster * oep.NUM_GLB_IACT+ x_cluster * oep.NUM_GLB_IACT * oep.Clusters_Y)
-                        except:
-                            iact_enable_signal = iact_enable_signal
-            cocotb.start_soon(set_input(ptp,(dut.iact_data_i), iact_transmission))
-            iact_transmission = 0
-            cocotb.start_soon(set_input(ptp,(dut.iact_enable_i), iact_enable_signal))
+        for iact_transmission, iact_enable_signal in stream.bus_cycles(get_lane_bits(oep, "iact")):
+            set_input(ptp,(dut.iact_data_i), iact_transmission)
+            set_input(ptp,(dut.iact_enable_i), iact_enable_signal)
             await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
-        cocotb.start_soon(set_input(ptp,(dut.iact_data_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.iact_enable_i), 0))
+        set_input(ptp,(dut.iact_data_i), 0)
+        set_input(ptp,(dut.iact_enable_i), 0)
 
 async def write_wght(ptp, dut, stream, oep, lp):
     """ Write the weights to the DUT.
@@ -217,33 +209,19 @@ async def write_wght(ptp, dut, stream, oep, lp):
     
     Args:
         dut: The DUT.
-        stream: The stream that is sent to the DUT.
+        stream: The PortStream that is sent to the DUT.
         layer_repetition: The index of the part of a layer, if it is too large to be processed at once.
         oep: The OpenEye parameters.
         lp: The layer parameters.
     """
-    wght_enable_signal = 0
-    wght_transmission = 0
     if(lp.skipWght != 1):
-        cocotb.start_soon(set_input(ptp,(dut.wght_enable_i), (2**(oep.Clusters_X*oep.Clusters_Y*oep.NUM_GLB_WGHT))-1))
-        for position in range(len(stream[0][0][0])):
-            wght_enable_signal = 0
-            for x_cluster in range(oep.Clusters_X):
-                for y_cluster in range(oep.Clusters_Y):
-                    for router in range(oep.NUM_GLB_WGHT):
-                        try:
-                            wght_transmission = wght_transmission + \
-                            (stream[x_cluster][y_cluster][router][position] \
-                            << ((router + y_cluster * oep.NUM_GLB_WGHT + x_cluster * oep.NUM_GLB_WGHT * oep.Clusters_Y) * int(oep.DMA_Bits/oep.Clusters_X)))
-                            wght_enable_signal = wght_enable_signal + 2**(router + y_cluster * oep.NUM_GLB_WGHT+ x_cluster * oep.NUM_GLB_WGHT * oep.Clusters_Y)
-                        except:
-                            wght_enable_signal = wght_enable_signal
-            cocotb.start_soon(set_input(ptp,(dut.wght_data_i), wght_transmission))
-            wght_transmission = 0
-            cocotb.start_soon(set_input(ptp,(dut.wght_enable_i), wght_enable_signal))
+        set_input(ptp,(dut.wght_enable_i), (2**(oep.Clusters_X*oep.Clusters_Y*oep.NUM_GLB_WGHT))-1)
+        for wght_transmission, wght_enable_signal in stream.bus_cycles(get_lane_bits(oep, "wght")):
+            set_input(ptp,(dut.wght_data_i), wght_transmission)
+            set_input(ptp,(dut.wght_enable_i), wght_enable_signal)
             await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
-        cocotb.start_soon(set_input(ptp,(dut.wght_data_i), 0))
-        cocotb.start_soon(set_input(ptp,(dut.wght_enable_i), 0))
+        set_input(ptp,(dut.wght_data_i), 0)
+        set_input(ptp,(dut.wght_enable_i), 0)
 
 async def write_bias(ptp, dut, stream, oep, lp):
     """ Write the bias to the DUT.
@@ -254,37 +232,95 @@ async def write_bias(ptp, dut, stream, oep, lp):
 
     Args:
         dut: The DUT.
-        stream: The stream that is sent to the DUT.
+        stream: The PortStream that is sent to the DUT.
         layer_repetition: The index of the part of a layer, if it is too large to be processed at once.
         oep: The OpenEye parameters.
         lp: The layer parameters.
 
     """
-    psum_transmission = 0
-    cocotb.start_soon(set_input(ptp,(dut.psum_enable_i), (2**(oep.Clusters_X*oep.Clusters_Y*oep.NUM_GLB_PSUM))-1))
-    for position in range(len(stream[0][0][0])):
-        for x_cluster in range(oep.Clusters_X):
-            for y_cluster in range(oep.Clusters_Y):
-                for router in range(oep.NUM_GLB_PSUM):
-                    psum_transmission = psum_transmission + \
-                    (stream[x_cluster][y_cluster][router][position] \
-                    << ((router + y_cluster * oep.NUM_GLB_PSUM + x_cluster * oep.NUM_GLB_PSUM * oep.Clusters_Y) * oep.DMA_Bits))
-        cocotb.start_soon(set_input(ptp,(dut.psum_data_i), psum_transmission))
-        psum_transmission = 0
+    set_input(ptp,(dut.psum_enable_i), (2**(oep.Clusters_X*oep.Clusters_Y*oep.NUM_GLB_PSUM))-1)
+    for psum_transmission, _ in stream.bus_cycles(get_lane_bits(oep, "psum")):
+        set_input(ptp,(dut.psum_data_i), psum_transmission)
         await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
-    cocotb.start_soon(set_input(ptp,(dut.psum_data_i), 0))
-    cocotb.start_soon(set_input(ptp,(dut.psum_enable_i), 0))
+    set_input(ptp,(dut.psum_data_i), 0)
+    set_input(ptp,(dut.psum_enable_i), 0)
+
+def get_watchdog_cycles(lp, layer_repetition, stream):
+    """ Return the number of cycles a wait for the DUT may take in a layer repetition.
+
+    The expected length is the number of cycles of the stream, a Stream or
+    the DMAImage it was replayed from, and one cycle per weight of a PE for
+    every refresh of the repetition.
+    """
+    if(watchdog_factor == 0):
+        return None
+    if isinstance(stream, dma_image.DMAImage):
+        stream_cycles = len(stream)
+    else:
+        stream_cycles = sum(getattr(getattr(stream, name, None), "cycles", 0) for name in ("status", "iact", "wght", "psum"))
+    try:
+        refreshes = max(1, int(lp.needed_refreshes_mx[layer_repetition][0]))
+    except (TypeError, IndexError):
+        refreshes = 1
+    expected_cycles = stream_cycles + refreshes * int(lp.used_wght_per_PE) + int(getattr(lp, "psum_delay", 0))
+    return max(WATCHDOG_MIN_CYCLES, watchdog_factor * expected_cycles)
+
+async def await_value(ptp, signal, condition, max_cycles, description):
+    """ Await the first clock cycle in which condition(signal.value) holds.
+
+    Instead of polling the signal every clock cycle, the coroutine sleeps
+    until the signal changes. The condition is only checked at the phase of
+    the clock the polling checked it at: after a change of the signal, it
+    resumes with a Timer at the next such point. A change right at this point
+    is seen one cycle later, as by the polling. If the condition does not
+    hold after max_cycles (None waits forever), the hang is reported with a
+    TimeoutError.
+    """
+    clk_steps = get_sim_steps(ptp.clk_cycle, ptp.clk_cycle_unit)
+    start = get_sim_time("step")
+    deadline = None if max_cycles is None else start + max_cycles * clk_steps
+    while not condition(signal.value):
+        now = get_sim_time("step")
+        if (deadline is None):
+            await Edge(signal)
+        elif (now >= deadline):
+            message = "Timeout after " + str(max_cycles) + " cycles: " + description + ", " + signal._name + " is " + str(signal.value)
+            logger.error(message)
+            raise TimeoutError(message)
+        else:
+            timeout = Timer(deadline - now, units="step")
+            if (await First(Edge(signal), timeout)) is timeout:
+                # The deadline is a point of the polling, check the condition there
+                continue
+        remaining = (start - get_sim_time("step")) % clk_steps
+        await Timer(remaining or clk_steps, units="step")
 
 async def await_ready_signal(ptp, dut, layer_number, model, layer_repetition, layer_parameters, oep, les, dram, login_level, stream):
+    max_cycles = get_watchdog_cycles(layer_parameters, layer_repetition, stream)
     if (oep.SERIAL == 0):
-        while (dut.psum_ready_o.value != (2**(oep.Clusters_X*oep.Clusters_Y*oep.NUM_GLB_PSUM))-1):
-            await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
+        psum_ready = (2**(oep.Clusters_X*oep.Clusters_Y*oep.NUM_GLB_PSUM))-1
+        await await_value(ptp, dut.psum_ready_o, lambda value: value == psum_ready, max_cycles,
+                          "layer " + str(layer_number) + " repetition " + str(layer_repetition) + " is not ready")
     else:
-        cocotb.start_soon(set_input(ptp,(dut.ready_dma_i), 1))
-        while (dut.enable_dma_o.value != 1):
-            await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
+        set_input(ptp,(dut.ready_dma_i), 1)
+        await await_value(ptp, dut.enable_dma_o, lambda value: value == 1, max_cycles,
+                          "layer " + str(layer_number) + " repetition " + str(layer_repetition) + " is not ready")
     pass
 
+def scatter_output(plan, fmap, words, bus_bits, les, login_level, txt_file = None, storage_file = None):
+    """ Write the captured output words to fmap with the ScatterPlan of the drain.
+
+    The start of the next output position is kept in les, the f, x and y
+    after the last word are returned.
+    """
+    state = plan.scatter(fmap, words, bus_bits)
+    if(logging.DEBUG >= login_level):
+        plan.write_debug(txt_file, storage_file, words, bus_bits)
+    les.f_start = state["f_start"]
+    les.x_start = state["x_start"]
+    les.y_start = state["y_start"]
+    return state["f"], state["x"], state["y"]
+
 async def compare_stream_Conv(ptp, dut, layer_number, model, layer_repetition, layer_parameters, oep, les, dram, login_level, stream):
     """ Await the output stream and compare it to the reference output.
 
@@ -333,105 +369,36 @@ async def compare_stream_Conv(ptp, dut, layer_number, model, layer_repetition, l
         storage_file.write(" f_corner_start: " + str(les.f_corner_start) + " y_corner_start: " + str(les.y_corner_start) + " x_corner_start: " + str(les.x_corner_start) + "\n")
     if (oep.SERIAL == 0) :
         if ((layer_repetition % layer_parameters.iact_transmissions_pe) == (layer_parameters.iact_transmissions_pe - 1)):
+            plan = psum_capture.get_plan_Conv(oep, layer_parameters, les, f, x, y, psum_capture.get_enable_cycles_conv(layer_parameters, layer_repetition))
             cocotb.start_soon(send_enable_conv(ptp, dut, layer_parameters, layer_repetition, oep))
-            while (dut.psum_enable_o.value == 0):
-                await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
+            await await_value(ptp, dut.psum_enable_o, lambda value: value != 0, get_watchdog_cycles(layer_parameters, layer_repetition, stream),
+                              "output stream of layer " + str(layer_number) + " repetition " + str(layer_repetition) + " does not start")
             dut._log.info("Output Stream started")
             assert dut.psum_enable_o.value != 0, "psum is not 1!"
+            words = []
             while (dut.psum_enable_o.value != 0):
-                cluster_order = []
-                for a in range(layer_parameters.used_Y_cluster):
-                    for b in range(0,oep.Clusters_Y,layer_parameters.used_Y_cluster):
-                        cluster_order.append(a+b)
-                for y_cluster in reversed(cluster_order):
-                    for x_cluster in reversed(range(oep.Clusters_X)):
-                        for router in reversed(range(oep.NUM_GLB_PSUM)):
-                            if(layer_parameters.computing_mx[oep.Clusters_X-x_cluster-1][oep.Clusters_Y-y_cluster-1][0][oep.NUM_GLB_PSUM-router-1]== 1):
-                                lower_limit = (x_cluster * oep.Clusters_Y * oep.NUM_GLB_PSUM * 40 + y_cluster * oep.NUM_GLB_PSUM * 40 + router * 40)
-                                upper_limit = lower_limit + 39
-                                outputvalue = dut.psum_data_o.value[lower_limit:upper_limit]
-                                if(logging.DEBUG >= login_level):
-                                    txt_file.write(bin(outputvalue)[2:].zfill(40) + "\n")
-                                for i in range(2):
-                                    if(logging.DEBUG >= login_level):
-                                        storage_file.write("f: " + str(f) + " x: " + str(x) + " y: " + str(y) + "\n")
-                                    try:
-                                        dram.fmap[layer_number + 1][f][x][y] = int(dut.psum_data_o.value[lower_limit+20*(1-i):upper_limit-20*i])
-                                        if (dram.fmap[layer_number + 1][f][x][y] >= 2**19) :
-                                            dram.fmap[layer_number + 1][f][x][y] = dram.fmap[layer_number + 1][f][x][y] - 2**20
-                                    except:
-                                        pass
-                                    f = f + 1
-                                if((y_cluster == 0) and (x_cluster == 0) and (router == layer_parameters.add_up)):
-                                    if(f >= les.f_end):
-                                        les.f_start = les.f_corner_start
-                                        f = les.f_start
-                                        if(x == les.x_end - 1):
-                                            x = 0
-                                            if(y >= les.y_end - 1):
-                                                y = 0
-                                            else:
-                                                y = y + 1
-                                        else:
-                                            x = x + 1
-                                        les.y_start = y
-                                        les.x_start = x
-                                    else:
-                                        les.f_start = f
-                                        x = les.x_start
-                                        y = les.y_start
-                                else:
-                                    f = f - 2
-                                    if(x == les.x_end - 1):
-                                        x = 0
-                                        y = y + 1
-                                    else:
-                                        x = x + 1
+                words.append(psum_capture.read_word(dut.psum_data_o))
                 await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
+            f, x, y = scatter_output(plan, dram.fmap[layer_number + 1], words, len(dut.psum_data_o), les, login_level, txt_file, storage_file)
         await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
-        cocotb.start_soon(set_input(ptp,(dut.psum_enable_i), 0))
+        set_input(ptp,(dut.psum_enable_i), 0)
         dut._log.info("Output Stream finished")
         await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
-        cocotb.start_soon(set_input(ptp,(dut.status_reg_enable_i), 1))
+        set_input(ptp,(dut.status_reg_enable_i), 1)
         await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
     else:
         dut._log.info("Output Stream started")
+        capture = ((layer_repetition % layer_parameters.iact_transmissions_pe) == (layer_parameters.iact_transmissions_pe - 1))
+        words = []
         while (dut.enable_dma_o.value == 1):
-
-            if ((layer_repetition % layer_parameters.iact_transmissions_pe) == (layer_parameters.iact_transmissions_pe - 1)) :
-                if(logging.DEBUG >= login_level):
-                    txt_file.write(bin(int(dut.data_dma_o.value))[2:].zfill(40) + "\n")
-                for i in range(2):
-
-                    if(logging.DEBUG >= login_level):
-                        storage_file.write("f: " + str(f) + " x: " + str(x) + " y: " + str(y) + "\n")
-                    try:
-                        dram.fmap[layer_number + 1][f][x][y] = int(dut.data_dma_o.value[28-20*i:47-20*i])
-                        if (dram.fmap[layer_number + 1][f][x][y] >= 2**19) :
-                            dram.fmap[layer_number + 1][f][x][y] = dram.fmap[layer_number + 1][f][x][y] - 2**20
-                    except:
-                        pass
-                    f = f + 1
-                if(f >= les.f_end):
-                    les.f_start = les.f_corner_start
-                    f = les.f_start
-                    if(x == les.x_end - 1):
-                        x = 0
-                        if(y >= les.y_end - 1):
-                            y = 0
-                        else:
-                            y = y + 1
-                    else:
-                        x = x + 1
-                    les.y_start = y
-                    les.x_start = x
-                else:
-                    les.f_start = f
-                    x = les.x_start
-                    y = les.y_start
+            if (capture):
+                words.append(psum_capture.read_word(dut.data_dma_o))
             await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
+        if (capture):
+            plan = psum_capture.get_plan_Conv_serial(oep, les, f, x, y)
+            f, x, y = scatter_output(plan, dram.fmap[layer_number + 1], words, len(dut.data_dma_o), les, login_level, txt_file, storage_file)
 
-        cocotb.start_soon(set_input(ptp,(dut.ready_dma_i), 0))
+        set_input(ptp,(dut.ready_dma_i), 0)
 
     if(math.floor(layer_repetition%(layer_parameters.iact_transmissions_pe*layer_parameters.needed_wght_transmissions)) == \
         (layer_parameters.iact_transmissions_pe*layer_parameters.needed_wght_transmissions-1)):
@@ -488,48 +455,22 @@ async def compare_stream_Dw(ptp, dut, layer_number, model, layer_repetition, lay
     y = les.y_start
     if(logging.DEBUG >= login_level):
         storage_file.write(" f_corner_start: " + str(les.f_corner_start) + " y_corner_start: " + str(les.y_corner_start) + " x_corner_start: " + str(les.x_corner_start) + "\n")
+    plan = psum_capture.get_plan_Dw(oep, layer_parameters, les, f, x, y, psum_capture.get_enable_cycles_conv(layer_parameters, layer_repetition))
     cocotb.start_soon(send_enable_conv(ptp, dut, layer_parameters, layer_repetition, oep))
-    while (dut.psum_enable_o.value == 0):
-        await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
+    await await_value(ptp, dut.psum_enable_o, lambda value: value != 0, get_watchdog_cycles(layer_parameters, layer_repetition, stream),
+                      "output stream of layer " + str(layer_number) + " repetition " + str(layer_repetition) + " does not start")
     dut._log.info("Output Stream started")
     assert dut.psum_enable_o.value != 0, "psum is not 1!"
+    words = []
     while (dut.psum_enable_o.value != 0):
-        for y_cluster in reversed(range(oep.Clusters_Y)):
-            for x_cluster in reversed(range(oep.Clusters_X)):
-                for router in reversed(range(oep.NUM_GLB_PSUM)):
-                    if(layer_parameters.computing_mx[oep.Clusters_X-x_cluster-1][oep.Clusters_Y-y_cluster-1][0][oep.NUM_GLB_PSUM-router-1]== 1):
-                        lower_limit = (x_cluster * oep.Clusters_Y * oep.NUM_GLB_PSUM * 40 + y_cluster * oep.NUM_GLB_PSUM * 40 + router * 40)
-                        upper_limit = lower_limit + 39
-                        outputvalue = dut.psum_data_o.value[lower_limit:upper_limit]
-
-                        if(logging.DEBUG >= login_level):
-                            txt_file.write(bin(outputvalue)[2:].zfill(40) + "\n")
-                        for i in range(1):
-
-                            if(logging.DEBUG >= login_level):
-                                storage_file.write("f: " + str(f) + " x: " + str(x) + " y: " + str(y) + "\n")
-                            try:
-                                dram.fmap[layer_number + 1][f][x][y] = int(dut.psum_data_o.value[lower_limit+20*(1-i):upper_limit-20*i])
-                                if (dram.fmap[layer_number + 1][f][x][y] >= 2**19) :
-                                    dram.fmap[layer_number + 1][f][x][y] = dram.fmap[layer_number + 1][f][x][y] - 2**20
-                            except:
-                                pass
-
-                            x = x + 1
-                        if((y_cluster == 0) and (x_cluster == 0) and (router == layer_parameters.add_up)):
-                            if(x >= les.x_end):
-                                x = 0
-                                y = y + 1
-                        else:
-                            if(x >= les.x_end):
-                                x = 0
-                                y = y + 1
+        words.append(psum_capture.read_word(dut.psum_data_o))
         await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
+    f, x, y = scatter_output(plan, dram.fmap[layer_number + 1], words, len(dut.psum_data_o), les, login_level, txt_file, storage_file)
     await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
-    cocotb.start_soon(set_input(ptp,(dut.psum_enable_i), 0))
+    set_input(ptp,(dut.psum_enable_i), 0)
     dut._log.info("Output Stream finished")
     await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
-    cocotb.start_soon(set_input(ptp,(dut.status_reg_enable_i), 1))
+    set_input(ptp,(dut.status_reg_enable_i), 1)
     await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
     
     if(math.floor(layer_repetition%(layer_parameters.iact_transmissions_pe*layer_parameters.needed_wght_transmissions)) == \
@@ -575,48 +516,26 @@ async def compare_stream_Dense(ptp, dut, layer_number, model, layer_repetition,
     offset_layer_repetition = (math.floor(layer_repetition/layer_parameters.iact_transmissions_pe) % layer_parameters.psum_transmissions_pe) * oep.Clusters_Y * oep.Clusters_X * layer_parameters.used_psum_per_PE
     les.x = offset_layer_repetition
     router = 3
-    offset = 0
 
     if ((layer_repetition % layer_parameters.iact_transmissions_pe) == (layer_parameters.iact_transmissions_pe - 1)) :
+        plan = psum_capture.get_plan_Dense(oep, layer_parameters, offset_layer_repetition, router, values_per_trans, math.ceil(layer_parameters.used_psum_per_PE/2))
         cocotb.start_soon(send_enable_dense(ptp, dut, layer_parameters, layer_repetition, oep))
-        while (dut.psum_enable_o.value == 0):
-            await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
+        await await_value(ptp, dut.psum_enable_o, lambda value: value != 0, get_watchdog_cycles(layer_parameters, layer_repetition, stream),
+                          "output stream of layer " + str(layer_number) + " repetition " + str(layer_repetition) + " does not start")
         dut._log.info("Output Stream started")
         assert dut.psum_enable_o.value != 0, "psum is not 1!"
+        words = []
         while (dut.psum_enable_o.value != 0):
-            for y_cluster in reversed(range(oep.Clusters_Y)):
-                for x_cluster in reversed(range(oep.Clusters_X)):
-                    lower_limit = (x_cluster * oep.Clusters_Y * oep.NUM_GLB_PSUM * 40 + y_cluster * oep.NUM_GLB_PSUM * 40 + router * 40)
-                    upper_limit = lower_limit + 39
-                    outputvalue = dut.psum_data_o.value[lower_limit:upper_limit]
-                    if(logging.DEBUG >= login_level):
-                        txt_file.write(bin(outputvalue)[2:].zfill(40) + "\n")
-                    x = offset + offset_layer_repetition + \
-                    (oep.Clusters_Y-1-y_cluster) * oep.Clusters_X * layer_parameters.used_psum_per_PE+ \
-                    (oep.Clusters_X-1-x_cluster) * layer_parameters.used_psum_per_PE
-                    for i in range(values_per_trans):
-
-                        if(logging.DEBUG >= login_level):
-                            storage_file.write("x: " + str(x) + "\n")
-                        try:
-                            dram.fmap[layer_number + 1][x] = int(dut.psum_data_o.value[lower_limit+20*(1-i):upper_limit-20*i])
-                            if (dram.fmap[layer_number + 1][x] >= 2**19) :
-                                dram.fmap[layer_number + 1][x] = dram.fmap[layer_number + 1][x] - 2**20
-                        except:
-                            #storage_file.close()
-                            #assert dut.rst_ni.value == 0, "Output is not in range of memory"
-                            logger.debug("Empty File")
-
-                        x = x + 1
-                    
-
-            offset = offset + values_per_trans
+            words.append(psum_capture.read_word(dut.psum_data_o))
             await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
+        plan.scatter(dram.fmap[layer_number + 1], words, len(dut.psum_data_o))
+        if(logging.DEBUG >= login_level):
+            plan.write_debug(txt_file, storage_file, words, len(dut.psum_data_o))
     await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
-    cocotb.start_soon(set_input(ptp,(dut.psum_enable_i), 0))
+    set_input(ptp,(dut.psum_enable_i), 0)
 
     await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
-    cocotb.start_soon(set_input(ptp,(dut.status_reg_enable_i), 1))
+    set_input(ptp,(dut.status_reg_enable_i), 1)
     await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
     if(logging.DEBUG >= login_level):
         storage_file.close()
@@ -627,14 +546,14 @@ async def compare_stream_Dense(ptp, dut, layer_number, model, layer_repetition,
 
 async def send_enable_conv(ptp, dut, layer_params, layer_repetition, oep):
 
-    cocotb.start_soon(set_input(ptp,(dut.psum_enable_i), (2**(oep.Clusters_X*oep.Clusters_Y*oep.NUM_GLB_PSUM))-1))
+    set_input(ptp,(dut.psum_enable_i), (2**(oep.Clusters_X*oep.Clusters_Y*oep.NUM_GLB_PSUM))-1)
     for _ in range(int((math.ceil(layer_params.filters/layer_params.needed_wght_transmissions/2)*\
                         math.ceil(layer_params.needed_refreshes_mx[layer_repetition][0]/layer_params.used_Y_cluster)))):
         await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
-    cocotb.start_soon(set_input(ptp,(dut.psum_enable_i), 0))
+    set_input(ptp,(dut.psum_enable_i), 0)
 
 async def send_enable_dense(ptp, dut, layer_params, layer_repetition, oep):
-    cocotb.start_soon(set_input(ptp,(dut.psum_enable_i), (2**(oep.Clusters_X*oep.Clusters_Y*oep.NUM_GLB_PSUM))-1))
+    set_input(ptp,(dut.psum_enable_i), (2**(oep.Clusters_X*oep.Clusters_Y*oep.NUM_GLB_PSUM))-1)
     for _ in range(math.ceil(layer_params.used_psum_per_PE/2)):
         await Timer(ptp.clk_cycle, units=ptp.clk_cycle_unit)
-    cocotb.start_soon(set_input(ptp,(dut.psum_enable_i), 0))
+    set_input(ptp,(dut.psum_enable_i), 0)
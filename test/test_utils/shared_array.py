@@ -0,0 +1,124 @@
+# This file is part of the OpenEye project.
+# All rights reserved. © Fachhochschule Dortmund - University of Applied Sciences and Arts.
+# SPDX-License-Identifier: SHL-2.1
+# For more details, see the LICENSE file in the root directory of this project.
+"""
+NumPy arrays in multiprocessing.shared_memory segments.
+
+A SharedArray and every view of it is pickled by the name of its segment,
+its offset and its strides. A worker process that unpickles it attaches to
+the segment and reads and writes the same memory without a copy. The segment
+is unlinked when the array that created it is garbage collected.
+
+A worker hands its results over with handoff(): the segment is not unlinked
+by the worker, the process that unpickles the array owns it.
+"""
+import sys
+import atexit
+import weakref
+import numpy as np
+from multiprocessing import shared_memory
+
+
+class SharedArray(np.ndarray):
+    """ ndarray whose memory lies in a shared memory segment. """
+
+    def __array_finalize__(self, obj):
+        self._shm_name = getattr(obj, "_shm_name", None)
+        self._shm_address = getattr(obj, "_shm_address", 0)
+        self._shm_size = getattr(obj, "_shm_size", 0)
+        self._shm_handoff = getattr(obj, "_shm_handoff", False)
+
+    def __reduce__(self):
+        address = self.__array_interface__["data"][0]
+        extent = 0
+        if self.size:
+            extent = sum((n - 1) * abs(s) for n, s in zip(self.shape, self.strides))
+        low = address + sum((n - 1) * s for n, s in zip(self.shape, self.strides) if s < 0)
+        if (self._shm_name is None) or (low < self._shm_address) or \
+           (low + extent + self.itemsize > self._shm_address + self._shm_size):
+            # Results of computations on shared arrays are private memory
+            return (np.array, (np.asarray(self),))
+        return (adopt if self._shm_handoff else attach,
+                (self._shm_name, self.shape, self.dtype.str, self.strides, address - self._shm_address))
+
+def _open(name = None, size = 0):
+    if name is None:
+        return shared_memory.SharedMemory(create = True, size = max(1, size))
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track = False)
+    # Workers share the resource tracker of the process that created the
+    # segment, so registering it a second time does not change its lifetime
+    return shared_memory.SharedMemory(name)
+
+# Segments of collected arrays whose buffer was still exported when they were released
+_closing = []
+
+def _close_pending():
+    for shm in list(_closing):
+        try:
+            shm.close()
+            _closing.remove(shm)
+        except BufferError:
+            # The finalizer runs before the collected array releases its buffer,
+            # the segment is closed with the next release or at exit
+            pass
+
+def _release(shm, unlink):
+    """ Unlink the segment of a collected array if it owns it and close it. """
+    if unlink:
+        shm.unlink()
+    _closing.append(shm)
+    _close_pending()
+
+atexit.register(_close_pending)
+
+def _view(shm, shape, dtype, strides = None, offset = 0, unlink = False):
+    """ Return a SharedArray on shm, the segment is closed (and unlinked) with the array.
+
+    Views of the array keep it alive, numpy does not collapse their base
+    past the SharedArray.
+    """
+    array = np.ndarray(shape, dtype, buffer = shm.buf, offset = offset, strides = strides).view(SharedArray)
+    array._shm = shm
+    array._shm_name = shm.name
+    array._shm_address = array.__array_interface__["data"][0] - offset
+    array._shm_size = shm.size
+    weakref.finalize(array, _release, shm, unlink)
+    return array
+
+def attach(name, shape, dtype, strides, offset):
+    """ Return a view on an existing segment. Used to unpickle a SharedArray. """
+    return _view(_open(name), shape, np.dtype(dtype), strides, offset)
+
+def adopt(name, shape, dtype, strides, offset):
+    """ Return a view on a segment that was handed over and unlink it with the view. """
+    return _view(_open(name), shape, np.dtype(dtype), strides, offset, unlink = True)
+
+def zeros(shape, dtype = np.int64):
+    """ Return a new SharedArray filled with zeros. """
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape, dtype = np.int64)) * dtype.itemsize
+    array = _view(_open(size = size), shape, dtype, unlink = True)
+    array.fill(0)
+    return array
+
+def copy(values, dtype = None):
+    """ Return a SharedArray with a copy of values. """
+    values = np.asarray(values, dtype = dtype)
+    array = zeros(values.shape, values.dtype)
+    array[...] = values
+    return array
+
+def handoff(values, dtype = None):
+    """ Return a SharedArray with a copy of values for the result of a worker.
+
+    The segment is not unlinked by this process. The process that unpickles
+    the array owns it, so it must be pickled exactly once.
+    """
+    values = np.asarray(values, dtype = dtype)
+    shm = _open(size = values.nbytes)
+    array = _view(shm, values.shape, values.dtype)
+    array[...] = values
+    array._shm_handoff = True
+    return array
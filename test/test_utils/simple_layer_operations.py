@@ -2,45 +2,53 @@
 # All rights reserved. © Fachhochschule Dortmund - University of Applied Sciences and Arts.
 # SPDX-License-Identifier: SHL-2.1
 # For more details, see the LICENSE file in the root directory of this project.
-import math
+import numpy as np
 
 
 def pool(dram, layer, layer_number):
-    temp_number = 0
+    """ Compute an Average or Max pooling layer in place in the DRAM.
+
+    The windows have the size layer.pool_size and are moved by layer.strides.
+    With "same" padding, the padded positions are ignored like in Keras. The
+    average is truncated towards zero.
+    """
+    fmap = np.asarray(dram.fmap[layer_number], dtype=np.int64)
+    output = dram.fmap[layer_number + 1]
+    strides = tuple(layer.strides)
+    pool_size = tuple(getattr(layer, "pool_size", strides))
+    output_size = (layer.output.shape[2], layer.output.shape[1])
+
+    padded_size = [(output_size[i] - 1) * strides[i] + pool_size[i] for i in range(2)]
+    pad = [max(0, padded_size[i] - fmap.shape[i + 1]) // 2 for i in range(2)]
+    valid = [min(fmap.shape[i + 1], padded_size[i] - pad[i]) for i in range(2)]
+
+    padded = np.zeros((fmap.shape[0], padded_size[0], padded_size[1]), dtype=np.int64)
+    mask = np.zeros((1, padded_size[0], padded_size[1]), dtype=np.int64)
+    area = (slice(None), slice(pad[0], pad[0] + valid[0]), slice(pad[1], pad[1] + valid[1]))
+    mask[area] = 1
 
     if "Average" in str(layer):
-        for oc in range(layer.output.shape[3]):
-            for ox in range(layer.output.shape[2]):
-                for oy in range(layer.output.shape[1]):
-                    for ix in range(layer.strides[1]):
-                        for iy in range(layer.strides[0]):
-                            temp_number = temp_number + dram.fmap[layer_number][oc][ix][iy]
-                    dram.fmap[layer_number + 1][oc][ox][oy] = int(temp_number/ (layer.strides[0]*layer.strides[1]))
+        padded[area] = fmap[:, :valid[0], :valid[1]]
+        sums = get_pool_windows(padded, pool_size, strides, output_size).sum(axis=(3, 4))
+        counts = get_pool_windows(mask, pool_size, strides, output_size).sum(axis=(3, 4))
+        output[:, :output_size[0], :output_size[1]] = np.sign(sums) * (np.abs(sums) // np.maximum(counts, 1))
 
     elif "Max" in str(layer):
-        for oc in range(layer.output.shape[3]):
-            for ox in range(layer.output.shape[2]):
-                for oy in range(layer.output.shape[1]):
-                    for ix in range(layer.strides[1]):
-                        for iy in range(layer.strides[0]):
-                            if(dram.fmap[layer_number][oc][ix][iy] > temp_number):
-                                temp_number = dram.fmap[layer_number][oc][ix][iy]
+        padded.fill(np.iinfo(np.int64).min)
+        padded[area] = fmap[:, :valid[0], :valid[1]]
+        output[:, :output_size[0], :output_size[1]] = get_pool_windows(padded, pool_size, strides, output_size).max(axis=(3, 4))
 
-                    dram.fmap[layer_number + 1][oc][ox][oy] = temp_number
+def get_pool_windows(fmap, pool_size, strides, output_size):
+    windows = np.lib.stride_tricks.sliding_window_view(fmap, pool_size, axis=(1, 2))
+    return windows[:, ::strides[0], ::strides[1]][:, :output_size[0], :output_size[1]]
 
 def flat(dram, layer, layer_number):
-    for ic in range(layer.input.shape[3]):
-        for iy in range(layer.input.shape[1]):
-            for ix in range(layer.input.shape[2]):
-                    dram.fmap[layer_number + 1][ic * layer.input.shape[2] * layer.input.shape[1]+ iy * layer.input.shape[2] + ix] = dram.fmap[layer_number][ic][ix][iy]
+    """ Flatten the DRAM fmap in the order (channel, y, x). """
+    fmap = np.asarray(dram.fmap[layer_number])[:, :layer.input.shape[2], :layer.input.shape[1]]
+    values = fmap.transpose(0, 2, 1).reshape(-1)
+    dram.fmap[layer_number + 1][:len(values)] = values
 
 def batchnorm_output(layer, divide_value, layer_number, dram):
-    if "Conv" in str(layer):
-        for f in range(len(dram.fmap[1 + layer_number])):
-            for x in range(len(dram.fmap[1 + layer_number][f])):
-                for y in range(len(dram.fmap[1 + layer_number][f][x])):
-                    dram.fmap[1 + layer_number][f][x][y] = math.floor(dram.fmap[1 + layer_number][f][x][y]/divide_value)
-    elif "Dense" in str(layer):
-        for f in range(len(dram.fmap[1 + layer_number])):
-            dram.fmap[1 + layer_number][f] = math.floor(dram.fmap[1 + layer_number][f]/divide_value)
-
+    """ Requantize the output of a layer in place with a floor division. """
+    if ("Conv" in str(layer)) or ("Dense" in str(layer)):
+        np.floor_divide(dram.fmap[1 + layer_number], divide_value, out=dram.fmap[1 + layer_number])
@@ -0,0 +1,362 @@
+# This file is part of the OpenEye project.
+# All rights reserved. © Fachhochschule Dortmund - University of Applied Sciences and Arts.
+# SPDX-License-Identifier: SHL-2.1
+# For more details, see the LICENSE file in the root directory of this project.
+"""
+Columnar representation of the stream of one layer repetition.
+
+Every port of the stream is a PortStream: a dense (cycles, lanes) array of
+the words that are sent in each cycle, a valid mask of the same shape and
+the number of words of every lane. In parallel mode the lanes are the
+routers of all clusters in the order [cl_x][cl_y][router], in serial mode a
+port has a single lane with the DMA words.
+"""
+import sys
+import os
+import hashlib
+directory = (os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)))
+sys.path.extend([directory, os.path.dirname(os.path.realpath(__file__))])
+import numpy as np
+import bit_fields
+import test_utils.shared_array as shared_array
+import stream_dicts as strdic
+
+# Ports with less data are pickled by value, larger ones are handed over in shared memory
+SHARE_MIN_BYTES = 1 << 16
+
+# Cycles whose bus words are converted to Python ints at once by the drivers
+BUS_CHUNK_CYCLES = 1024
+
+
+def get_lane_bits(params, port):
+    """ Return the width of one lane on the bus of a port of the parallel interface. """
+    if port == "psum":
+        return params.DMA_Bits
+    return int(params.DMA_Bits/params.Clusters_X)
+
+
+def to_array(values):
+    """ Return the values as int64 array, or as object array if they do not fit. """
+    try:
+        return np.asarray(values, dtype = np.int64)
+    except OverflowError:
+        return np.asarray(values, dtype = object)
+
+
+class LaneInterner(object):
+    """ Hash-consing of lane payloads.
+
+    Lanes with the same words are returned as the same list object, so a
+    payload that is shared by many clusters and routers is converted and
+    stored once. PortStream.from_lanes keeps one column per distinct object.
+    """
+    def __init__(self):
+        self.lanes = {}
+        self.hits = 0
+
+    def intern(self, values):
+        """ Return the canonical list of the words in values. """
+        if isinstance(values, np.ndarray):
+            key = tuple(values.tolist()) if values.dtype == object else (values.dtype.str, values.shape, values.tobytes())
+        else:
+            key = tuple(values)
+        lane = self.lanes.get(key)
+        if lane is None:
+            lane = values.tolist() if isinstance(values, np.ndarray) else list(values)
+            self.lanes[key] = lane
+        else:
+            self.hits = self.hits + 1
+        return lane
+
+    def intern_rows(self, array):
+        """ Return the nested lists of array, identical rows of the last axis are one list. """
+        array = np.asarray(array)
+        rows = array.reshape(-1, array.shape[-1])
+        if (len(rows) == 0) or (array.dtype == object):
+            return nest_lanes([self.intern(row) for row in rows], array.shape[:-1])
+        unique, inverse = np.unique(rows, axis = 0, return_inverse = True)
+        lanes = [self.intern(row) for row in unique]
+        return nest_lanes([lanes[index] for index in inverse.reshape(-1)], array.shape[:-1])
+
+
+def nest_lanes(lanes, lanes_shape):
+    """ Return the flat list of lanes as nested lists with the shape lanes_shape. """
+    for size in reversed(lanes_shape[1:]):
+        lanes = [lanes[n:n + size] for n in range(0, len(lanes), size)]
+    return lanes
+
+
+class PortStream(object):
+    """ The words of one port as (cycles, lanes) array.
+
+    Lanes with the same words share one column of data.
+
+    Attributes:
+        data: The words of the distinct lanes, 0 behind the end of a lane.
+        columns: The column of data that holds the words of every lane.
+        valid: True where a lane sends a word, with the shape (cycles, lanes).
+        lengths: The number of words of every lane.
+        lanes_shape: The shape of the lanes, (Clusters_X, Clusters_Y, routers) or (1,).
+        bus: None, or (lane_bits, data, enable) with the bus word and the
+            enable mask of every cycle as 64 bit limbs, see make_bus().
+    """
+    def __init__(self, data, lengths, lanes_shape, columns = None, bus = None):
+        self.data = data
+        self.lengths = np.asarray(lengths, dtype = np.int64)
+        self.lanes_shape = tuple(lanes_shape)
+        self.columns = np.arange(len(self.lengths)) if columns is None else np.asarray(columns, dtype = np.int64)
+        self.valid = np.arange(data.shape[0])[:, None] < self.lengths[None, :]
+        self.bus = bus
+
+    @classmethod
+    def from_lanes(cls, lanes):
+        """ Make a port from nested lists [cl_x][cl_y][router][position].
+
+        Identical lanes are stored once, lanes that are the same object
+        (see LaneInterner) are recognized without comparing their words.
+        """
+        if len(lanes) == 0:
+            return cls.empty((0,))
+        lanes_shape = (len(lanes), len(lanes[0]), len(lanes[0][0]))
+        flat = [lane for cluster_column in lanes for cluster in cluster_column for lane in cluster]
+        lengths = [len(lane) for lane in flat]
+        by_id = {}
+        by_words = {}
+        distinct = []
+        columns = []
+        for lane in flat:
+            column = by_id.get(id(lane))
+            if column is None:
+                words = tuple(lane)
+                column = by_words.get(words)
+                if column is None:
+                    column = len(distinct)
+                    distinct.append(lane)
+                    by_words[words] = column
+                by_id[id(lane)] = column
+            columns.append(column)
+        distinct_lengths = [len(lane) for lane in distinct]
+        if min(distinct_lengths) == max(distinct_lengths):
+            data = to_array(distinct).reshape(len(distinct), distinct_lengths[0]).T
+        else:
+            data = np.zeros((max(distinct_lengths), len(distinct)), dtype = np.int64)
+            for column, values in enumerate(distinct):
+                values = to_array(values)
+                if values.dtype == object:
+                    data = data.astype(object)
+                data[:len(values), column] = values
+        return cls(np.ascontiguousarray(data), lengths, lanes_shape, columns)
+
+    @classmethod
+    def from_words(cls, words):
+        """ Make a single lane port from a list of words. """
+        data = to_array([] if words is None else words).reshape(-1, 1)
+        return cls(data, [data.shape[0]], (1,))
+
+    @classmethod
+    def empty(cls, lanes_shape):
+        lanes = int(np.prod(lanes_shape))
+        return cls(np.zeros((0, lanes), dtype = np.int64), [0] * lanes, lanes_shape)
+
+    def __getstate__(self):
+        # The valid mask follows from the lengths and is not pickled
+        state = dict(vars(self))
+        del state["valid"]
+        return state
+
+    def __setstate__(self, state):
+        self.__init__(state["data"], state["lengths"], state["lanes_shape"], state["columns"], state["bus"])
+
+    def share(self, min_bytes = SHARE_MIN_BYTES):
+        """ Move the data to shared memory to hand it over to the process that unpickles the port. """
+        if (self.data.dtype != object) and (self.data.nbytes >= min_bytes):
+            self.data = shared_array.handoff(self.data)
+        if (self.bus is not None) and (self.bus[1].nbytes >= min_bytes):
+            self.bus = (self.bus[0], shared_array.handoff(self.bus[1]), shared_array.handoff(self.bus[2]))
+        return self
+
+    @property
+    def cycles(self):
+        return self.data.shape[0]
+
+    def __len__(self):
+        return self.cycles
+
+    def __getitem__(self, cycles):
+        """ Return the port for a slice of cycles. """
+        if not isinstance(cycles, slice):
+            raise TypeError("A PortStream can only be sliced by cycles.")
+        start, stop, step = cycles.indices(self.cycles)
+        if step != 1:
+            raise ValueError("A PortStream can only be sliced with step 1.")
+        lengths = np.clip(self.lengths - start, 0, max(stop - start, 0))
+        bus = None if self.bus is None else (self.bus[0], self.bus[1][start:stop], self.bus[2][start:stop])
+        return PortStream(self.data[start:stop], lengths, self.lanes_shape, self.columns, bus)
+
+    def get_lane_index(self, *index):
+        return int(np.ravel_multi_index(index, self.lanes_shape))
+
+    def lane(self, *index):
+        """ Return the valid words of a lane as list. """
+        lane = self.get_lane_index(*index) if index else 0
+        return self.data[:self.lengths[lane], self.columns[lane]].tolist()
+
+    def words(self):
+        """ Return the words of a single lane port as list. """
+        return self.lane()
+
+    def to_lanes(self):
+        """ Return the nested lists [cl_x][cl_y][router][position] of the port. """
+        lanes = [self.data[:length, column].tolist() for column, length in zip(self.columns, self.lengths)]
+        return nest_lanes(lanes, self.lanes_shape)
+
+    def dense(self):
+        """ Return the words as (cycles, lanes) array with one column per lane. """
+        if np.array_equal(self.columns, np.arange(self.data.shape[1])):
+            return self.data
+        return self.data[:, self.columns]
+
+    def bus_words(self, lane_bits):
+        """ Return the bus word of every cycle.
+
+        The lanes are placed side by side with lane_bits each, the first lane
+        is the least significant one. Lanes without data are 0.
+        """
+        return bit_fields.pack(np.where(self.valid, self.dense(), 0), lane_bits)
+
+    def enable_masks(self):
+        """ Return the enable mask of every cycle, one bit per valid lane. """
+        return bit_fields.pack(self.valid, 1)
+
+    def make_bus(self, lane_bits):
+        """ Precompute the bus word and the enable mask of every cycle, see bus_words(). """
+        self.bus = (lane_bits,
+                    bit_fields.pack_limbs(np.where(self.valid, self.dense(), 0), lane_bits),
+                    bit_fields.pack_limbs(self.valid, 1))
+        return self
+
+    def bus_cycles(self, lane_bits):
+        """ Yield (bus word, enable mask) of every cycle as Python ints.
+
+        The words are precomputed by make_bus() with the same lane width, in
+        the worker or the stream cache, they are not packed here.
+        """
+        if (self.bus is None) or (self.bus[0] != lane_bits):
+            raise ValueError("The bus words of the port were not made for " + str(lane_bits) + " bit lanes, see make_bus().")
+        _, data, enable = self.bus
+        for start in range(0, self.cycles, BUS_CHUNK_CYCLES):
+            yield from zip(bit_fields.limbs_to_ints(data[start:start + BUS_CHUNK_CYCLES]),
+                           bit_fields.limbs_to_ints(enable[start:start + BUS_CHUNK_CYCLES]))
+
+
+def intern_streams(streams):
+    """ Let identical port arrays of the repetitions share one array.
+
+    Returns the streams, the port data of later repetitions is replaced by
+    the array of the first repetition with the same words.
+    """
+    arrays = {}
+    for stream in streams:
+        for name in ("status",) + Stream.ports:
+            port = getattr(stream, name)
+            if (not isinstance(port, PortStream)) or (port.data.dtype == object):
+                continue
+            data = np.ascontiguousarray(port.data)
+            key = (data.dtype.str, data.shape, hashlib.sha256(data.tobytes()).digest())
+            canonical = arrays.setdefault(key, port.data)
+            if (canonical is not port.data) and np.array_equal(canonical, port.data):
+                port.data = canonical
+    return streams
+
+
+class StatusRecord(object):
+    """ The status section of a parallel stream.
+
+    Every field of strdic.status_dict is an attribute. The router modes are
+    int arrays with the shape (Clusters_X, Clusters_Y, routers).
+    """
+    router_fields = ("router_iact", "router_wght", "router_psum")
+
+    def __init__(self, **fields):
+        for name in strdic.status_dict:
+            value = fields.get(name, 0)
+            if name in self.router_fields:
+                value = np.asarray(value, dtype = np.int64)
+            setattr(self, name, value)
+
+    @classmethod
+    def from_list(cls, storage):
+        """ Make the record from the status list of write_working_parameters. """
+        return cls(**{name: storage[index] for name, index in strdic.status_dict.items()})
+
+    def to_list(self):
+        storage = [[] for _ in range(len(strdic.status_dict))]
+        for name, index in strdic.status_dict.items():
+            value = getattr(self, name)
+            storage[index] = value.tolist() if name in self.router_fields else value
+        return storage
+
+    def __eq__(self, other):
+        return isinstance(other, StatusRecord) and (self.to_list() == other.to_list())
+
+
+class Stream(object):
+    """ The stream of one layer repetition.
+
+    Attributes:
+        serial: True for the DMA stream of the serial interface.
+        status: StatusRecord, or a PortStream with the status DMA words in serial mode.
+        iact, wght, psum: PortStream of the ports.
+    """
+    ports = ("iact", "wght", "psum")
+
+    def __init__(self, serial, status, iact, wght, psum):
+        self.serial = serial
+        self.status = status
+        self.iact = iact
+        self.wght = wght
+        self.psum = psum
+
+    def make_bus(self, params):
+        """ Precompute the bus words of the ports of a parallel stream, see PortStream.make_bus(). """
+        if not self.serial:
+            for name in self.ports:
+                port = getattr(self, name)
+                if port is not None:
+                    port.make_bus(get_lane_bits(params, name))
+        return self
+
+    def share(self, min_bytes = SHARE_MIN_BYTES):
+        """ Move the data of all ports to shared memory, see PortStream.share(). """
+        for port in [self.status if self.serial else None] + [getattr(self, name) for name in self.ports]:
+            if port is not None:
+                port.share(min_bytes)
+        return self
+
+    @classmethod
+    def from_storage(cls, storage, serial):
+        """ Make the stream from the storage list of a LayerMapper. """
+        status = storage[strdic.stream_parallel_dict["status"]]
+        if serial:
+            status = PortStream.from_words(status)
+            make_port = PortStream.from_words
+        else:
+            status = StatusRecord.from_list(status) if len(status) else None
+            make_port = PortStream.from_lanes
+        ports = [make_port(storage[strdic.stream_parallel_dict[port]]) for port in cls.ports]
+        return cls(serial, status, *ports)
+
+    def to_storage(self):
+        """ Return the stream as nested lists like LayerMapper.storage. """
+        storage = [[] for _ in range(len(strdic.stream_parallel_dict))]
+        if self.serial:
+            storage[strdic.stream_parallel_dict["status"]] = self.status.words()
+        elif self.status is not None:
+            storage[strdic.stream_parallel_dict["status"]] = self.status.to_list()
+        for port in self.ports:
+            port_stream = getattr(self, port)
+            storage[strdic.stream_parallel_dict[port]] = port_stream.words() if self.serial else port_stream.to_lanes()
+        return storage
+
+    def __eq__(self, other):
+        return isinstance(other, Stream) and (self.serial == other.serial) and (self.to_storage() == other.to_storage())
@@ -0,0 +1,299 @@
+# This file is part of the OpenEye project.
+# All rights reserved. © Fachhochschule Dortmund - University of Applied Sciences and Arts.
+# SPDX-License-Identifier: SHL-2.1
+# For more details, see the LICENSE file in the root directory of this project.
+"""
+Content-addressed on-disk cache for the generated streams of a layer.
+
+The stream of a layer is cached in three parts, by the input they depend on:
+the status and wght streams (weights), the psum streams (bias) and the iact
+streams (input feature map). Each part is addressed by a SHA-256 hash over
+the OpenEye parameters, the layer geometry, its input and the sources of the
+mappers, so new weights only miss the status and wght entry, and a change of
+the mapping invalidates the entries without a new CACHE_VERSION.
+
+Each part is one binary_container file with the streams of all layer
+repetitions, the arrays are its data blocks. The header holds the index of
+the repetitions: the offset, dtype and shape of every port array and of its
+precomputed bus words (see PortStream.make_bus), the lane lengths and
+columns and the status record. Identical arrays of different repetitions
+are written once and share their offset. A hit maps the file with
+np.memmap, the ports and their bus words are views into the mapping, so the
+drivers do not pack the bus words again.
+
+The cache is configured with environment variables:
+    STREAM_CACHE: Set to 0 to bypass the cache (default 1).
+    STREAM_CACHE_DIR: Directory of the cache (default test/.stream_cache).
+    STREAM_CACHE_MAX_MB: Size cap in MiB, the least recently used entries
+        are evicted first (default 2048).
+"""
+import sys
+import os
+directory = (os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)))
+sys.path.extend([directory, os.path.dirname(os.path.realpath(__file__))])
+import hashlib
+import logging
+import numpy as np
+from test_utils.reference_cache import ReferenceCache, get_source_hash
+from test_utils.stream import Stream, StatusRecord, PortStream
+from test_utils.layer_description import describe, get_layer_type
+from test_utils.binary_container import write_container, read_header, get_aligned
+
+logger = logging.getLogger("cocotb")
+
+# Increase when the format or the semantics of the streams change
+CACHE_VERSION = 5
+
+MAGIC = b"OESTREAM"
+
+DEFAULT_CACHE_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, ".stream_cache"))
+DEFAULT_MAX_MB = 2048
+
+# The entries of a layer. Besides the geometry, every part of the stream
+# depends on one input (see strdic.stream_dependencies), the parts with the
+# same input are cached together.
+PARTS = {
+    "weights": ("status", "wght"),
+    "bias": ("psum",),
+    "fmap": ("iact",),
+}
+
+# Sources the streams are generated with and the modules the mappers use,
+# relative to the test directory
+STREAM_SOURCES = (
+    "test_utils/layer_mapper.py",
+    "test_utils/conv_mapper.py",
+    "test_utils/dw_mapper.py",
+    "test_utils/dense_mapper.py",
+    "test_utils/iact_stream_mapper.py",
+    "test_utils/wght_stream_mapper.py",
+    "test_utils/psum_stream_mapper.py",
+    "test_utils/stream.py",
+    "test_utils/stream_dicts.py",
+    "test_utils/bit_fields.py",
+    "test_utils/generic_test_utils.py",
+    "test_utils/layer_parameters.py",
+    "test_utils/layer_description.py",
+    "cocotb_parallel/parallel_test_utils.py",
+)
+
+
+class StreamCache(ReferenceCache):
+    """ LRU cache of the streams of layers in memory-mappable files.
+
+    Attributes:
+        enabled: False if the cache is bypassed.
+        directory: Directory that holds the .stream entries.
+        max_bytes: Size cap of the directory in bytes.
+    """
+    suffix = ".stream"
+    sources = STREAM_SOURCES
+
+    def __init__(self, directory = None, max_mb = None, enabled = None):
+        if enabled is None:
+            enabled = os.getenv("STREAM_CACHE", "1") not in ("0", "false", "False", "off")
+        if directory is None:
+            directory = os.getenv("STREAM_CACHE_DIR", DEFAULT_CACHE_DIR)
+        if max_mb is None:
+            try:
+                max_mb = float(os.getenv("STREAM_CACHE_MAX_MB", DEFAULT_MAX_MB))
+            except ValueError:
+                logger.warning("STREAM_CACHE_MAX_MB is not a number. Setting to " + str(DEFAULT_MAX_MB) + ".")
+                max_mb = DEFAULT_MAX_MB
+        super().__init__(directory, max_mb, enabled)
+
+    def key(self, params, layer, part, data):
+        """ Return the hash that addresses a part of the stream of a layer.
+
+        Args:
+            params: The OpenEye parameters.
+            layer: The layer or its LayerDescription.
+            part: The name of the entry, see PARTS.
+            data: The arrays the part depends on.
+        """
+        sha = hashlib.sha256()
+        geometry = (
+            CACHE_VERSION,
+            part,
+            get_layer_type(layer),
+            tuple(layer.input.shape),
+            tuple(layer.output.shape),
+            tuple(getattr(layer, "kernel_size", ())),
+            getattr(layer, "filters", None),
+            tuple(getattr(layer, "strides", ())),
+            getattr(layer, "padding", None),
+            sorted(vars(params).items()),
+            get_source_hash(self.sources),
+        )
+        sha.update(repr(geometry).encode())
+        for array in data:
+            if array is None:
+                sha.update(b"None")
+            else:
+                array = np.ascontiguousarray(np.asarray(array))
+                sha.update(repr((array.dtype.str, array.shape)).encode())
+                sha.update(array.tobytes())
+        return sha.hexdigest()
+
+    def part_key(self, params, layer, part, dram_layer_content):
+        """ Return the key of a part of the stream of a layer, see PARTS. """
+        if part == "weights":
+            # The realfactor of the status depends on the weights of the layer
+            layer = describe(layer, weights = True)
+            return self.key(params, layer, part, list(layer.weights) + [dram_layer_content[1]])
+        if part == "bias":
+            return self.key(params, layer, part, [dram_layer_content[2]])
+        return self.key(params, layer, part, [dram_layer_content[0]])
+
+    def part_keys(self, params, layer, dram_layer_content, parts = tuple(PARTS)):
+        """ Return a dict with the key of every part in parts. """
+        return {part: self.part_key(params, layer, part, dram_layer_content) for part in parts}
+
+    def load_parts(self, keys):
+        """ Return the cached streams of the parts in keys and the parts that missed.
+
+        The streams of the hits are combined, they only hold the components
+        of these parts, see combine().
+        """
+        hits = []
+        missing = []
+        for part, key in keys.items():
+            streams = self.load(key)
+            if streams is None:
+                missing.append(part)
+            else:
+                hits.append((PARTS[part], streams))
+        return hits, tuple(missing)
+
+    def store_parts(self, keys, streams):
+        """ Store the components of every part in keys of the streams of all repetitions. """
+        for part, key in keys.items():
+            self.store(key, [select(stream, PARTS[part]) for stream in streams])
+
+    def load(self, key):
+        """ Return the streams of all repetitions, mapped from the file, or None on a miss. """
+        if not self.enabled:
+            return None
+        path = self.path(key)
+        try:
+            streams = read_streams(path)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("Stream cache entry " + path + " is unreadable and removed: " + str(e))
+            self._remove(path)
+            return None
+        # Mark the entry as recently used
+        os.utime(path)
+        logger.info("Stream cache hit: " + key)
+        return streams
+
+    def store(self, key, streams):
+        """ Store the streams of all repetitions atomically and evict old entries above the size cap. """
+        if not self.enabled:
+            return
+        try:
+            write_streams(self.path(key), streams)
+        except TypeError as e:
+            # Words that do not fit into int64 can not be mapped
+            logger.debug("Stream cache does not store " + key + ": " + str(e))
+            return
+        self.evict()
+
+
+def get_components(parts):
+    """ Return the components of the stream in the given parts. """
+    return tuple(component for part in parts for component in PARTS[part])
+
+def select(stream, components):
+    """ Return a new Stream with the given components of stream, the others are None. """
+    return Stream(stream.serial, **{component: (getattr(stream, component) if component in components else None)
+                                    for component in ("status",) + Stream.ports})
+
+def combine(sources):
+    """ Return the streams of all repetitions, put together from (components, streams) pairs. """
+    streams = [select(stream, ()) for stream in sources[0][1]]
+    for components, source_streams in sources:
+        for stream, source_stream in zip(streams, source_streams):
+            for component in components:
+                setattr(stream, component, getattr(source_stream, component))
+    return streams
+
+class ArrayBlocks(object):
+    """ The arrays of a stream file, identical arrays are written once. """
+    def __init__(self):
+        self.blocks = []
+        self.offsets = {}
+        self.size = 0
+
+    def add(self, data):
+        """ Return the description of an array: its offset, dtype and shape. """
+        data = np.ascontiguousarray(data)
+        if data.dtype == object:
+            raise TypeError("object arrays can not be mapped")
+        key = (data.dtype.str, data.shape, hashlib.sha256(data.tobytes()).digest())
+        if key not in self.offsets:
+            self.offsets[key] = self.size
+            self.blocks.append((self.size, data.tobytes()))
+            self.size = self.size + get_aligned(data.nbytes)
+        return {"offset": self.offsets[key], "dtype": data.dtype.str, "shape": list(data.shape)}
+
+def describe_port(port, arrays):
+    description = {"data": arrays.add(port.data), "lengths": port.lengths.tolist(),
+                   "lanes_shape": list(port.lanes_shape), "columns": port.columns.tolist(), "bus": None}
+    if port.bus is not None:
+        lane_bits, data, enable = port.bus
+        description["bus"] = {"lane_bits": lane_bits, "data": arrays.add(data), "enable": arrays.add(enable)}
+    return description
+
+def map_array(mapping, start, description):
+    dtype = np.dtype(description["dtype"])
+    begin = start + description["offset"]
+    count = int(np.prod(description["shape"]))
+    return mapping[begin:begin + count * dtype.itemsize].view(dtype).reshape(description["shape"])
+
+def describe_status(status):
+    if status is None:
+        return None
+    return {name: (value.tolist() if isinstance(value, (np.ndarray, np.generic)) else value) for name, value in vars(status).items()}
+
+def write_streams(path, streams):
+    """ Write the streams of all repetitions atomically to path. """
+    repetitions = []
+    arrays = ArrayBlocks()
+    for stream in streams:
+        entry = {}
+        ports = list(Stream.ports)
+        if stream.serial:
+            ports.insert(0, "status")
+        else:
+            entry["status"] = describe_status(stream.status)
+        for name in ports:
+            if getattr(stream, name) is None:
+                continue
+            entry[name] = describe_port(getattr(stream, name), arrays)
+        repetitions.append(entry)
+    serial = bool(streams[0].serial) if len(streams) else False
+    write_container(path, MAGIC, CACHE_VERSION, {"serial": serial, "repetitions": repetitions}, arrays.blocks)
+
+def read_streams(path):
+    """ Return the streams of a binary file, the ports are views into a memory map. """
+    header, start = read_header(path, MAGIC, CACHE_VERSION)
+    mapping = np.memmap(path, dtype=np.uint8, mode="r")
+    streams = []
+    for entry in header["repetitions"]:
+        ports = {}
+        for name, description in entry.items():
+            if name == "status" and not header["serial"]:
+                continue
+            bus = description["bus"]
+            if bus is not None:
+                bus = (bus["lane_bits"], map_array(mapping, start, bus["data"]), map_array(mapping, start, bus["enable"]))
+            ports[name] = PortStream(map_array(mapping, start, description["data"]), description["lengths"],
+                                     description["lanes_shape"], description["columns"], bus)
+        if header["serial"]:
+            status = ports.get("status")
+        else:
+            status = None if entry["status"] is None else StatusRecord(**entry["status"])
+        streams.append(Stream(header["serial"], status, *[ports.get(name) for name in Stream.ports]))
+    return streams
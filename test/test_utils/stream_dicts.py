@@ -24,6 +24,14 @@ stream_parallel_dict = {
   "psum": 3
 }
 
+# inputs of the layer that every part of the stream depends on
+stream_dependencies = {
+  "status": ("geometry", "weights"),
+  "iact": ("geometry", "fmap"),
+  "wght": ("geometry", "weights"),
+  "psum": ("geometry", "bias")
+}
+
 # further refinement of the status data (index in sub-list)
 status_dict = {
   "data_mode": 0,
@@ -51,3 +59,36 @@ status_dict = {
   "router_psum": 22,
   "psum_delay": 23
 }
+
+# layout of the two status words of the serial DMA stream, field name: bitwidth
+# (least significant field first)
+status_dma_layout = [
+  {
+    "data_mode": 1,
+    "realfactor": 5,
+    "autofunction": 1,
+    "poolingmode": 1,
+    "needed_refreshes": 8,
+    "used_X_cluster": 2,
+    "used_Y_cluster": 4,
+    "needed_Iact_writes": 4,
+    "used_psum_per_PE": 6,
+    "used_iact_addr_per_PE": 4,
+    "used_wght_addr_per_PE": 5,
+    "used_iact_per_PE": 7
+  },
+  {
+    "iact_addr_len": 2,
+    "iact_data_len": 4,
+    "strideX": 4,
+    "strideY": 4,
+    "skipIact": 1,
+    "skipWght": 1,
+    "skipPsum": 1,
+    "psum_delay": 31
+  }
+]
+
+# number and width of the DMA words that carry the mask of the computing PEs
+use_pes_dma_words = 4
+use_pes_dma_bitwidth = 48
@@ -0,0 +1,75 @@
+# This file is part of the OpenEye project.
+# All rights reserved. © Fachhochschule Dortmund - University of Applied Sciences and Arts.
+# SPDX-License-Identifier: SHL-2.1
+# For more details, see the LICENSE file in the root directory of this project.
+import sys
+import os
+directory = (os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)))
+sys.path.extend([directory, os.path.dirname(os.path.realpath(__file__))])
+import random
+import numpy as np
+import pytest
+import test_utils.bit_fields as bit_fields
+
+
+def random_fields(rng, shape, widths, signed):
+    """ Return random fields that fit into their widths, along the last axis. """
+    columns = []
+    for width in widths:
+        low, high = (-(1 << (width - 1)), 1 << (width - 1)) if signed else (0, 1 << width)
+        columns.append(np.array([rng.randrange(low, high) for _ in range(int(np.prod(shape)))], dtype = object).reshape(shape))
+    return np.stack(columns, axis = -1)
+
+def reference_word(fields, widths):
+    word = 0
+    for value, width in reversed(list(zip(fields, widths))):
+        word = (word << width) | (int(value) & ((1 << width) - 1))
+    return word
+
+
+@pytest.mark.parametrize("widths", [[8] * 4, [20, 20], [3, 17, 12, 32], [24] * 6, [40] * 4, [62, 7, 64, 1]])
+@pytest.mark.parametrize("signed", [False, True])
+def test_pack_unpack_round_trip(widths, signed):
+    rng = random.Random(sum(widths) + signed)
+    fields = random_fields(rng, (5, 3), widths, signed)
+    words = bit_fields.pack(fields, widths)
+    assert words.shape == (5, 3)
+    assert words.dtype == (object if sum(widths) > 64 else np.uint64)
+    for index in np.ndindex(5, 3):
+        assert int(words[index]) == reference_word(fields[index], widths)
+    unpacked = bit_fields.unpack(words, widths, signed = signed)
+    assert np.array_equal(unpacked.astype(object), fields)
+
+def test_pack_cuts_off_bits_outside_the_field():
+    assert int(bit_fields.pack([0x1ff, -1], 8)) == 0xffff
+    assert int(bit_fields.pack([-2, 5], [3, 4])) == (5 << 3) | 6
+
+def test_signed_fields():
+    assert bit_fields.to_signed(np.array([0, 1, 0x7ffff, 0x80000, 0xfffff]), 20).tolist() == [0, 1, 0x7ffff, -0x80000, -1]
+    words = bit_fields.pack([[-1, 0x7ffff], [-0x80000, 3]], 20)
+    assert bit_fields.unpack(words, 20, count = 2, signed = True).tolist() == [[-1, 0x7ffff], [-0x80000, 3]]
+
+@pytest.mark.parametrize("widths", [[60, 10], [33, 33, 33], [24] * 8, [64, 64, 1], [1] * 130, [20, 44, 21, 43]])
+@pytest.mark.parametrize("signed", [False, True])
+def test_pack_limbs_matches_pack(widths, signed):
+    rng = random.Random(len(widths) * 7 + signed)
+    fields = random_fields(rng, (4, 2), widths, signed)
+    limbs = bit_fields.pack_limbs(fields, widths)
+    assert limbs.dtype == np.uint64
+    assert limbs.shape == (4, 2, -(-sum(widths) // 64))
+    words = bit_fields.limbs_to_ints(limbs.reshape(-1, limbs.shape[-1]))
+    assert words == [reference_word(fields[index], widths) for index in np.ndindex(4, 2)]
+    assert words == [int(word) for word in bit_fields.pack(fields, widths).reshape(-1)]
+
+def test_pack_limbs_straddles_the_limb_boundary():
+    # The second field covers the bits 60 to 69, split over both limbs
+    limbs = bit_fields.pack_limbs([[0, 0x3ff]], [60, 10])
+    assert limbs.tolist() == [[0xf << 60, 0x3f]]
+    assert bit_fields.limbs_to_ints(limbs) == [0x3ff << 60]
+
+def test_limbs_to_ints_wider_than_64_bit():
+    word = (1 << 200) - 12345
+    limbs = np.array([[(word >> (64 * limb)) & ((1 << 64) - 1) for limb in range(4)]], dtype = np.uint64)
+    assert bit_fields.limbs_to_ints(limbs) == [word]
+    fields = bit_fields.unpack(np.array([word], dtype = object), 50, count = 4)
+    assert bit_fields.pack(fields, 50).tolist() == [word]
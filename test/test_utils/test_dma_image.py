@@ -0,0 +1,71 @@
+# This file is part of the OpenEye project.
+# All rights reserved. © Fachhochschule Dortmund - University of Applied Sciences and Arts.
+# SPDX-License-Identifier: SHL-2.1
+# For more details, see the LICENSE file in the root directory of this project.
+import sys
+import os
+directory = (os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)))
+sys.path.extend([directory, os.path.dirname(os.path.realpath(__file__))])
+import random
+import numpy as np
+import pytest
+import test_utils.dma_image as dma_image
+from test_utils.stream import Stream, PortStream
+
+
+def make_serial_stream(rng, word_bits, lengths):
+    """ Return a serial Stream with random words in the sections status, iact, wght and psum. """
+    ports = [PortStream.from_words([rng.getrandbits(word_bits) for _ in range(length)]) for length in lengths]
+    return Stream(True, *ports)
+
+def get_words(stream):
+    return [word for name in dma_image.sections for word in getattr(stream, name).words()]
+
+
+@pytest.mark.parametrize("word_bits", [8, 48, 63, 64, 65, 72, 130])
+def test_image_round_trip(tmp_path, word_bits):
+    rng = random.Random(word_bits)
+    stream = make_serial_stream(rng, word_bits, [5, 300, 0, 17])
+    path = dma_image.write_image(str(tmp_path / "layer.dma"), stream, word_bits, "key")
+    image = dma_image.read_image(path, "key")
+    assert image is not None
+    assert (image.word_bits, image.word_bytes, image.key) == (word_bits, -(-word_bits // 8), "key")
+    assert len(image) == 322
+    assert list(image.chunks(7)) == get_words(stream)
+    assert list(image.chunks()) == get_words(stream)
+    for name in dma_image.sections:
+        assert image.words(name).tolist() == getattr(stream, name).words()
+    assert image.words("iact", 10, 20).tolist() == stream.iact.words()[10:20]
+    # Words of up to 64 bit are mapped as uint64, wider ones are decoded to ints
+    assert image.words().dtype == (object if word_bits > 64 else np.uint64)
+
+def test_image_with_a_stale_key_is_rejected(tmp_path):
+    stream = make_serial_stream(random.Random(0), 48, [2, 3, 4, 5])
+    path = dma_image.write_image(str(tmp_path / "layer.dma"), stream, 48, "old")
+    assert dma_image.read_image(path, "new") is None
+    assert dma_image.read_image(path).key == "old"
+    assert dma_image.read_image(str(tmp_path / "missing.dma")) is None
+
+def test_image_is_replaced_atomically(tmp_path):
+    rng = random.Random(1)
+    path = str(tmp_path / "layer.dma")
+    dma_image.write_image(path, make_serial_stream(rng, 48, [1, 1, 1, 1]), 48, "first")
+    stream = make_serial_stream(rng, 48, [2, 2, 2, 2])
+    dma_image.write_image(path, stream, 48, "second")
+    assert list(dma_image.read_image(path, "second").chunks()) == get_words(stream)
+    assert os.listdir(str(tmp_path)) == ["layer.dma"]
+
+def test_export_images(tmp_path):
+    rng = random.Random(2)
+    streams = [make_serial_stream(rng, 48, [3, 4, 5, 6]) for _ in range(3)]
+    paths = dma_image.export_images(str(tmp_path), 4, streams, 48, "key")
+    assert paths == [dma_image.get_image_path(str(tmp_path), 4, layer_repetition) for layer_repetition in range(3)]
+    for path, stream in zip(paths, streams):
+        assert list(dma_image.read_image(path, "key").chunks()) == get_words(stream)
+
+@pytest.mark.parametrize("word_bytes", [1, 6, 8, 9, 17])
+def test_encode_decode(word_bytes):
+    words = np.array([0, 1, 2**(8 * word_bytes) - 1, 2**(8 * word_bytes - 1) + 5], dtype = object if word_bytes > 8 else np.uint64)
+    data = np.frombuffer(dma_image.encode(words, word_bytes), dtype = np.uint8)
+    assert len(data) == len(words) * word_bytes
+    assert dma_image.decode(data, word_bytes).tolist() == words.tolist()
@@ -0,0 +1,249 @@
+# This file is part of the OpenEye project.
+# All rights reserved. © Fachhochschule Dortmund - University of Applied Sciences and Arts.
+# SPDX-License-Identifier: SHL-2.1
+# For more details, see the LICENSE file in the root directory of this project.
+import sys
+import os
+directory = (os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)))
+sys.path.extend([directory, os.path.dirname(os.path.realpath(__file__))])
+import io
+import types
+import random
+import numpy as np
+import pytest
+import test_utils.psum_capture as psum_capture
+
+
+class BusValue(object):
+    """ Slices of a captured word like a BinaryValue: big endian, inclusive stop. """
+    def __init__(self, bits):
+        self.bits = bits
+
+    def __getitem__(self, key):
+        if key.stop > len(self.bits) - 1:
+            raise IndexError(key)
+        return BusValue(self.bits[key.start:key.stop + 1])
+
+    def __int__(self):
+        return int(self.bits, 2)
+
+def get_bus_value(word, bus_bits):
+    return BusValue(word if isinstance(word, str) else format(word, "0" + str(bus_bits) + "b"))
+
+def to_signed(value):
+    return value - 2**20 if value >= 2**19 else value
+
+# The drain loops of compare_stream_Conv/Dw/Dense before the ScatterPlan, the reference of the plans
+
+def drain_Conv(oep, layer_parameters, les, f, x, y, words, bus_bits, fmap):
+    for word in words:
+        value = get_bus_value(word, bus_bits)
+        cluster_order = []
+        for a in range(layer_parameters.used_Y_cluster):
+            for b in range(0, oep.Clusters_Y, layer_parameters.used_Y_cluster):
+                cluster_order.append(a + b)
+        for y_cluster in reversed(cluster_order):
+            for x_cluster in reversed(range(oep.Clusters_X)):
+                for router in reversed(range(oep.NUM_GLB_PSUM)):
+                    if (layer_parameters.computing_mx[oep.Clusters_X-x_cluster-1][oep.Clusters_Y-y_cluster-1][0][oep.NUM_GLB_PSUM-router-1] == 1):
+                        lower_limit = x_cluster * oep.Clusters_Y * oep.NUM_GLB_PSUM * 40 + y_cluster * oep.NUM_GLB_PSUM * 40 + router * 40
+                        upper_limit = lower_limit + 39
+                        for i in range(2):
+                            try:
+                                fmap[f][x][y] = to_signed(int(value[lower_limit+20*(1-i):upper_limit-20*i]))
+                            except (IndexError, ValueError):
+                                pass
+                            f = f + 1
+                        if ((y_cluster == 0) and (x_cluster == 0) and (router == layer_parameters.add_up)):
+                            if (f >= les.f_end):
+                                les.f_start = les.f_corner_start
+                                f = les.f_start
+                                if (x == les.x_end - 1):
+                                    x = 0
+                                    y = 0 if (y >= les.y_end - 1) else y + 1
+                                else:
+                                    x = x + 1
+                                les.y_start = y
+                                les.x_start = x
+                            else:
+                                les.f_start = f
+                                x = les.x_start
+                                y = les.y_start
+                        else:
+                            f = f - 2
+                            if (x == les.x_end - 1):
+                                x = 0
+                                y = y + 1
+                            else:
+                                x = x + 1
+    return f, x, y
+
+def drain_Conv_serial(les, f, x, y, words, bus_bits, fmap):
+    for word in words:
+        value = get_bus_value(word, bus_bits)
+        for i in range(2):
+            try:
+                fmap[f][x][y] = to_signed(int(value[28-20*i:47-20*i]))
+            except (IndexError, ValueError):
+                pass
+            f = f + 1
+        if (f >= les.f_end):
+            les.f_start = les.f_corner_start
+            f = les.f_start
+            if (x == les.x_end - 1):
+                x = 0
+                y = 0 if (y >= les.y_end - 1) else y + 1
+            else:
+                x = x + 1
+            les.y_start = y
+            les.x_start = x
+        else:
+            les.f_start = f
+            x = les.x_start
+            y = les.y_start
+    return f, x, y
+
+def drain_Dw(oep, layer_parameters, les, f, x, y, words, bus_bits, fmap):
+    for word in words:
+        value = get_bus_value(word, bus_bits)
+        for y_cluster in reversed(range(oep.Clusters_Y)):
+            for x_cluster in reversed(range(oep.Clusters_X)):
+                for router in reversed(range(oep.NUM_GLB_PSUM)):
+                    if (layer_parameters.computing_mx[oep.Clusters_X-x_cluster-1][oep.Clusters_Y-y_cluster-1][0][oep.NUM_GLB_PSUM-router-1] == 1):
+                        lower_limit = x_cluster * oep.Clusters_Y * oep.NUM_GLB_PSUM * 40 + y_cluster * oep.NUM_GLB_PSUM * 40 + router * 40
+                        upper_limit = lower_limit + 39
+                        try:
+                            fmap[f][x][y] = to_signed(int(value[lower_limit+20:upper_limit]))
+                        except (IndexError, ValueError):
+                            pass
+                        x = x + 1
+                        if (x >= les.x_end):
+                            x = 0
+                            y = y + 1
+    return f, x, y
+
+def drain_Dense(oep, layer_parameters, offset_layer_repetition, words, bus_bits, fmap, router = 3):
+    offset = 0
+    for word in words:
+        value = get_bus_value(word, bus_bits)
+        for y_cluster in reversed(range(oep.Clusters_Y)):
+            for x_cluster in reversed(range(oep.Clusters_X)):
+                lower_limit = x_cluster * oep.Clusters_Y * oep.NUM_GLB_PSUM * 40 + y_cluster * oep.NUM_GLB_PSUM * 40 + router * 40
+                upper_limit = lower_limit + 39
+                x = offset + offset_layer_repetition + (oep.Clusters_Y-1-y_cluster) * oep.Clusters_X * layer_parameters.used_psum_per_PE \
+                    + (oep.Clusters_X-1-x_cluster) * layer_parameters.used_psum_per_PE
+                for i in range(2):
+                    try:
+                        fmap[x] = to_signed(int(value[lower_limit+20*(1-i):upper_limit-20*i]))
+                    except (IndexError, ValueError):
+                        pass
+                    x = x + 1
+        offset = offset + 2
+
+
+FMAP_SHAPE = (8, 6, 6)
+
+def make_oep(rng, num_glb_psum = None):
+    return types.SimpleNamespace(Clusters_X = rng.randint(1, 3), Clusters_Y = rng.randint(1, 4),
+                                 NUM_GLB_PSUM = rng.randint(1, 4) if num_glb_psum is None else num_glb_psum, DMA_Bits = 48)
+
+def make_layer_parameters(rng, oep):
+    return types.SimpleNamespace(
+        used_Y_cluster = rng.choice([d for d in range(1, oep.Clusters_Y + 1) if oep.Clusters_Y % d == 0]),
+        add_up = rng.randint(0, oep.NUM_GLB_PSUM),
+        computing_mx = [[[[int(rng.random() < 0.8) for _ in range(oep.NUM_GLB_PSUM)]] for _ in range(oep.Clusters_Y)] for _ in range(oep.Clusters_X)],
+        used_psum_per_PE = rng.randint(1, 5))
+
+def make_les(rng):
+    return types.SimpleNamespace(f_start = rng.randint(0, 3), f_corner_start = rng.randint(0, 2), f_end = rng.randint(2, 8),
+                                 x_start = rng.randint(0, 3), y_start = rng.randint(0, 3), x_end = rng.randint(2, 6), y_end = rng.randint(2, 6))
+
+def make_words(rng, bus_bits):
+    """ Return the captured words of a drain, the first one has an unresolvable bit at times. """
+    words = [rng.getrandbits(bus_bits) for _ in range(rng.randint(0, 12))]
+    if words and (rng.random() < 0.3):
+        bits = list(format(words[0], "0" + str(bus_bits) + "b"))
+        bits[rng.randrange(bus_bits)] = "x"
+        words[0] = "".join(bits)
+    return words
+
+def get_bus_bits(oep):
+    return oep.Clusters_X * oep.Clusters_Y * oep.NUM_GLB_PSUM * psum_capture.LANE_BITS
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_plan_Conv(seed):
+    rng = random.Random(seed)
+    oep = make_oep(rng)
+    layer_parameters = make_layer_parameters(rng, oep)
+    bus_bits = get_bus_bits(oep)
+    words = make_words(rng, bus_bits)
+    les = make_les(rng)
+    plan_les = types.SimpleNamespace(**vars(les))
+    f, x, y = les.f_start, les.x_start, les.y_start
+    expected = np.zeros(FMAP_SHAPE)
+    fmap = np.zeros(FMAP_SHAPE)
+    end = drain_Conv(oep, layer_parameters, les, f, x, y, words, bus_bits, expected)
+    # The plan is extended if the DUT sends more words than expected
+    state = psum_capture.get_plan_Conv(oep, layer_parameters, plan_les, f, x, y, rng.randint(0, 15)).scatter(fmap, words, bus_bits)
+    assert np.array_equal(fmap, expected)
+    assert (state["f"], state["x"], state["y"]) == end
+    assert (state["f_start"], state["x_start"], state["y_start"]) == (les.f_start, les.x_start, les.y_start)
+
+@pytest.mark.parametrize("seed", range(50))
+def test_plan_Conv_serial(seed):
+    rng = random.Random(seed)
+    oep = make_oep(rng)
+    words = make_words(rng, oep.DMA_Bits)
+    les = make_les(rng)
+    plan_les = types.SimpleNamespace(**vars(les))
+    f, x, y = les.f_start, les.x_start, les.y_start
+    expected = np.zeros(FMAP_SHAPE)
+    fmap = np.zeros(FMAP_SHAPE)
+    end = drain_Conv_serial(les, f, x, y, words, oep.DMA_Bits, expected)
+    state = psum_capture.get_plan_Conv_serial(oep, plan_les, f, x, y, rng.randint(0, 15)).scatter(fmap, words, oep.DMA_Bits)
+    assert np.array_equal(fmap, expected)
+    assert (state["f"], state["x"], state["y"]) == end
+    assert (state["f_start"], state["x_start"], state["y_start"]) == (les.f_start, les.x_start, les.y_start)
+
+@pytest.mark.parametrize("seed", range(50))
+def test_plan_Dw(seed):
+    rng = random.Random(seed)
+    oep = make_oep(rng)
+    layer_parameters = make_layer_parameters(rng, oep)
+    bus_bits = get_bus_bits(oep)
+    words = make_words(rng, bus_bits)
+    les = make_les(rng)
+    f, x, y = les.f_start, les.x_start, les.y_start
+    expected = np.zeros(FMAP_SHAPE)
+    fmap = np.zeros(FMAP_SHAPE)
+    end = drain_Dw(oep, layer_parameters, les, f, x, y, words, bus_bits, expected)
+    state = psum_capture.get_plan_Dw(oep, layer_parameters, les, f, x, y, rng.randint(0, 15)).scatter(fmap, words, bus_bits)
+    assert np.array_equal(fmap, expected)
+    assert (state["f"], state["x"], state["y"]) == end
+
+@pytest.mark.parametrize("seed", range(50))
+def test_plan_Dense(seed):
+    rng = random.Random(seed)
+    # The Dense drain reads router 3 of every cluster
+    oep = make_oep(rng, num_glb_psum = 4)
+    layer_parameters = make_layer_parameters(rng, oep)
+    bus_bits = get_bus_bits(oep)
+    words = make_words(rng, bus_bits)
+    offset_layer_repetition = rng.randint(0, 10)
+    expected = np.zeros(128)
+    fmap = np.zeros(128)
+    drain_Dense(oep, layer_parameters, offset_layer_repetition, words, bus_bits, expected)
+    psum_capture.get_plan_Dense(oep, layer_parameters, offset_layer_repetition, cycles = rng.randint(0, 15)).scatter(fmap, words, bus_bits)
+    assert np.array_equal(fmap, expected)
+
+def test_write_debug():
+    rng = random.Random(0)
+    oep = make_oep(rng)
+    bus_bits = get_bus_bits(oep)
+    words = [rng.getrandbits(bus_bits) for _ in range(3)]
+    plan = psum_capture.get_plan_Conv(oep, make_layer_parameters(rng, oep), make_les(rng), 0, 0, 0, len(words))
+    txt_file = io.StringIO()
+    storage_file = io.StringIO()
+    plan.write_debug(txt_file, storage_file, words, bus_bits)
+    assert txt_file.getvalue() and storage_file.getvalue()
@@ -9,8 +9,11 @@ directory = (os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__fil
 sys.path.extend([directory, os.path.dirname(os.path.realpath(__file__))])
 import math
 import logging
+import numpy as np
 import generic_test_utils as gtu
+import bit_fields
 import stream_dicts as strdic
+from test_utils.stream import LaneInterner
 
 logger = logging.getLogger("cocotb")
 
@@ -20,21 +23,36 @@ class WghtStreamMapper(object):
         self.params = params
         self.layer_params = layer_params
         self.layer_repetition = layer_repetition
-        self.dram_weights = dram_layer_content
+        self.dram_weights = dram_layer_content if dram_layer_content is None else np.asarray(dram_layer_content)
+        self.wght_plan = None
+        self.interner = LaneInterner()
         if (params.SERIAL):
             self.storage = [[] for _ in range(len(strdic.stream_serial_dict))]
         else:
             self.storage = [[] for _ in range(len(strdic.stream_parallel_dict))]
 
     def get_wght_stream(self):
-        storage = [[[[] for c in range(self.params.Wght_Routers)] for b in range(self.params.Clusters_Y)] for a in range(self.params.Clusters_X)]
-        for cl_x in range(self.params.Clusters_X):
-            for cl_y in range(self.params.Clusters_Y):
-                for router in range(self.params.Wght_Routers):
-                    if(self.layer_params.computing_mx[cl_x][cl_y][router][0] == 1):
-                        spad = self.write_wght_pe(cl_x, cl_y, router)
-                        storage[cl_x][cl_y][router] = spad
-        wght_stream = self.create_complete_wght_stream(storage)
+        params = self.params
+        pes = (params.Clusters_X, params.Clusters_Y, params.Wght_Routers)
+        # PEs that do not compute get empty SPads
+        addr_spads = np.zeros(pes + (params.Wghts_Addr_per_PE,), dtype=np.int64)
+        data_spads = np.zeros(pes + (int(params.Wghts_per_PE/params.PARALLEL_MACS), 2, 2), dtype=np.int64)
+        computing_pes = [(cl_x, cl_y, router) for cl_x in range(params.Clusters_X)
+                                              for cl_y in range(params.Clusters_Y)
+                                              for router in range(params.Wght_Routers)
+                                              if(self.layer_params.computing_mx[cl_x][cl_y][router][0] == 1)]
+        if computing_pes:
+            # The data SPads of all computing PEs are gathered at once
+            cl_x, cl_y, router = [np.array(a) for a in zip(*computing_pes)]
+            data_spads[cl_x, cl_y, router] = self.write_wght_data_storage(cl_x, cl_y, router)
+            # The address SPads of PEs with the same lane key are written once
+            addr = {}
+            for pe in computing_pes:
+                key = self.get_lane_key(*pe)
+                if key not in addr:
+                    addr[key] = self.write_wght_addr_storage(*pe)
+                addr_spads[pe] = addr[key]
+        wght_stream = self.create_complete_wght_stream([addr_spads, data_spads])
         return wght_stream
     
     def write_wght_pe(self, cl_x, cl_y, router):
@@ -42,39 +60,67 @@ class WghtStreamMapper(object):
         addr_spad = self.write_wght_addr_storage(cl_x, cl_y, router)
         return [addr_spad, data_spad]
 
+    def get_lane_key(self, cl_x, cl_y, router):
+        """ Return the coordinates of a PE that its address SPad depends on. """
+        return ()
+
+    def get_used_wght_words(self):
+        """ Return the number of SPad words that are filled. """
+        return min(int(self.params.Wghts_per_PE/self.params.PARALLEL_MACS), math.ceil(self.layer_params.used_wght_per_PE/2) + 1)
+
+    def get_wght_plan(self):
+        """ Return the order of the weights in the SPad of this layer repetition.
+
+        The order is the same for all PEs, it is computed once. Returns the
+        arrays channel, filters, kernel_x and the mask of the written values
+        with the shape (words, PARALLEL_MACS).
+        """
+        if self.wght_plan is None:
+            layer_params = self.layer_params
+            params = self.params
+
+            channels = int(layer_params.input_shape[3]/layer_params.iact_transmissions_pe)
+            filters_per_calculation = math.ceil(layer_params.used_wght_per_PE/layer_params.used_iact_per_PE)
+            start_current_repetition = int((math.floor(self.layer_repetition/layer_params.iact_transmissions_pe) % layer_params.needed_wght_transmissions) * filters_per_calculation)
+
+            # The filters change fastest, then kernel_x, then the channel
+            value = np.arange(self.get_used_wght_words() * params.PARALLEL_MACS).reshape(-1, params.PARALLEL_MACS)
+            filters = start_current_repetition + value % filters_per_calculation
+            kernel_x = (value // filters_per_calculation) % layer_params.kernel_size[0]
+            channel_offset = value // (filters_per_calculation * layer_params.kernel_size[0])
+            channel = channel_offset + (self.layer_repetition % layer_params.iact_transmissions_pe) * math.ceil(layer_params.input_shape[3]/layer_params.iact_transmissions_pe)
+            self.wght_plan = (channel, filters, kernel_x, channel_offset < channels)
+        return self.wght_plan
+
+    def get_used_kernel_rows(self):
+        layer_params = self.layer_params
+        return layer_params.kernel_size[1] * int(layer_params.input_shape[3]/layer_params.iact_transmissions_pe)
+
     def write_wght_data_storage(self, cl_x, cl_y, router):
+        """ Return the data SPads of the PEs cl_x, cl_y, router.
 
-        layer_repetition = self.layer_repetition
+        The arguments are broadcast against each other. The result is an
+        ndarray with the shape (*broadcast shape, words, 2, 2) that holds the
+        weight and the overhead counter of every value. The overhead counter of
+        the weights is always 0.
+        """
         layer_params = self.layer_params
         params = self.params
         dram = self.dram_weights
 
-        spad_storage = [[[0 for _ in range(2)] for _ in range(2)] for _ in range(int(self.params.Wghts_per_PE/self.params.PARALLEL_MACS))]
-        overhead_counter = 0
-        kernel_x = 0
-        channel = (layer_repetition % layer_params.iact_transmissions_pe) * math.ceil(layer_params.input_shape[3]/layer_params.iact_transmissions_pe)
-        filters_per_calculation = math.ceil(layer_params.used_wght_per_PE/layer_params.used_iact_per_PE)
-        start_current_repetition = int((math.floor(layer_repetition/layer_params.iact_transmissions_pe) % layer_params.needed_wght_transmissions) * filters_per_calculation)
-        filters = start_current_repetition
-                    
-        for words_in_storage in range(int(self.params.Wghts_per_PE/self.params.PARALLEL_MACS)):
-            kernel_row = (cl_y % layer_params.ceil_used_PE_per_clm) * params.PEs_Y + router
-            if(kernel_row < (layer_params.kernel_size[1] * int(layer_params.input_shape[3]/layer_params.iact_transmissions_pe))):
-                for spad_val_number in range(self.params.PARALLEL_MACS): 
-                    if(channel != int(layer_params.input_shape[3]/layer_params.iact_transmissions_pe) + (layer_repetition % layer_params.iact_transmissions_pe) * math.ceil(layer_params.input_shape[3]/layer_params.iact_transmissions_pe)):
-                        spad_storage[words_in_storage][spad_val_number][0] = dram[channel][filters][kernel_row][kernel_x]
-                        spad_storage[words_in_storage][spad_val_number][1] = overhead_counter
-                        filters = filters + 1
-                        if((filters == (start_current_repetition + filters_per_calculation))):
-                            filters = start_current_repetition
-                            kernel_x = kernel_x + 1
-                            overhead_counter = 0
-                        if(kernel_x == layer_params.kernel_size[0]):
-                            kernel_x = 0
-                            channel = channel + 1
-            if (words_in_storage == math.ceil(layer_params.used_wght_per_PE/2)):
-                break
+        channel, filters, kernel_x, written = self.get_wght_plan()
+        cl_x, cl_y, router = np.broadcast_arrays(cl_x, cl_y, router)
+        kernel_row = ((cl_y % layer_params.ceil_used_PE_per_clm) * params.PEs_Y + router)[..., None, None]
+        used = np.broadcast_to(written & (kernel_row < self.get_used_kernel_rows()), kernel_row.shape[:-2] + written.shape)
+        values = np.zeros(used.shape, dtype=np.int64)
+        values[used] = self.gather_wghts(dram, *[np.broadcast_to(a, used.shape)[used] for a in (channel, filters, kernel_row, kernel_x)])
+
+        spad_storage = np.zeros(used.shape[:-2] + (int(params.Wghts_per_PE/params.PARALLEL_MACS), 2, 2), dtype=np.int64)
+        spad_storage[..., :values.shape[-2], :values.shape[-1], 0] = values
         return spad_storage
+
+    def gather_wghts(self, dram, channel, filters, kernel_row, kernel_x):
+        return dram[channel, filters, kernel_row, kernel_x]
         
     def write_wght_addr_storage(self, cl_x, cl_y, router):
 
@@ -92,116 +138,61 @@ class WghtStreamMapper(object):
         return spad_storage
         
     def create_complete_wght_stream(self, spad_storage):
+        """ Return the stream of the SPads [addr, data] of all PEs. """
         params = self.params
 
-        stream = [[[[] for c in range(params.Wght_Routers)] for b in range(params.Clusters_Y)] for a in range(params.Clusters_X)]
-        for cl_x in range(params.Clusters_X):
-            for cl_y in range(params.Clusters_Y):
-                for router in range(params.Wght_Routers):
-
-                    current_spad = spad_storage[cl_x][cl_y][router]
-                    stream[cl_x][cl_y][router] = self.create_pe_addr_wght_stream(current_spad)
-                    stream[cl_x][cl_y][router].extend(self.create_pe_data_wght_stream(current_spad))
+        # The address transmissions of a PE are followed by its data transmissions
+        words = np.concatenate([self.create_pe_addr_wght_stream(spad_storage),
+                                self.create_pe_data_wght_stream(spad_storage)], axis=-1)
         if(params.SERIAL):
-            temp_stream = stream
-            stream = []
-            for cl_y in range(params.Clusters_Y):
-                for router in range(params.Iact_Routers):
-                    for word in range(len(temp_stream[0][cl_y][router])):
-                        stream.append(temp_stream[0][cl_y][router][word] + (temp_stream[1][cl_y][router][word] * (2**24)))
-        return stream
+            return bit_fields.pack(np.stack([words[0], words[1]], axis=-1)[:, :params.Iact_Routers], 24).reshape(-1).tolist()
+        return self.interner.intern_rows(words)
     
     def create_pe_addr_wght_stream(self, spad):
+        """ Return the address transmissions of one or more SPads [addr, data].
+
+        Every transmission is repeated addr_per_trans times.
+        """
         layer_params = self.layer_params
         params = self.params
 
         addr_per_trans = math.floor(params.WGHT_Trans_Bitwidth/params.WGHT_Addr_Bitwidth)
-        line_counter = 0
-        stream = []
-
-        for spad_addr_trans in range(math.ceil(params.Wghts_Addr_per_PE/addr_per_trans)):
-            temp_trans = 0
-            for addr_in_trans in range(addr_per_trans):
-                try:
-                    spad_word = addr_in_trans + spad_addr_trans * addr_per_trans
-                    temp_trans = temp_trans + \
-                        (spad[0][spad_word] \
-                        << (params.WGHT_Addr_Bitwidth * addr_in_trans)) 
-                except:
-                    pass
-            for write_time in range(addr_per_trans):
-                stream.append(temp_trans)
-                line_counter = line_counter + 1
-                if (line_counter == layer_params.used_wght_addr_per_PE):
-                    break
-            if (line_counter == layer_params.used_wght_addr_per_PE):
-                break
-        return stream
+        transmissions = math.ceil(params.Wghts_Addr_per_PE/addr_per_trans)
+        words = bit_fields.pack(bit_fields.group(spad[0], transmissions, addr_per_trans), params.WGHT_Addr_Bitwidth)
+        lines = gtu.get_used_transmissions(layer_params.used_wght_addr_per_PE, transmissions * addr_per_trans)
+        return np.repeat(words, addr_per_trans, axis=-1)[..., :lines]
     
     def create_pe_data_wght_stream(self, spad):
+        """ Return the data transmissions of one or more SPads [addr, data].
+
+        Transmission n holds the weights of SPad word n, without overhead.
+        """
         layer_params = self.layer_params
         params = self.params
 
         data_per_trans = math.floor(params.WGHT_Trans_Bitwidth/params.WGHT_WOH_Bitwidth)
-        line_counter = 0
-        stream = []
-        for spad_data_trans in range(math.floor(params.Wghts_per_PE/data_per_trans)):
-            temp_trans = 0
-            for data_in_trans in range(data_per_trans):
-                try:
-                    spad_word = data_in_trans + data_per_trans * spad_data_trans
-                    value = gtu.to_twos_complement(spad[1][spad_data_trans][data_in_trans][0], self.params.WGHT_Bitwidth)
-                    temp_trans = temp_trans + (value << (data_in_trans * params.WGHT_WOH_Bitwidth))
-                except:
-                    pass
-            stream.append(temp_trans)
-            line_counter = line_counter + 1
-            if (line_counter == math.ceil(layer_params.used_wght_per_PE/2)):
-                break
-        return stream
+        transmissions = gtu.get_used_transmissions(math.ceil(layer_params.used_wght_per_PE/2),
+                                                   math.floor(params.Wghts_per_PE/data_per_trans))
+        values = np.asarray(spad[1])[..., 0]
+        lanes = np.zeros(values.shape[:-2] + (transmissions, data_per_trans), dtype=np.int64)
+        words_used = min(transmissions, values.shape[-2])
+        lanes_used = min(data_per_trans, values.shape[-1])
+        lanes[..., :words_used, :lanes_used] = values[..., :words_used, :lanes_used]
+        return bit_fields.pack(bit_fields.to_unsigned(lanes, params.WGHT_Bitwidth), params.WGHT_WOH_Bitwidth)
     
 class ConvWghtStreamMapper(WghtStreamMapper):
     def __init__(self, params, layer_params, layer_repetition, dram_layer_content):
         super().__init__(params, layer_params, layer_repetition, dram_layer_content)
 
-    def write_wght_data_storage(self, cl_x, cl_y, router):
+    def get_used_kernel_rows(self):
+        return self.layer_params.kernel_size[1]
 
-        layer_repetition = self.layer_repetition
-        layer_params = self.layer_params
-        params = self.params
-        dram = self.dram_weights
-
-        spad_storage = [[[0 for _ in range(2)] for _ in range(2)] for _ in range(int(self.params.Wghts_per_PE/self.params.PARALLEL_MACS))]
-        overhead_counter = 0
-        kernel_x = 0
-        channel = (layer_repetition % layer_params.iact_transmissions_pe) * math.ceil(layer_params.input_shape[3]/layer_params.iact_transmissions_pe)
-        filters_per_calculation = math.ceil(layer_params.used_wght_per_PE/layer_params.used_iact_per_PE)
-        start_current_repetition = int((math.floor(layer_repetition/layer_params.iact_transmissions_pe) % layer_params.needed_wght_transmissions) * filters_per_calculation)
-        filters = start_current_repetition
-                    
-        for words_in_storage in range(int(self.params.Wghts_per_PE/self.params.PARALLEL_MACS)):
-            kernel_row = (cl_y % layer_params.ceil_used_PE_per_clm) * params.PEs_Y + router
-            if(kernel_row < (layer_params.kernel_size[1])):
-                for spad_val_number in range(self.params.PARALLEL_MACS): 
-                    if(channel != int(layer_params.input_shape[3]/layer_params.iact_transmissions_pe) + (layer_repetition % layer_params.iact_transmissions_pe) * math.ceil(layer_params.input_shape[3]/layer_params.iact_transmissions_pe)):
-                        
-                        try:
-                            spad_storage[words_in_storage][spad_val_number][0] = dram[channel][filters][kernel_row][kernel_x]
-                        except:
-                            spad_storage[words_in_storage][spad_val_number][0] = 0
-
-                        spad_storage[words_in_storage][spad_val_number][1] = overhead_counter
-                        filters = filters + 1
-                        if((filters == (start_current_repetition + filters_per_calculation))):
-                            filters = start_current_repetition
-                            kernel_x = kernel_x + 1
-                            overhead_counter = 0
-                        if(kernel_x == layer_params.kernel_size[0]):
-                            kernel_x = 0
-                            channel = channel + 1
-            if (words_in_storage == math.ceil(layer_params.used_wght_per_PE/2)):
-                break
-        return spad_storage
+    def gather_wghts(self, dram, channel, filters, kernel_row, kernel_x):
+        # Weights outside of the weight tensor are 0
+        inside = (channel < dram.shape[0]) & (filters < dram.shape[1]) & (kernel_row < dram.shape[2]) & (kernel_x < dram.shape[3])
+        values = np.zeros(inside.shape, dtype=np.int64)
+        values[inside] = dram[channel[inside], filters[inside], kernel_row[inside], kernel_x[inside]]
+        return values
         
     def write_wght_addr_storage(self, cl_x, cl_y, router):
 
@@ -228,28 +219,29 @@ class DenseWghtStreamMapper(WghtStreamMapper):
         params = self.params
         dram = self.dram_weights
 
-        spad_storage = [[[0 for _ in range(2)] for _ in range(2)] for _ in range(int(self.params.Wghts_per_PE/self.params.PARALLEL_MACS))]
-        overhead_counter = 0
-                
-        for words_in_storage in range(int(self.params.Wghts_per_PE/self.params.PARALLEL_MACS)):
-            for spad_val_number in range(self.params.PARALLEL_MACS):
-
-                position = words_in_storage * 2 + spad_val_number
-                filters =  (position%layer_params.used_psum_per_PE) + \
-                cl_x * layer_params.used_psum_per_PE + \
-                cl_y * params.Clusters_X * layer_params.used_psum_per_PE + \
-                (math.floor(layer_repetition/layer_params.iact_transmissions_pe) % layer_params.psum_transmissions_pe) * params.Clusters_X * params.Clusters_Y * layer_params.used_psum_per_PE
-
-                channel = math.floor((layer_repetition%layer_params.iact_transmissions_pe)*params.Wght_Routers*layer_params.used_iact_per_PE) + \
-                math.floor(position/layer_params.used_psum_per_PE) + \
-                router * layer_params.used_iact_per_PE
-                try:
-                    spad_storage[words_in_storage][spad_val_number][0] = dram[filters][channel]
-                    spad_storage[words_in_storage][spad_val_number][1] = overhead_counter
-                except:
-                    pass
-            if (words_in_storage == math.ceil(layer_params.used_wght_per_PE/2)):
-                break
+        words = np.arange(self.get_used_wght_words())[:, None]
+        position = words * 2 + np.arange(params.PARALLEL_MACS)[None, :]
+        cl_x = np.asarray(cl_x)[..., None, None]
+        cl_y = np.asarray(cl_y)[..., None, None]
+        router = np.asarray(router)[..., None, None]
+
+        filters =  (position%layer_params.used_psum_per_PE) + \
+        cl_x * layer_params.used_psum_per_PE + \
+        cl_y * params.Clusters_X * layer_params.used_psum_per_PE + \
+        (math.floor(layer_repetition/layer_params.iact_transmissions_pe) % layer_params.psum_transmissions_pe) * params.Clusters_X * params.Clusters_Y * layer_params.used_psum_per_PE
+
+        channel = math.floor((layer_repetition%layer_params.iact_transmissions_pe)*params.Wght_Routers*layer_params.used_iact_per_PE) + \
+        position // layer_params.used_psum_per_PE + \
+        router * layer_params.used_iact_per_PE
+
+        # Weights outside of the weight tensor are 0
+        filters, channel = np.broadcast_arrays(filters, channel)
+        inside = (filters < dram.shape[0]) & (channel < dram.shape[1])
+        values = np.zeros(inside.shape, dtype=np.int64)
+        values[inside] = dram[filters[inside], channel[inside]]
+
+        spad_storage = np.zeros(inside.shape[:-2] + (int(params.Wghts_per_PE/params.PARALLEL_MACS), 2, 2), dtype=np.int64)
+        spad_storage[..., :values.shape[-2], :values.shape[-1], 0] = values
         return spad_storage
         
     def write_wght_addr_storage(self, cl_x, cl_y, router):
@@ -271,38 +263,26 @@ class DwWghtStreamMapper(WghtStreamMapper):
     def __init__(self, params, layer_params, layer_repetition, dram_layer_content):
         super().__init__(params, layer_params, layer_repetition, dram_layer_content)
 
-    def write_wght_data_storage(self, cl_x, cl_y, router):
+    def get_wght_plan(self):
+        if self.wght_plan is None:
+            layer_params = self.layer_params
 
-        layer_repetition = self.layer_repetition
-        layer_params = self.layer_params
-        params = self.params
-        dram = self.dram_weights
-
-        spad_storage = [[[0 for _ in range(2)] for _ in range(2)] for _ in range(int(self.params.Wghts_per_PE/self.params.PARALLEL_MACS))]
-        overhead_counter = 0
-        kernel_x = 0
-        channel = (layer_repetition % layer_params.iact_transmissions_pe) * math.ceil(layer_params.input_shape[3]/layer_params.iact_transmissions_pe)
-                    
-        if(layer_params.filters == 1):
-            values_per_wght_data = 1
-        else:
-            values_per_wght_data = 2
-        for words_in_storage in range(int(self.params.Wghts_per_PE/self.params.PARALLEL_MACS)):
-            Mtrx_Row = (cl_y % layer_params.ceil_used_PE_per_clm) * params.PEs_Y + router
-            if(Mtrx_Row < (layer_params.kernel_size[1] * int(layer_params.input_shape[3]/layer_params.iact_transmissions_pe))):
-                for spad_val_number in range(values_per_wght_data): 
-                    if(channel != int(layer_params.input_shape[3]/layer_params.iact_transmissions_pe) + (layer_repetition % layer_params.iact_transmissions_pe) * math.ceil(layer_params.input_shape[3]/layer_params.iact_transmissions_pe)):
-                        spad_storage[words_in_storage][spad_val_number][0] = dram[channel][Mtrx_Row][kernel_x]
-                        spad_storage[words_in_storage][spad_val_number][1] = overhead_counter
-                        overhead_counter = overhead_counter + 1
-                        kernel_x = kernel_x + 1
-                        overhead_counter = 0
-                        if(kernel_x == layer_params.kernel_size[0]):
-                            kernel_x = 0
-                            channel = channel + 1
-            if (words_in_storage == math.ceil(layer_params.used_wght_per_PE/2)):
-                break
-        return spad_storage
+            channels = int(layer_params.input_shape[3]/layer_params.iact_transmissions_pe)
+            if(layer_params.filters == 1):
+                values_per_wght_data = 1
+            else:
+                values_per_wght_data = 2
+
+            # Each channel has its own kernel, kernel_x changes fastest
+            value = np.arange(self.get_used_wght_words() * values_per_wght_data).reshape(-1, values_per_wght_data)
+            kernel_x = value % layer_params.kernel_size[0]
+            channel_offset = value // layer_params.kernel_size[0]
+            channel = channel_offset + (self.layer_repetition % layer_params.iact_transmissions_pe) * math.ceil(layer_params.input_shape[3]/layer_params.iact_transmissions_pe)
+            self.wght_plan = (channel, np.zeros_like(value), kernel_x, channel_offset < channels)
+        return self.wght_plan
+
+    def gather_wghts(self, dram, channel, filters, Mtrx_Row, kernel_x):
+        return dram[channel, Mtrx_Row, kernel_x]
         
     def write_wght_addr_storage(self, cl_x, cl_y, router):
 
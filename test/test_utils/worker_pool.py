@@ -0,0 +1,109 @@
+# This file is part of the OpenEye project.
+# All rights reserved. © Fachhochschule Dortmund - University of Applied Sciences and Arts.
+# SPDX-License-Identifier: SHL-2.1
+# For more details, see the LICENSE file in the root directory of this project.
+"""
+Shared, bounded process pool for the host-side work of the testbench.
+
+The pool is created on first use and reused for all later tasks. It is
+configured with environment variables:
+    WORKER_POOL_PROCESSES: Number of worker processes (default: CPU count).
+    WORKER_POOL_START_METHOD: forkserver or spawn (default: forkserver if
+        available). numpy is preloaded in the workers.
+"""
+import sys
+import os
+import math
+import atexit
+import shutil
+import logging
+import multiprocessing as mp
+
+logger = logging.getLogger("cocotb")
+
+_pool = None
+_processes = None
+
+
+def get_processes():
+    """ Return the number of worker processes. """
+    try:
+        processes = int(os.getenv("WORKER_POOL_PROCESSES", os.cpu_count() or 1))
+    except ValueError:
+        logger.warning("WORKER_POOL_PROCESSES is not a number. Setting to the CPU count.")
+        processes = os.cpu_count() or 1
+    return max(1, processes)
+
+def get_context():
+    """ Return the multiprocessing context of the pool. """
+    start_method = os.getenv("WORKER_POOL_START_METHOD")
+    if start_method is None:
+        start_method = "forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn"
+    elif start_method not in ("forkserver", "spawn"):
+        logger.warning("WORKER_POOL_START_METHOD " + start_method + " unknown. Setting to spawn.")
+        start_method = "spawn"
+    context = mp.get_context(start_method)
+    if start_method == "forkserver":
+        context.set_forkserver_preload(["numpy"])
+    # Inside of the simulator sys.executable is not a Python interpreter
+    if "python" not in os.path.basename(sys.executable or ""):
+        executable = os.getenv("PYGPI_PYTHON_BIN") or shutil.which("python3")
+        if executable:
+            context.set_executable(executable)
+    return context
+
+def init_worker(sys_path, log_level):
+    sys.path[:] = sys_path
+    # Preload numpy for the spawn start method as well
+    import numpy
+    logger.setLevel(log_level)
+
+def get_pool():
+    """ Return the shared pool, create it on first use. """
+    global _pool, _processes
+    if _pool is None:
+        _processes = get_processes()
+        _pool = get_context().Pool(_processes, initializer = init_worker, initargs = (list(sys.path), logger.level))
+        logger.debug("Worker pool with " + str(_processes) + " processes started.")
+    return _pool
+
+def get_chunksize(tasks):
+    get_pool()
+    return max(1, math.ceil(tasks / (4 * _processes)))
+
+def starmap(function, args, chunksize = None):
+    """ Run function(*arg) for every arg in the pool.
+
+    The results are returned in the order of args.
+    """
+    args = list(args)
+    if not args:
+        return []
+    if chunksize is None:
+        chunksize = get_chunksize(len(args))
+    return get_pool().starmap(function, args, chunksize)
+
+def apply_async(function, args = (), callback = None, error_callback = None):
+    """ Run function(*args) in the pool without waiting for the result.
+
+    Returns the AsyncResult. The callbacks run in a thread of the pool and
+    must not block.
+    """
+    return get_pool().apply_async(function, args, callback = callback, error_callback = error_callback)
+
+def starmap_async(function, args, chunksize = None, callback = None, error_callback = None):
+    """ Like starmap, but returns an AsyncResult instead of waiting for the results. """
+    args = list(args)
+    if chunksize is None:
+        chunksize = get_chunksize(max(1, len(args)))
+    return get_pool().starmap_async(function, args, chunksize, callback = callback, error_callback = error_callback)
+
+def shutdown():
+    """ Stop the shared pool. A later task creates a new one. """
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
+
+atexit.register(shutdown)